@@ -0,0 +1,42 @@
+"""Compare two sets of results written by benchmarks.suite.
+
+Usage (from the root of the repository):
+    python -m benchmarks.compare BASELINE.json RESULTS.json
+"""
+import argparse
+import json
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+
+    return {
+        (r["scenario"], r["compression"], r["entries"]): r for r in report["results"]
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("results")
+    args = parser.parse_args(argv)
+
+    baseline = load_results(args.baseline)
+    results = load_results(args.results)
+
+    print(
+        "%-20s %-5s %7s %12s %12s %8s"
+        % ("scenario", "comp", "entries", "baseline ms", "ms", "change")
+    )
+    for key in sorted(baseline.keys() & results.keys()):
+        before = baseline[key]["latency_ms"]["median"]
+        after = results[key]["latency_ms"]["median"]
+        print(
+            "%-20s %-5s %7d %12.2f %12.2f %+7.1f%%"
+            % (key + (before, after, (after - before) / before * 100))
+        )
+
+
+if __name__ == "__main__":
+    main()
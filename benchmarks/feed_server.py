@@ -0,0 +1,191 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.record_request(self)
+        feed = self.server.feeds.get(self.path)
+        if feed is None:
+            self._send_status(404)
+            return
+
+        with self.server.lock:
+            failure = feed["failures"].pop(0) if feed["failures"] else None
+            drop_after = feed["drops"].pop(0) if feed["drops"] else None
+
+        if feed["delay"]:
+            time.sleep(feed["delay"])
+
+        if failure is not None:
+            self._send_status(failure)
+            return
+
+        etag = feed["headers"].get("ETag")
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            # A 304 response repeats the headers that control caching
+            self._send_status(
+                304,
+                {
+                    name: value
+                    for name, value in feed["headers"].items()
+                    if name in ("Cache-Control", "ETag")
+                },
+            )
+            return
+
+        status = 200
+        headers = dict(feed["headers"])
+        content = feed["content"]
+        if feed["ranges"]:
+            headers["Accept-Ranges"] = "bytes"
+            start = self._get_range_start(headers)
+            if start is not None:
+                if start >= len(content):
+                    self._send_status(416)
+                    return
+
+                status = 206
+                headers["Content-Range"] = "bytes %d-%d/%d" % (
+                    start,
+                    len(content) - 1,
+                    len(content),
+                )
+                content = content[start:]
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+
+        if drop_after is not None:
+            # Simulate a dropped connection after drop_after bytes of the body
+            self.wfile.write(content[:drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(content)
+
+    def do_HEAD(self):
+        self.server.record_request(self)
+        feed = self.server.feeds.get(self.path)
+        if feed is None:
+            self._send_status(404)
+            return
+
+        self.send_response(200)
+        for name, value in feed["headers"].items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(feed["content"])))
+        self.end_headers()
+
+    def _get_range_start(self, headers):
+        range_header = self.headers.get("Range")
+        if range_header is None or not range_header.startswith("bytes="):
+            return None
+
+        # Ranges are only honoured if the client's copy is still current
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range not in (
+            headers.get("ETag"),
+            headers.get("Last-Modified"),
+        ):
+            return None
+
+        return int(range_header.partition("=")[2].split("-")[0])
+
+    def _send_status(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    """A local HTTP server that stands in for the servers feeds are fetched from.
+
+    Feeds are served from memory. Used as a context manager, the server runs in a
+    background thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FeedRequestHandler)
+        self.lock = threading.Lock()
+        self.feeds = {}
+        self.requests = []
+        self._thread = None
+
+    def add_feed(
+        self,
+        path,
+        content,
+        headers=None,
+        delay=0,
+        failures=None,
+        ranges=False,
+        drops=None,
+    ):
+        """Serve content at path.
+
+        Each of failures is the status code of a failed response to one request.
+        If ranges is True, range requests are supported. Each of drops is the number
+        of bytes of the body after which the connection is dropped, for one request.
+        """
+        if isinstance(content, str):
+            content = content.encode()
+
+        self.feeds[path] = {
+            "content": content,
+            "headers": headers or {},
+            "delay": delay,
+            "failures": list(failures or []),
+            "ranges": ranges,
+            "drops": list(drops or []),
+        }
+
+        return self.url(path)
+
+    def add_feed_file(self, path, file_path, **kwargs):
+        with open(file_path, "rb") as f:
+            return self.add_feed(path, f.read(), **kwargs)
+
+    def url(self, path):
+        return "http://%s:%d%s" % (self.server_address[0], self.server_address[1], path)
+
+    def record_request(self, handler):
+        with self.lock:
+            self.requests.append(
+                {
+                    "method": handler.command,
+                    "path": handler.path,
+                    "headers": dict(handler.headers),
+                    "client_address": handler.client_address,
+                }
+            )
+
+    def requests_for(self, path):
+        return [r for r in self.requests if r["path"] == path]
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
@@ -0,0 +1,61 @@
+"""Generate synthetic feeds shaped like the files served to USTDownloadCache."""
+import bz2
+import gzip
+import json
+import random
+
+COMPRESSIONS = ("plain", "bz2", "gz")
+PRIORITIES = ("negligible", "low", "medium", "high", "critical")
+RELEASES = ("bionic", "focal", "jammy", "noble")
+STATUSES = ("released", "needed", "not-affected", "deferred")
+WORDS = (
+    "a buffer overflow allows remote attackers to execute arbitrary code via "
+    "crafted input in the parser of the library when handling malformed "
+    "certificates denial of service memory corruption use after free integer "
+    "underflow out of bounds read information disclosure privilege escalation"
+).split()
+
+
+def generate_document(entries, timestamp=1591401600, ttl=3600, seed=0):
+    """Return a feed document with entries CVE-like members in its data.
+
+    The same arguments always produce the same document, so that results can be
+    compared across runs and versions.
+    """
+    rng = random.Random(seed)
+    data = {}
+    for i in range(entries):
+        data["CVE-%d-%05d" % (2000 + i % 25, i)] = {
+            "description": " ".join(
+                rng.choice(WORDS) for _ in range(rng.randint(8, 40))
+            ),
+            "priority": rng.choice(PRIORITIES),
+            "packages": {
+                "pkg%d"
+                % rng.randrange(entries): {
+                    release: {
+                        "status": rng.choice(STATUSES),
+                        "version": "%d.%d.%d-%dubuntu%d"
+                        % tuple(rng.randrange(20) for _ in range(5)),
+                    }
+                    for release in RELEASES
+                }
+                for _ in range(rng.randint(1, 4))
+            },
+            "cvss_score": round(rng.uniform(0, 10), 1),
+            "public": rng.random() < 0.9,
+        }
+
+    return {"metadata": {"timestamp": timestamp, "ttl": ttl}, "data": data}
+
+
+def encode_feed(document, compression="plain"):
+    content = json.dumps(document, indent=1).encode()
+    if compression == "bz2":
+        return bz2.compress(content)
+    if compression == "gz":
+        return gzip.compress(content)
+    if compression == "plain":
+        return content
+
+    raise ValueError("Unknown compression %r" % compression)
@@ -0,0 +1,54 @@
+"""Compare loading a cached file with json.loads() against loading its snapshot.
+
+Usage (from the root of the repository):
+    python -m benchmarks.snapshot_load [--entries N] [--repeat N]
+"""
+import argparse
+import json
+import os
+import tempfile
+import timeit
+
+from benchmarks.feeds import generate_document
+from ust_download_cache.document_cache import get_file_identity
+from ust_download_cache.snapshot import read_snapshot, write_snapshot
+
+
+def load_json(path):
+    with open(path, "rb") as f:
+        return json.loads(f.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "document")
+        snapshot_path = path + ".snapshot"
+        with open(path, "w") as f:
+            json.dump(generate_document(args.entries), f)
+
+        identity = get_file_identity(path)
+        write_snapshot(snapshot_path, identity, load_json(path))
+
+        print(
+            "File size: %d bytes, snapshot size: %d bytes"
+            % (os.path.getsize(path), os.path.getsize(snapshot_path))
+        )
+        timings = {
+            "json.loads": lambda: load_json(path),
+            "snapshot": lambda: read_snapshot(snapshot_path, identity),
+        }
+        results = {}
+        for name, load in timings.items():
+            results[name] = min(timeit.repeat(load, number=1, repeat=args.repeat))
+            print("%-10s %8.2f ms" % (name, results[name] * 1000))
+
+        print("Speedup: %.1fx" % (results["json.loads"] / results["snapshot"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Measure how long a short-lived process takes to read a fresh cached file.
+
+Each run starts a new Python process that imports ust_download_cache, creates a
+USTDownloadCache for a pre-populated cache dir and reads one file from it.
+
+Usage (from the root of the repository):
+    python -m benchmarks.startup [--runs N] [--index-entries N]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from ust_download_cache import CachedFile
+from ust_download_cache.cache_index import JSONCacheIndex
+
+CHILD_SCRIPT = """
+import logging, sys, time
+logger = logging.getLogger("benchmark")
+logger.addHandler(logging.NullHandler())
+start = time.perf_counter()
+import ust_download_cache
+imported = time.perf_counter()
+udc = ust_download_cache.USTDownloadCache(logger, sys.argv[1])
+created = time.perf_counter()
+udc.get_data_from_url(sys.argv[2])
+read = time.perf_counter()
+print(imported - start, created - imported, read - created, "requests" in sys.modules)
+"""
+
+
+def populate_cache(cache_dir, index_entries):
+    logger = logging.getLogger("benchmark")
+    logger.addHandler(logging.NullHandler())
+    index = JSONCacheIndex(logger, cache_dir)
+    document = {"metadata": {"timestamp": int(time.time()), "ttl": 3600}, "data": {}}
+
+    for i in range(index_entries):
+        path = os.path.join(cache_dir, str(uuid.uuid4()))
+        with open(path, "w") as f:
+            json.dump(document, f)
+
+        url = "https://example.com/%d.json" % i
+        index[url] = CachedFile(url, path, document["metadata"]["timestamp"], 3600)
+
+    index.save()
+    return url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--index-entries", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        url = populate_cache(cache_dir, args.index_entries)
+        timings = []
+        for _ in range(args.runs):
+            output = subprocess.check_output(
+                [sys.executable, "-c", CHILD_SCRIPT, cache_dir, url]
+            ).split()
+            timings.append([float(t) for t in output[:3]])
+            imported_requests = output[3] == b"True"
+
+    for i, name in enumerate(["import", "construct", "first read"]):
+        values = [t[i] * 1000 for t in timings]
+        print(
+            "%-11s median %7.2f ms, min %7.2f ms"
+            % (name, statistics.median(values), min(values))
+        )
+
+    print("requests imported: %s" % imported_requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""Benchmark USTDownloadCache.get_data_from_url() against a local feed server.
+
+Synthetic feeds of each size and compression are served over HTTP and the
+latency of cache hits, misses and refreshes of expired files, the throughput of
+decompression and the peak memory allocated by Python during a hit and a miss
+are measured. Results are written as JSON, so that they can be compared across
+versions with benchmarks.compare.
+
+Usage (from the root of the repository):
+    python -m benchmarks.suite [--entries N ...] [--runs N] [--output FILE]
+"""
+import argparse
+import functools
+import io
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from benchmarks.feed_server import FeedServer
+from benchmarks.feeds import COMPRESSIONS, encode_feed, generate_document
+from ust_download_cache import USTDownloadCache
+from ust_download_cache.decompressors import MAX_MAGIC_NUMBER_LENGTH, get_decompressor
+from ust_download_cache.ust_download_cache import DOWNLOAD_CHUNK_SIZE
+
+RESULTS_SCHEMA_VERSION = 1
+DEFAULT_ENTRIES = (1000, 10000)
+DEFAULT_RUNS = 10
+
+
+def get_logger():
+    logger = logging.getLogger("benchmarks.null")
+    if not logger.hasHandlers():
+        logger.addHandler(logging.NullHandler())
+
+    return logger
+
+
+def get_git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(durations):
+    latencies = sorted(d * 1000 for d in durations)
+    return {
+        "min": latencies[0],
+        "median": statistics.median(latencies),
+        "mean": statistics.mean(latencies),
+        "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "max": latencies[-1],
+    }
+
+
+def measure_peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def time_runs(func, runs, setup=None):
+    durations = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        durations.append(timeit.timeit(func, number=1))
+
+    return durations
+
+
+class Scenarios:
+    """The scenarios measured for one feed, served at url."""
+
+    def __init__(self, server, feed_name, document, compression, cache_options):
+        self.logger = get_logger()
+        self.cache_options = cache_options
+        self.compression = compression
+        self.content = encode_feed(document, compression)
+        self.uncompressed_size = len(encode_feed(document))
+        self.url = server.add_feed("/%s" % feed_name, self.content)
+
+        # A negative ttl keeps revalidated files expired within the same second
+        expired_document = dict(document, metadata={"timestamp": 0, "ttl": -1})
+        expired_content = encode_feed(expired_document, compression)
+        self.expired_url = server.add_feed("/expired/%s" % feed_name, expired_content)
+        self.not_modified_url = server.add_feed(
+            "/not-modified/%s" % feed_name, expired_content, {"ETag": '"1"'}
+        )
+        self._tmp_dirs = []
+
+    def close(self):
+        for tmp_dir in self._tmp_dirs:
+            tmp_dir.cleanup()
+
+    def create_cache(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self._tmp_dirs.append(tmp_dir)
+        return USTDownloadCache(self.logger, tmp_dir.name, **self.cache_options)
+
+    def miss(self, runs):
+        caches = []
+        durations = time_runs(
+            lambda: caches[-1].get_data_from_url(self.url),
+            runs,
+            setup=lambda: caches.append(self.create_cache()),
+        )
+        peak_memory = measure_peak_memory(
+            lambda: self.create_cache().get_data_from_url(self.url)
+        )
+
+        return durations, peak_memory
+
+    def hit(self, runs):
+        cache = self.create_cache()
+        cache.get_data_from_url(self.url)
+        durations = time_runs(lambda: cache.get_data_from_url(self.url), runs)
+        peak_memory = measure_peak_memory(lambda: cache.get_data_from_url(self.url))
+
+        return durations, peak_memory
+
+    def expired_modified(self, runs):
+        cache = self.create_cache()
+        cache.get_data_from_url(self.expired_url)
+        return time_runs(lambda: cache.get_data_from_url(self.expired_url), runs), None
+
+    def expired_not_modified(self, runs):
+        cache = self.create_cache()
+        cache.get_data_from_url(self.not_modified_url)
+        durations = time_runs(
+            lambda: cache.get_data_from_url(self.not_modified_url), runs
+        )
+
+        return durations, None
+
+    def decompress(self, runs):
+        def decompress():
+            decompressor = get_decompressor(self.content[:MAX_MAGIC_NUMBER_LENGTH])
+            read_chunk = functools.partial(
+                io.BytesIO(self.content).read, DOWNLOAD_CHUNK_SIZE
+            )
+            for chunk in iter(read_chunk, b""):
+                decompressor.decompress(chunk)
+            decompressor.flush()
+
+        return time_runs(decompress, runs), None
+
+
+SCENARIOS = ("miss", "hit", "expired_modified", "expired_not_modified", "decompress")
+
+
+def run_benchmarks(entries_list, compressions, scenarios, runs, cache_options):
+    results = []
+    with FeedServer() as server:
+        for entries in entries_list:
+            document = generate_document(entries, timestamp=int(time.time()))
+            for compression in compressions:
+                feed_name = "%d.json.%s" % (entries, compression)
+                feed = Scenarios(
+                    server, feed_name, document, compression, cache_options
+                )
+                try:
+                    for scenario in scenarios:
+                        durations, peak_memory = getattr(feed, scenario)(runs)
+                        latency = summarize(durations)
+                        results.append(
+                            {
+                                "scenario": scenario,
+                                "compression": compression,
+                                "entries": entries,
+                                "compressed_bytes": len(feed.content),
+                                "uncompressed_bytes": feed.uncompressed_size,
+                                "runs": runs,
+                                "latency_ms": latency,
+                                "throughput_mb_s": feed.uncompressed_size
+                                / latency["median"]
+                                / 1000,
+                                "peak_memory_bytes": peak_memory,
+                            }
+                        )
+                        print_result(results[-1])
+                finally:
+                    feed.close()
+
+    return results
+
+
+def print_result(result):
+    peak_memory = result["peak_memory_bytes"]
+    print(
+        "%-20s %-5s %6d entries: median %9.2f ms, p95 %9.2f ms, %8.1f MB/s%s"
+        % (
+            result["scenario"],
+            result["compression"],
+            result["entries"],
+            result["latency_ms"]["median"],
+            result["latency_ms"]["p95"],
+            result["throughput_mb_s"],
+            "" if peak_memory is None else ", peak %.1f MB" % (peak_memory / 1e6),
+        ),
+        file=sys.stderr,
+    )
+
+
+def parse_cache_option(option):
+    name, _, value = option.partition("=")
+    return name, json.loads(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--entries",
+        type=int,
+        nargs="+",
+        default=DEFAULT_ENTRIES,
+        help="The number of entries in each feed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compression", nargs="+", choices=COMPRESSIONS, default=COMPRESSIONS
+    )
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument(
+        "--cache-option",
+        action="append",
+        default=[],
+        type=parse_cache_option,
+        metavar="NAME=JSON",
+        help="Pass an argument to USTDownloadCache, e.g. memory_cache_size=1000000",
+    )
+    parser.add_argument("--output", help="Write results to a file instead of stdout")
+    args = parser.parse_args(argv)
+
+    cache_options = dict(args.cache_option)
+    report = {
+        "schema_version": RESULTS_SCHEMA_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cache_options": cache_options,
+        "results": run_benchmarks(
+            args.entries, args.compression, args.scenario, args.runs, cache_options
+        ),
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import logging
+import os
+import sys
+
+import pytest
+
+# benchmarks and ust_download_cache are imported from the root of the repository,
+# whether or not it is the working directory or the package is installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.feed_server import FeedServer  # noqa: E402
+
+
+@pytest.fixture
+def null_logger():
+    logger = logging.getLogger("cvescan.null")
+    if not logger.hasHandlers():
+        logger.addHandler(logging.NullHandler())
+
+    return logger
+
+
+@pytest.fixture
+def feed_server():
+    with FeedServer() as server:
+        yield server
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import threading
+
+from ust_download_cache import AsyncUSTDownloadCache, DownloadError, USTDownloadCache
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_get_data(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    cache = AsyncUSTDownloadCache(USTDownloadCache(null_logger, tmpdir))
+
+    data = run(cache.get_data(url))
+
+    assert data == {"a": 1, "b": 2, "c": 3}
+
+
+def test_get_metadata(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/2.json.bz2", "./tests/assets/2.json.bz2")
+    cache = AsyncUSTDownloadCache(USTDownloadCache(null_logger, tmpdir))
+
+    metadata = run(cache.get_metadata(url))
+
+    assert metadata["timestamp"] == 1591402600
+
+
+def test_does_not_block_event_loop(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json", delay=0.3)
+    cache = AsyncUSTDownloadCache(USTDownloadCache(null_logger, tmpdir))
+    ticks = []
+
+    async def ticker():
+        for _ in range(5):
+            ticks.append(threading.get_ident())
+            await asyncio.sleep(0.02)
+
+    async def main():
+        return await asyncio.gather(cache.get_data(url), ticker())
+
+    data, _ = run(main())
+
+    assert data["a"] == 1
+    assert len(ticks) == 5
+
+
+def test_coalesces_concurrent_requests(null_logger, tmpdir, feed_server, monkeypatch):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json", delay=0.3)
+    cache = AsyncUSTDownloadCache(USTDownloadCache(null_logger, tmpdir))
+
+    with open("./tests/assets/1.json", "rb") as f:
+        document = f.read()
+    parses = []
+    loads = json.loads
+    monkeypatch.setattr(
+        json, "loads", lambda s, **kw: parses.append(s == document) or loads(s)
+    )
+
+    async def main():
+        return await asyncio.gather(
+            *[cache.get_data(url) for _ in range(50)],
+            *[cache.get_metadata(url) for _ in range(50)]
+        )
+
+    results = run(main())
+
+    assert len(feed_server.requests) == 1
+    assert parses.count(True) == 1
+    assert all(r == {"a": 1, "b": 2, "c": 3} for r in results[:50])
+    assert all(r["ttl"] == 60 for r in results[50:])
+    assert cache._pending == {}
+
+
+def test_different_urls_not_coalesced(null_logger, tmpdir, feed_server):
+    url1 = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    url2 = feed_server.add_feed_file("/4.json.gz", "./tests/assets/4.json.gz")
+    cache = AsyncUSTDownloadCache(USTDownloadCache(null_logger, tmpdir))
+
+    async def main():
+        return await asyncio.gather(cache.get_data(url1), cache.get_data(url2))
+
+    data1, data2 = run(main())
+
+    assert data1["a"] == 1
+    assert data2["a"] == "I"
+
+
+def test_error_propagates_to_all_waiters(null_logger, tmpdir, feed_server):
+    url = feed_server.url("/missing.json")
+    cache = AsyncUSTDownloadCache(USTDownloadCache(null_logger, tmpdir))
+
+    async def main():
+        return await asyncio.gather(
+            cache.get_data(url), cache.get_data(url), return_exceptions=True
+        )
+
+    results = run(main())
+
+    assert all(isinstance(r, DownloadError) for r in results)
+    assert len(feed_server.requests) == 1
+    assert cache._pending == {}
+
+
+def test_cancelling_one_waiter(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json", delay=0.2)
+    cache = AsyncUSTDownloadCache(USTDownloadCache(null_logger, tmpdir))
+
+    async def main():
+        task1 = asyncio.ensure_future(cache.get_data(url))
+        task2 = asyncio.ensure_future(cache.get_data(url))
+        await asyncio.sleep(0.05)
+        task1.cancel()
+
+        return await task2
+
+    assert run(main())["a"] == 1
@@ -0,0 +1,38 @@
+import json
+
+from benchmarks import compare, suite
+from benchmarks.feeds import COMPRESSIONS, encode_feed, generate_document
+from ust_download_cache.decompressors import get_decompressor
+
+
+def test_generate_document_is_reproducible():
+    assert generate_document(10) == generate_document(10)
+    assert generate_document(10) != generate_document(10, seed=1)
+    assert len(generate_document(10)["data"]) == 10
+
+
+def test_encode_feed():
+    document = generate_document(10)
+    for compression in COMPRESSIONS:
+        content = encode_feed(document, compression)
+        decompressor = get_decompressor(content[:4])
+        decoded = decompressor.decompress(content) + decompressor.flush()
+
+        assert json.loads(decoded) == document
+
+
+def test_suite(tmpdir, capsys):
+    output = str(tmpdir.join("results.json"))
+    suite.main(["--entries", "5", "--runs", "2", "--output", output])
+
+    with open(output) as f:
+        report = json.load(f)
+
+    assert report["schema_version"] == suite.RESULTS_SCHEMA_VERSION
+    assert len(report["results"]) == len(COMPRESSIONS) * len(suite.SCENARIOS)
+    for result in report["results"]:
+        assert result["runs"] == 2
+        assert 0 < result["latency_ms"]["min"] <= result["latency_ms"]["max"]
+
+    compare.main([output, output])
+    assert "+0.0%" in capsys.readouterr().out
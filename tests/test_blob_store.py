@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+from ust_download_cache.blob_store import BlobStore, hash_file
+
+CONTENTS = b'{"metadata": {}, "data": {}}'
+CONTENT_HASH = hashlib.sha256(CONTENTS).hexdigest()
+
+
+def write_file(path, contents=CONTENTS):
+    with open(path, "wb") as f:
+        f.write(contents)
+
+
+def test_hash_file(tmpdir):
+    path = str(tmpdir.join("a"))
+    write_file(path)
+
+    assert hash_file(path) == CONTENT_HASH
+
+
+def test_link_missing_blob(tmpdir):
+    store = BlobStore(str(tmpdir.join("blobs")))
+
+    assert not store.link(CONTENT_HASH, str(tmpdir.join("a")))
+    assert not tmpdir.join("a").exists()
+
+
+def test_add_and_link(tmpdir):
+    store = BlobStore(str(tmpdir.join("blobs")), (".snapshot",))
+    a, b = str(tmpdir.join("a")), str(tmpdir.join("b"))
+    write_file(a)
+    write_file(a + ".snapshot", b"snapshot")
+
+    store.add(CONTENT_HASH, a)
+    assert store.link(CONTENT_HASH, b)
+
+    blob_path = store.get_blob_path(CONTENT_HASH)
+    assert os.path.samefile(a, b)
+    assert os.path.samefile(a, blob_path)
+    assert os.path.samefile(a + ".snapshot", b + ".snapshot")
+    assert os.stat(blob_path).st_nlink == 3
+
+
+def test_add_existing_blob(tmpdir):
+    store = BlobStore(str(tmpdir.join("blobs")))
+    a, b = str(tmpdir.join("a")), str(tmpdir.join("b"))
+    write_file(a)
+    write_file(b)
+
+    store.add(CONTENT_HASH, a)
+    store.add(CONTENT_HASH, b)
+
+    assert os.path.samefile(a, store.get_blob_path(CONTENT_HASH))
+
+
+def test_release(tmpdir):
+    store = BlobStore(str(tmpdir.join("blobs")), (".snapshot",))
+    a = str(tmpdir.join("a"))
+    write_file(a)
+    write_file(a + ".snapshot", b"snapshot")
+    store.add(CONTENT_HASH, a)
+
+    assert store.release(CONTENT_HASH) == []
+
+    os.remove(a)
+    blob_path = store.get_blob_path(CONTENT_HASH)
+    assert store.release(CONTENT_HASH) == [blob_path, blob_path + ".snapshot"]
+    assert os.listdir(store.path) == []
+
+
+def test_remove_unreferenced(tmpdir):
+    store = BlobStore(str(tmpdir.join("blobs")), (".snapshot",))
+    a, b = str(tmpdir.join("a")), str(tmpdir.join("b"))
+    other_contents = b'{"data": {"a": 1}}'
+    other_hash = hashlib.sha256(other_contents).hexdigest()
+    write_file(a)
+    write_file(b, other_contents)
+    store.add(CONTENT_HASH, a)
+    store.add(other_hash, b)
+    # A sidecar left behind without its blob
+    write_file(store.get_blob_path("0" * 64) + ".snapshot", b"snapshot")
+
+    os.remove(b)
+    assert sorted(store.remove_unreferenced()) == sorted(
+        [
+            store.get_blob_path(other_hash),
+            store.get_blob_path("0" * 64) + ".snapshot",
+        ]
+    )
+    assert os.listdir(store.path) == [CONTENT_HASH]
+
+
+def test_remove_unreferenced_no_blobs(tmpdir):
+    assert BlobStore(str(tmpdir.join("blobs"))).remove_unreferenced() == []
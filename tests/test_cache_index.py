@@ -0,0 +1,269 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+
+import pytest
+
+from ust_download_cache import CachedFile, FileCacheLoadError
+from ust_download_cache.cache_index import (
+    CacheIndex,
+    JSONCacheIndex,
+    SQLiteCacheIndex,
+    create_cache_index,
+)
+
+
+def cached_file(url, path="/.ust_cache/1", timestamp=1591880020, ttl=60, **kwargs):
+    return CachedFile(url, path, timestamp, ttl, **kwargs)
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request):
+    return request.param
+
+
+def test_set_get(null_logger, tmpdir, backend):
+    index = create_cache_index(backend, null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a", etag='"abc"')
+
+    assert (
+        index["file:///a"].to_dict() == cached_file("file:///a", etag='"abc"').to_dict()
+    )
+    assert index.get("file:///a").path == "/.ust_cache/1"
+    assert index.get("file:///b") is None
+    assert "file:///a" in index
+    assert "file:///b" not in index
+    assert len(index) == 1
+    with pytest.raises(KeyError):
+        index["file:///b"]
+
+
+def test_replace(null_logger, tmpdir, backend):
+    index = create_cache_index(backend, null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a")
+    index["file:///a"] = cached_file("file:///a", path="/.ust_cache/2")
+
+    assert index["file:///a"].path == "/.ust_cache/2"
+    assert len(index) == 1
+
+
+def test_delete(null_logger, tmpdir, backend):
+    index = create_cache_index(backend, null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a")
+    del index["file:///a"]
+
+    assert "file:///a" not in index
+    with pytest.raises(KeyError):
+        del index["file:///a"]
+
+
+def test_pop(null_logger, tmpdir, backend):
+    index = create_cache_index(backend, null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a")
+
+    assert index.pop("file:///a").url == "file:///a"
+    assert index.pop("file:///a") is None
+    assert len(index) == 0
+
+
+def test_items(null_logger, tmpdir, backend):
+    index = create_cache_index(backend, null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a")
+    index["file:///b"] = cached_file("file:///b")
+
+    assert sorted(index.keys()) == ["file:///a", "file:///b"]
+    assert sorted(url for url, _ in index.items()) == ["file:///a", "file:///b"]
+    assert sorted(cf.url for cf in index.values()) == ["file:///a", "file:///b"]
+    assert sorted(index) == ["file:///a", "file:///b"]
+
+
+def test_persisted(null_logger, tmpdir, backend):
+    index = create_cache_index(backend, null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a", revalidated=1591880030)
+    index.save()
+    index.close()
+
+    index = create_cache_index(backend, null_logger, tmpdir)
+    assert index["file:///a"].revalidated == 1591880030
+
+
+def test_reload(null_logger, tmpdir, backend):
+    index1 = create_cache_index(backend, null_logger, tmpdir)
+    index2 = create_cache_index(backend, null_logger, tmpdir)
+    index1["file:///a"] = cached_file("file:///a")
+    index1.save()
+
+    assert index2.reload("file:///a").url == "file:///a"
+    assert "file:///a" in index2
+
+    del index1["file:///a"]
+    index1.save()
+
+    assert index2.reload("file:///a") is None
+    assert "file:///a" not in index2
+
+
+def test_touch(null_logger, tmpdir, backend):
+    index = create_cache_index(backend, null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a")
+    index.touch("file:///a", "/.ust_cache/1", 1591880100)
+    index.touch("file:///a", "/.ust_cache/2", 1591880200)
+    index.touch("file:///b", "/.ust_cache/1", 1591880300)
+    index.save()
+
+    index = create_cache_index(backend, null_logger, tmpdir)
+    assert index["file:///a"].last_access == 1591880100
+    assert "file:///b" not in index
+
+
+def test_touch_does_not_replace_newer_entry(null_logger, tmpdir, backend):
+    index1 = create_cache_index(backend, null_logger, tmpdir)
+    index2 = create_cache_index(backend, null_logger, tmpdir)
+    index1["file:///a"] = cached_file("file:///a")
+    index1.save()
+    index2.reload("file:///a")
+
+    index1["file:///a"] = cached_file("file:///a", path="/.ust_cache/2")
+    index1.save()
+    index2.touch("file:///a", "/.ust_cache/1", 1591880100)
+    index2.save()
+
+    assert index2.reload("file:///a").path == "/.ust_cache/2"
+    assert index2.reload("file:///a").last_access is None
+
+
+def test_json_touch_saved_on_close(null_logger, tmpdir):
+    index = JSONCacheIndex(null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a")
+    index.save()
+    index.touch("file:///a", "/.ust_cache/1", 1591880100)
+    index.close()
+
+    assert JSONCacheIndex(null_logger, tmpdir)["file:///a"].last_access == 1591880100
+
+
+def test_json_save_merges(null_logger, tmpdir):
+    index1 = JSONCacheIndex(null_logger, tmpdir)
+    index2 = JSONCacheIndex(null_logger, tmpdir)
+    index1["file:///a"] = cached_file("file:///a")
+    index1.save()
+    index2["file:///b"] = cached_file("file:///b")
+    index2.save()
+
+    with open(tmpdir.join("file_cache.json")) as f:
+        assert sorted(json.load(f).keys()) == ["file:///a", "file:///b"]
+
+    assert sorted(index2.keys()) == ["file:///a", "file:///b"]
+
+
+def test_json_reload_keeps_unsaved_changes(null_logger, tmpdir):
+    index = JSONCacheIndex(null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a")
+
+    assert index.reload("file:///a").url == "file:///a"
+
+
+def test_json_malformed(null_logger, tmpdir):
+    shutil.copy(
+        "./tests/assets/malformed_json_file_cache.json", tmpdir.join("file_cache.json")
+    )
+
+    with pytest.raises(FileCacheLoadError):
+        JSONCacheIndex(null_logger, tmpdir)
+
+
+def test_sqlite_commits_without_save(null_logger, tmpdir):
+    index1 = SQLiteCacheIndex(null_logger, tmpdir)
+    index2 = SQLiteCacheIndex(null_logger, tmpdir)
+    index1["file:///a"] = cached_file("file:///a")
+
+    assert index2["file:///a"].url == "file:///a"
+
+
+def test_sqlite_read_during_write_in_other_thread(null_logger, tmpdir):
+    index = SQLiteCacheIndex(null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a", path="/.ust_cache/old")
+    connection = index._get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    index["file:///a"] = cached_file("file:///a", path="/.ust_cache/new")
+
+    paths = []
+    thread = threading.Thread(target=lambda: paths.append(index["file:///a"].path))
+    thread.start()
+    thread.join(5)
+    connection.execute("COMMIT")
+
+    assert paths == ["/.ust_cache/old"]
+    assert index["file:///a"].path == "/.ust_cache/new"
+
+
+def test_sqlite_close_closes_connections_of_all_threads(null_logger, tmpdir):
+    index = SQLiteCacheIndex(null_logger, tmpdir)
+    connections = []
+    ready = threading.Event()
+    finish = threading.Event()
+
+    def read():
+        connections.append(index._get_connection())
+        ready.set()
+        finish.wait(5)
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    ready.wait(5)
+    index.close()
+    finish.set()
+    thread.join(5)
+
+    for connection in connections + [index._get_connection()]:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+
+
+def test_sqlite_migrates_json_index(null_logger, tmpdir):
+    json_index = JSONCacheIndex(null_logger, tmpdir)
+    json_index["file:///a"] = cached_file("file:///a", etag='"abc"')
+    json_index["file:///b"] = cached_file("file:///b")
+    json_index.save()
+
+    index = SQLiteCacheIndex(null_logger, tmpdir)
+
+    assert sorted(index.keys()) == ["file:///a", "file:///b"]
+    assert index["file:///a"].etag == '"abc"'
+    assert not os.path.exists(tmpdir.join("file_cache.json"))
+    assert os.path.exists(tmpdir.join("file_cache.json.migrated"))
+
+
+def test_sqlite_migration_does_not_overwrite(null_logger, tmpdir):
+    index = SQLiteCacheIndex(null_logger, tmpdir)
+    index["file:///a"] = cached_file("file:///a", path="/.ust_cache/new")
+    index.close()
+
+    json_index = JSONCacheIndex(null_logger, tmpdir)
+    json_index["file:///a"] = cached_file("file:///a", path="/.ust_cache/old")
+    json_index.save()
+
+    index = SQLiteCacheIndex(null_logger, tmpdir)
+    assert index["file:///a"].path == "/.ust_cache/new"
+
+
+def test_sqlite_corrupt(null_logger, tmpdir):
+    tmpdir.join("file_cache.sqlite3").write("This is not a database" * 100)
+
+    with pytest.raises(FileCacheLoadError):
+        SQLiteCacheIndex(null_logger, tmpdir)
+
+
+def test_create_cache_index_class(null_logger, tmpdir):
+    assert isinstance(
+        create_cache_index(JSONCacheIndex, null_logger, tmpdir), CacheIndex
+    )
+
+
+def test_create_cache_index_unknown(null_logger, tmpdir):
+    with pytest.raises(ValueError) as ve:
+        create_cache_index("yaml", null_logger, tmpdir)
+
+    assert "json, sqlite" in str(ve.value)
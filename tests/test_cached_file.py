@@ -1,5 +1,7 @@
 import time
 
+import pytest
+
 from ust_download_cache import CachedFile
 
 
@@ -35,3 +37,115 @@ def test_from_dict():
     assert cf.path == expected_path
     assert cf.timestamp == expected_timestamp
     assert cf.ttl == expected_ttl
+
+
+def test_is_expired_revalidated(monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: 1591880120.0)
+
+    cf = CachedFile(
+        "file:///test", "/.ust_cache/1", 1591880020, 60, revalidated=1591880100
+    )
+    assert not cf.is_expired
+
+
+def test_is_expired_revalidated_expired(monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: 1591880220.0)
+
+    cf = CachedFile(
+        "file:///test", "/.ust_cache/1", 1591880020, 60, revalidated=1591880100
+    )
+    assert cf.is_expired
+
+
+def test_validator_headers():
+    cf = CachedFile(
+        "file:///test",
+        "/.ust_cache/1",
+        1591880020,
+        60,
+        etag='"abc"',
+        last_modified="Thu, 11 Jun 2020 13:00:20 GMT",
+    )
+
+    assert cf.can_revalidate
+    assert cf.get_validator_headers() == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Thu, 11 Jun 2020 13:00:20 GMT",
+    }
+
+
+def test_validator_headers_none():
+    cf = CachedFile("file:///test", "/.ust_cache/1", 1591880020, 60)
+
+    assert not cf.can_revalidate
+    assert cf.get_validator_headers() == {}
+
+
+def test_to_dict_omits_unset_fields():
+    cf = CachedFile("file:///test", "/.ust_cache/1", 1591880020, 60)
+
+    assert cf.to_dict() == {
+        "url": "file:///test",
+        "path": "/.ust_cache/1",
+        "timestamp": 1591880020,
+        "ttl": 60,
+    }
+
+
+def test_to_dict_from_dict_round_trip():
+    cf = CachedFile(
+        "file:///test",
+        "/.ust_cache/1",
+        1591880020,
+        60,
+        etag='"abc"',
+        last_modified="Thu, 11 Jun 2020 13:00:20 GMT",
+        revalidated=1591880100,
+        size=1024,
+        last_access=1591880200,
+    )
+
+    cf2 = CachedFile.from_dict(cf.to_dict())
+    assert cf2.to_dict() == cf.to_dict()
+
+
+def test_expiration_time():
+    cf = CachedFile("file:///test", "/.ust_cache/1", 1591880020, 60)
+    assert cf.expiration_time == 1591880080
+
+
+def test_expiration_time_revalidated():
+    cf = CachedFile(
+        "file:///test", "/.ust_cache/1", 1591880020, 60, revalidated=1591880100
+    )
+    assert cf.expiration_time == 1591880160
+
+
+def test_expiration_time_expires():
+    cf = CachedFile(
+        "file:///test",
+        "/.ust_cache/1",
+        1591880020,
+        60,
+        revalidated=1591880100,
+        expires=1591880500,
+    )
+    assert cf.expiration_time == 1591880500
+    assert CachedFile.from_dict(cf.to_dict()).expires == 1591880500
+
+
+def test_expires_within(monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: 1591880050.0)
+
+    cf = CachedFile("file:///test", "/.ust_cache/1", 1591880020, 60)
+    assert not cf.expires_within(30)
+    assert cf.expires_within(31)
+    assert not cf.expires_within(-10)
+
+
+def test_slots():
+    cf = CachedFile("file:///test", "/.ust_cache/1", 1591880020, 60)
+
+    assert not hasattr(cf, "__dict__")
+    with pytest.raises(AttributeError):
+        cf.unknown = 1
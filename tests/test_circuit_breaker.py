@@ -0,0 +1,132 @@
+import time
+
+import pytest
+
+from ust_download_cache.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    NegativeCache,
+)
+
+HOST = "mirror.example.com"
+
+
+class Clock:
+    def __init__(self, now=1591401600.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+def test_circuit_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+
+    assert not breaker.record_failure(HOST)
+    assert not breaker.record_failure(HOST)
+    assert breaker.allow_request(HOST)
+    assert breaker.record_failure(HOST)
+
+    assert breaker.get_state(HOST) == OPEN
+    assert not breaker.allow_request(HOST)
+    assert breaker.get_state("other.example.com") == CLOSED
+    assert breaker.allow_request("other.example.com")
+
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+
+    breaker.record_failure(HOST)
+    breaker.record_success(HOST)
+    breaker.record_failure(HOST)
+
+    assert breaker.get_state(HOST) == CLOSED
+
+
+def test_half_open_allows_one_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure(HOST)
+
+    clock.now += 60
+    assert breaker.get_state(HOST) == HALF_OPEN
+    assert breaker.allow_request(HOST)
+    assert not breaker.allow_request(HOST)
+
+    breaker.record_success(HOST)
+    assert breaker.get_state(HOST) == CLOSED
+    assert breaker.allow_request(HOST)
+
+
+def test_failed_trial_reopens_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure(HOST)
+
+    clock.now += 60
+    assert breaker.allow_request(HOST)
+    assert not breaker.record_failure(HOST)
+
+    assert breaker.get_state(HOST) == OPEN
+    clock.now += 59
+    assert not breaker.allow_request(HOST)
+    clock.now += 1
+    assert breaker.allow_request(HOST)
+
+
+def test_abandoned_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure(HOST)
+
+    clock.now += 60
+    assert breaker.allow_request(HOST)
+    clock.now += 60
+    assert breaker.allow_request(HOST)
+
+
+def test_invalid_failure_threshold():
+    with pytest.raises(ValueError):
+        CircuitBreaker(failure_threshold=0)
+
+
+def test_negative_cache(clock):
+    negative_cache = NegativeCache(10)
+    error = Exception("Connection refused")
+
+    assert negative_cache.get("url") is None
+    negative_cache.add("url", error)
+    assert negative_cache.get("url") is error
+    assert negative_cache.get("other_url") is None
+
+    clock.now += 10
+    assert negative_cache.get("url") is None
+
+
+def test_negative_cache_backoff(clock):
+    negative_cache = NegativeCache(10, max_ttl=30)
+
+    expected_ttls = (10, 20, 30, 30)
+    for ttl in expected_ttls:
+        negative_cache.add("url", Exception())
+        clock.now += ttl - 1
+        assert negative_cache.get("url") is not None
+        clock.now += 1
+        assert negative_cache.get("url") is None
+
+
+def test_negative_cache_remove(clock):
+    negative_cache = NegativeCache(10)
+    negative_cache.add("url", Exception())
+    negative_cache.remove("url")
+    assert negative_cache.get("url") is None
+
+    negative_cache.add("url", Exception())
+    clock.now += 10
+    assert negative_cache.get("url") is None
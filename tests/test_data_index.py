@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from ust_download_cache.data_index import build_data_index, get_data_index_path
+from ust_download_cache.json_scan import decode_value
+
+DOCUMENT = b"""
+{
+    "metadata": {"timestamp": 1591401600, "ttl": 60},
+    "data": {
+        "CVE-2020-0001": {"packages": ["a", "b"], "priority": "high"},
+        "CVE-2020-0002": "\\"}",
+        "CVE-2020-0003": 3
+    }
+}
+"""
+
+
+def test_get_data_index_path():
+    assert get_data_index_path("/.ust_cache/1") == "/.ust_cache/1.index"
+
+
+def test_build_data_index():
+    offsets = build_data_index(DOCUMENT)
+    data = json.loads(DOCUMENT)["data"]
+
+    assert list(offsets) == list(data)
+    for key, (start, end) in offsets.items():
+        assert decode_value(DOCUMENT, start, end) == data[key]
+
+
+def test_build_data_index_data_first():
+    document = b'{"data": {"a": 1}, "metadata": {}}'
+    start, end = build_data_index(document)["a"]
+
+    assert document[start:end] == b"1"
+
+
+def test_build_data_index_empty_data():
+    assert build_data_index(b'{"metadata": {}, "data": {}}') == {}
+
+
+def test_build_data_index_missing_data():
+    with pytest.raises(KeyError):
+        build_data_index(b'{"metadata": {}}')
+
+
+@pytest.mark.parametrize(
+    "document",
+    [b'{"data": [1, 2]}', b'{"data": {"a": 1', b'{"metadata": {}, "data": }'],
+)
+def test_build_data_index_malformed(document):
+    with pytest.raises(ValueError):
+        build_data_index(document)
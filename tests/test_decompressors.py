@@ -0,0 +1,134 @@
+import bz2
+import gzip
+import lzma
+
+import pytest
+
+from ust_download_cache import BZ2ExtractionError, GZExtractionError, XZExtractionError
+from ust_download_cache.decompressors import (
+    BZ2StreamDecompressor,
+    GZStreamDecompressor,
+    PassthroughDecompressor,
+    XZStreamDecompressor,
+    get_decompressor,
+)
+
+PLAINTEXT = b'{"metadata": {"timestamp": 1, "ttl": 2}, "data": {}}' * 100
+
+
+def decompress_in_chunks(decompressor, data, chunk_size):
+    output = b""
+    while data:
+        output += decompressor.decompress(data[:chunk_size])
+        data = data[chunk_size:]
+
+    return output + decompressor.flush()
+
+
+def test_get_decompressor_bz2():
+    assert isinstance(get_decompressor(bz2.compress(b"")), BZ2StreamDecompressor)
+
+
+def test_get_decompressor_gz():
+    assert isinstance(get_decompressor(gzip.compress(b"")), GZStreamDecompressor)
+
+
+def test_get_decompressor_xz():
+    assert isinstance(get_decompressor(lzma.compress(b"")), XZStreamDecompressor)
+
+
+def test_get_decompressor_plain():
+    assert isinstance(get_decompressor(b"{}"), PassthroughDecompressor)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_bz2_chunked(chunk_size):
+    compressed = bz2.compress(PLAINTEXT)
+
+    output = decompress_in_chunks(BZ2StreamDecompressor(), compressed, chunk_size)
+    assert output == PLAINTEXT
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_gz_chunked(chunk_size):
+    compressed = gzip.compress(PLAINTEXT)
+
+    output = decompress_in_chunks(GZStreamDecompressor(), compressed, chunk_size)
+    assert output == PLAINTEXT
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_xz_chunked(chunk_size):
+    compressed = lzma.compress(PLAINTEXT)
+
+    output = decompress_in_chunks(XZStreamDecompressor(), compressed, chunk_size)
+    assert output == PLAINTEXT
+
+
+def test_bz2_multi_stream():
+    compressed = bz2.compress(PLAINTEXT[:1000]) + bz2.compress(PLAINTEXT[1000:])
+
+    output = decompress_in_chunks(BZ2StreamDecompressor(), compressed, 100)
+    assert output == PLAINTEXT
+
+
+def test_gz_multi_member():
+    compressed = gzip.compress(PLAINTEXT[:1000]) + gzip.compress(PLAINTEXT[1000:])
+
+    output = decompress_in_chunks(GZStreamDecompressor(), compressed, 100)
+    assert output == PLAINTEXT
+
+
+def test_gz_trailing_zero_padding():
+    compressed = gzip.compress(PLAINTEXT) + b"\x00" * 512
+
+    output = decompress_in_chunks(GZStreamDecompressor(), compressed, 100)
+    assert output == PLAINTEXT
+
+
+def test_xz_multi_stream_padding():
+    compressed = (
+        lzma.compress(PLAINTEXT[:1000])
+        + b"\x00" * 4
+        + lzma.compress(PLAINTEXT[1000:])
+        + b"\x00" * 8
+    )
+
+    output = decompress_in_chunks(XZStreamDecompressor(), compressed, 100)
+    assert output == PLAINTEXT
+
+
+def test_bz2_truncated():
+    compressed = bz2.compress(PLAINTEXT)
+
+    with pytest.raises(BZ2ExtractionError) as bee:
+        decompress_in_chunks(BZ2StreamDecompressor(), compressed[:-10], 100)
+
+    assert "end-of-stream marker" in str(bee.value)
+
+
+def test_gz_truncated():
+    compressed = gzip.compress(PLAINTEXT)
+
+    with pytest.raises(GZExtractionError):
+        decompress_in_chunks(GZStreamDecompressor(), compressed[:-10], 100)
+
+
+def test_xz_truncated():
+    compressed = lzma.compress(PLAINTEXT)
+
+    with pytest.raises(XZExtractionError):
+        decompress_in_chunks(XZStreamDecompressor(), compressed[:-10], 100)
+
+
+def test_bz2_corrupt():
+    compressed = bytearray(bz2.compress(PLAINTEXT))
+    compressed[20] ^= 0xFF
+
+    with pytest.raises(BZ2ExtractionError):
+        decompress_in_chunks(BZ2StreamDecompressor(), bytes(compressed), 100)
+
+
+def test_passthrough():
+    output = decompress_in_chunks(PassthroughDecompressor(), PLAINTEXT, 100)
+    assert output == PLAINTEXT
@@ -0,0 +1,102 @@
+import os
+
+from ust_download_cache.document_cache import DocumentCache, get_file_identity
+
+
+def identity(size, mtime=0):
+    return (0, 1, size, mtime)
+
+
+def test_disabled():
+    dc = DocumentCache()
+    dc.put("/a", identity(10), {"a": 1})
+
+    assert not dc.enabled
+    assert dc.get("/a", identity(10)) is None
+
+
+def test_get():
+    dc = DocumentCache(100)
+    dc.put("/a", identity(10), {"a": 1})
+
+    assert dc.get("/a", identity(10)) == {"a": 1}
+    assert dc.size == 10
+
+
+def test_get_missing():
+    dc = DocumentCache(100)
+
+    assert dc.get("/a", identity(10)) is None
+
+
+def test_get_identity_changed():
+    dc = DocumentCache(100)
+    dc.put("/a", identity(10), {"a": 1})
+
+    assert dc.get("/a", identity(10, mtime=1)) is None
+    assert "/a" not in dc
+    assert dc.size == 0
+
+
+def test_put_too_large():
+    dc = DocumentCache(100)
+    dc.put("/a", identity(101), {"a": 1})
+
+    assert "/a" not in dc
+    assert dc.size == 0
+
+
+def test_put_replaces():
+    dc = DocumentCache(100)
+    dc.put("/a", identity(10), {"a": 1})
+    dc.put("/a", identity(20, mtime=1), {"a": 2})
+
+    assert dc.get("/a", identity(20, mtime=1)) == {"a": 2}
+    assert len(dc) == 1
+    assert dc.size == 20
+
+
+def test_evicts_least_recently_used():
+    dc = DocumentCache(100)
+    dc.put("/a", identity(40), {"a": 1})
+    dc.put("/b", identity(40), {"b": 1})
+    dc.get("/a", identity(40))
+    dc.put("/c", identity(40), {"c": 1})
+
+    assert "/a" in dc
+    assert "/b" not in dc
+    assert "/c" in dc
+    assert dc.size == 80
+
+
+def test_invalidate():
+    dc = DocumentCache(100)
+    dc.put("/a", identity(10), {"a": 1})
+    dc.invalidate("/a")
+    dc.invalidate("/b")
+
+    assert len(dc) == 0
+    assert dc.size == 0
+
+
+def test_clear():
+    dc = DocumentCache(100)
+    dc.put("/a", identity(10), {"a": 1})
+    dc.put("/b", identity(10), {"b": 1})
+    dc.clear()
+
+    assert len(dc) == 0
+    assert dc.size == 0
+
+
+def test_get_file_identity(tmpdir):
+    path = tmpdir.join("f")
+    path.write("abc")
+    identity1 = get_file_identity(path)
+
+    os.remove(path)
+    path.write("abcd")
+    identity2 = get_file_identity(path)
+
+    assert identity1[2] == 3
+    assert identity1 != identity2
@@ -0,0 +1,96 @@
+import fcntl
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from ust_download_cache.file_lock import FileLock
+
+
+def try_lock(path):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def try_lock_in_child(path, queue):
+    queue.put(try_lock(path))
+
+
+def test_creates_lock_file(tmpdir):
+    path = str(tmpdir.join("a.lock"))
+
+    with FileLock(path) as lock:
+        assert lock.locked
+        assert os.path.exists(path)
+
+    assert not lock.locked
+
+
+def test_acquire_non_blocking(tmpdir):
+    path = str(tmpdir.join("a.lock"))
+    lock = FileLock(path)
+
+    with FileLock(path):
+        assert lock.acquire(blocking=False) is False
+        assert not lock.locked
+
+    assert lock.acquire(blocking=False) is True
+    assert lock.locked
+    lock.release()
+
+
+def test_excludes_other_processes(tmpdir):
+    path = str(tmpdir.join("a.lock"))
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+
+    with FileLock(path):
+        child = context.Process(target=try_lock_in_child, args=(path, queue))
+        child.start()
+        child.join()
+        assert queue.get() is False
+
+    child = context.Process(target=try_lock_in_child, args=(path, queue))
+    child.start()
+    child.join()
+    assert queue.get() is True
+
+
+def test_excludes_other_instances(tmpdir):
+    path = str(tmpdir.join("a.lock"))
+    events = []
+
+    def hold_lock():
+        with FileLock(path):
+            events.append("acquired")
+            time.sleep(0.2)
+            events.append("released")
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    while not events:
+        time.sleep(0.01)
+
+    with FileLock(path):
+        events.append("acquired")
+
+    thread.join()
+    assert events == ["acquired", "released", "acquired"]
+
+
+def test_released_on_error(tmpdir):
+    path = str(tmpdir.join("a.lock"))
+
+    with pytest.raises(ValueError):
+        with FileLock(path):
+            raise ValueError()
+
+    assert try_lock(path)
@@ -0,0 +1,109 @@
+import pytest
+
+from ust_download_cache import CachedFile
+from ust_download_cache.freshness import FETCH_BASIS, FreshnessPolicy, get_max_age
+
+TIMESTAMP = 1591401600
+
+
+def cached_file(timestamp=TIMESTAMP, ttl=3600, revalidated=None):
+    return CachedFile("url", "path", timestamp, ttl, revalidated=revalidated)
+
+
+@pytest.mark.parametrize(
+    "headers,max_age",
+    [
+        (None, None),
+        ({}, None),
+        ({"Cache-Control": "no-cache"}, None),
+        ({"Cache-Control": "max-age=60"}, 60),
+        ({"Cache-Control": "public, max-age=60, must-revalidate"}, 60),
+        ({"Cache-Control": 'max-age="60"'}, 60),
+        ({"Cache-Control": "s-maxage=30"}, None),
+        ({"Cache-Control": "max-age=60", "Age": "20"}, 40),
+        ({"Cache-Control": "max-age=60", "Age": "90"}, 0),
+        ({"Cache-Control": "max-age=60", "Age": "bogus"}, 60),
+    ],
+)
+def test_get_max_age(headers, max_age):
+    assert get_max_age(headers) == max_age
+
+
+def test_default_policy_uses_timestamp():
+    policy = FreshnessPolicy()
+
+    assert policy.get_expiration_time(cached_file(), TIMESTAMP + 10) == TIMESTAMP + 3600
+    assert (
+        policy.get_expiration_time(
+            cached_file(revalidated=TIMESTAMP + 100), TIMESTAMP + 100
+        )
+        == TIMESTAMP + 3700
+    )
+
+
+def test_default_policy_ignores_max_age():
+    policy = FreshnessPolicy()
+    headers = {"Cache-Control": "max-age=60"}
+
+    assert policy.get_expiration_time(cached_file(), TIMESTAMP, headers) == (
+        TIMESTAMP + 3600
+    )
+
+
+def test_fetch_basis():
+    policy = FreshnessPolicy(FETCH_BASIS)
+    fetched = TIMESTAMP + 86400
+
+    assert policy.get_expiration_time(cached_file(), fetched) == fetched + 3600
+
+
+def test_max_age():
+    policy = FreshnessPolicy(use_max_age=True)
+    fetched = TIMESTAMP + 86400
+    headers = {"Cache-Control": "max-age=600"}
+
+    assert policy.get_expiration_time(cached_file(), fetched, headers) == fetched + 600
+    assert policy.get_expiration_time(cached_file(), fetched) == TIMESTAMP + 3600
+
+
+@pytest.mark.parametrize("ttl,expected_ttl", [(10, 60), (600, 600), (7200, 3600)])
+def test_ttl_clamped(ttl, expected_ttl):
+    policy = FreshnessPolicy(FETCH_BASIS, min_ttl=60, max_ttl=3600)
+
+    assert policy.get_expiration_time(cached_file(ttl=ttl), TIMESTAMP) == (
+        TIMESTAMP + expected_ttl
+    )
+
+
+def test_max_age_clamped():
+    policy = FreshnessPolicy(use_max_age=True, max_ttl=300)
+    headers = {"Cache-Control": "max-age=600"}
+
+    assert policy.get_expiration_time(cached_file(), TIMESTAMP, headers) == (
+        TIMESTAMP + 300
+    )
+
+
+def test_min_refresh_interval():
+    policy = FreshnessPolicy(min_refresh_interval=300)
+    fetched = TIMESTAMP + 86400
+
+    assert policy.get_expiration_time(cached_file(), fetched) == fetched + 300
+    assert policy.get_expiration_time(cached_file(), TIMESTAMP) == TIMESTAMP + 3600
+
+
+def test_is_expired_on_arrival():
+    policy = FreshnessPolicy()
+
+    assert policy.is_expired_on_arrival(TIMESTAMP - 1, TIMESTAMP)
+    assert not policy.is_expired_on_arrival(TIMESTAMP, TIMESTAMP)
+
+
+def test_unknown_basis():
+    with pytest.raises(ValueError):
+        FreshnessPolicy("modified")
+
+
+def test_min_ttl_greater_than_max_ttl():
+    with pytest.raises(ValueError):
+        FreshnessPolicy(min_ttl=600, max_ttl=60)
@@ -0,0 +1,134 @@
+import json
+import mmap
+
+import pytest
+
+from ust_download_cache.json_scan import (
+    decode_value,
+    find_member,
+    iter_object_members,
+    skip_container,
+    skip_value,
+    skip_whitespace,
+)
+
+DOCUMENT = b"""
+{
+    "metadata": {"timestamp": 1591401600, "ttl": 60, "version": "1.0"},
+    "data": {
+        "a": [1, -2.5e3, true, false, null],
+        "b \\"quoted\\" }]": {"nested": {"x": "}]{["}},
+        "c": "\\\\"
+    },
+    "empty": {},
+    "list": []
+}
+"""
+
+
+def members(buf, **kwargs):
+    return {
+        key: decode_value(buf, start, end)
+        for key, start, end in iter_object_members(buf, **kwargs)
+    }
+
+
+def test_iter_object_members():
+    assert members(DOCUMENT) == json.loads(DOCUMENT)
+
+
+def test_iter_object_members_nested():
+    for key, start, end in iter_object_members(DOCUMENT):
+        if key == "data":
+            assert members(DOCUMENT, pos=start) == json.loads(DOCUMENT)["data"]
+
+
+def test_iter_object_members_empty():
+    assert members(b" { } ") == {}
+
+
+def test_iter_object_members_mmap(tmpdir):
+    path = tmpdir.join("doc.json")
+    path.write_binary(DOCUMENT)
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            assert members(buf) == json.loads(DOCUMENT)
+
+
+def test_iter_object_members_is_lazy():
+    document = b'{"metadata": {"ttl": 60}, "data": {"a": '
+
+    key, start, end = next(iter_object_members(document))
+    assert key == "metadata"
+    assert decode_value(document, start, end) == {"ttl": 60}
+
+
+@pytest.mark.parametrize(
+    "document",
+    [
+        b"[1, 2]",
+        b'{"a" 1}',
+        b'{"a": 1 "b": 2}',
+        b'{"a": {"b": 1}',
+        b'{"a": [1, 2}}',
+        b'{"a": nope}',
+        b'{"a": 1',
+        b"",
+    ],
+)
+def test_iter_object_members_malformed(document):
+    with pytest.raises(ValueError):
+        members(document)
+
+
+def test_find_member():
+    start = find_member(DOCUMENT, "data")
+    assert members(DOCUMENT, pos=start) == json.loads(DOCUMENT)["data"]
+
+
+def test_find_member_does_not_skip_value():
+    document = b'{"metadata": {"ttl": 60}, "data": {"a": '
+
+    start = find_member(document, "data")
+    assert document[start:] == b'{"a": '
+
+
+def test_find_member_missing():
+    with pytest.raises(KeyError):
+        find_member(DOCUMENT, "missing")
+
+    with pytest.raises(KeyError):
+        find_member(b"{}", "data")
+
+
+def test_find_member_malformed():
+    with pytest.raises(ValueError):
+        find_member(b'{"a": 1 "data": 2}', "data")
+
+
+def test_skip_value_scalars():
+    assert skip_value(b"123,", 0) == 3
+    assert skip_value(b"-0.5e-3]", 0) == 7
+    assert skip_value(b"null}", 0) == 4
+    assert skip_value(b'"a\\"b",', 0) == 6
+
+
+def test_skip_container_limit():
+    document = b'{"a": [1, 2, 3, 4, 5]}'
+
+    assert skip_container(document, 0, limit=len(document)) == len(document)
+    with pytest.raises(ValueError):
+        skip_container(document, 0, limit=10)
+
+
+def test_iter_object_members_limit():
+    document = b'{"data": {"a": "%s"}, "metadata": {}}' % (b"x" * 100)
+
+    with pytest.raises(ValueError):
+        members(document, limit=50)
+
+
+def test_skip_whitespace():
+    assert skip_whitespace(b" \t\r\n{", 0) == 4
+    assert skip_whitespace(b"{", 0) == 0
@@ -0,0 +1,126 @@
+import pytest
+
+from ust_download_cache.mirrors import (
+    MirrorSelector,
+    get_attempt_suffix,
+    get_percentile,
+)
+
+MIRROR_A = "http://a.example.com/feed.json"
+MIRROR_B = "http://b.example.com/feed.json"
+MIRROR_C = "http://c.example.com/feed.json"
+
+
+@pytest.mark.parametrize(
+    "values,percentile,expected",
+    [
+        ([], 50, None),
+        ([3], 95, 3),
+        ([4, 1, 3, 2], 50, 2),
+        ([4, 1, 3, 2], 95, 4),
+        (list(range(1, 101)), 95, 95),
+    ],
+)
+def test_get_percentile(values, percentile, expected):
+    assert get_percentile(values, percentile) == expected
+
+
+def test_get_attempt_suffix():
+    assert get_attempt_suffix(0) == ".a"
+    assert get_attempt_suffix(12) == ".bc"
+
+
+def test_rank_untimed_mirrors_in_order():
+    selector = MirrorSelector()
+
+    assert selector.rank([MIRROR_A, MIRROR_B, MIRROR_C]) == [
+        MIRROR_A,
+        MIRROR_B,
+        MIRROR_C,
+    ]
+
+
+def test_rank_by_median_duration():
+    selector = MirrorSelector()
+    selector.record_success(MIRROR_A, 0.1, 2.0, 1000)
+    selector.record_success(MIRROR_B, 0.1, 1.0, 1000)
+
+    assert selector.rank([MIRROR_A, MIRROR_B, MIRROR_C]) == [
+        MIRROR_B,
+        MIRROR_A,
+        MIRROR_C,
+    ]
+
+
+def test_rank_failed_mirrors_last():
+    selector = MirrorSelector()
+    selector.record_success(MIRROR_A, 0.1, 1.0, 1000)
+    selector.record_failure(MIRROR_A)
+
+    assert selector.rank([MIRROR_A, MIRROR_B]) == [MIRROR_B, MIRROR_A]
+
+    selector.record_success(MIRROR_A, 0.1, 1.0, 1000)
+    assert selector.rank([MIRROR_A, MIRROR_B]) == [MIRROR_A, MIRROR_B]
+
+
+def test_rank_not_modified():
+    selector = MirrorSelector()
+    selector.record_success(MIRROR_B, 0.1)
+
+    assert selector.rank([MIRROR_A, MIRROR_B]) == [MIRROR_A, MIRROR_B]
+
+
+def test_cancellation_slows_mirror():
+    selector = MirrorSelector()
+    selector.record_success(MIRROR_A, 0.1, 1.0, 1000)
+    selector.record_success(MIRROR_B, 0.1, 2.0, 1000)
+    selector.record_cancellation(MIRROR_A, 5.0)
+    selector.record_cancellation(MIRROR_A, 5.0)
+
+    assert selector.rank([MIRROR_A, MIRROR_B]) == [MIRROR_B, MIRROR_A]
+
+
+def test_hedge_delay():
+    selector = MirrorSelector(min_hedge_samples=3)
+    selector.record_success(MIRROR_A, 0.1, 1.0, 1000)
+    selector.record_success(MIRROR_A, 0.1, 3.0, 1000)
+    assert selector.get_hedge_delay(MIRROR_A) is None
+    assert selector.get_hedge_delay(MIRROR_B) is None
+
+    selector.record_success(MIRROR_A, 0.1, 2.0, 1000)
+    assert selector.get_hedge_delay(MIRROR_A) == 3.0
+
+
+def test_sample_window():
+    selector = MirrorSelector(window=2, min_hedge_samples=1)
+    for duration in (10.0, 1.0, 2.0):
+        selector.record_success(MIRROR_A, 0.1, duration, 1000)
+
+    assert selector.get_hedge_delay(MIRROR_A) == 2.0
+
+
+def test_snapshot():
+    selector = MirrorSelector()
+    selector.record_success(MIRROR_A, 0.25, 2.0, 1000)
+    selector.record_failure(MIRROR_B)
+
+    assert selector.snapshot() == {
+        MIRROR_A: {
+            "downloads": 1,
+            "failures": 0,
+            "latency_p50": 0.25,
+            "latency_p95": 0.25,
+            "duration_p50": 2.0,
+            "duration_p95": 2.0,
+            "throughput_p50": 500.0,
+        },
+        MIRROR_B: {
+            "downloads": 0,
+            "failures": 1,
+            "latency_p50": None,
+            "latency_p95": None,
+            "duration_p50": None,
+            "duration_p95": None,
+            "throughput_p50": None,
+        },
+    }
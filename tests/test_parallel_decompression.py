@@ -0,0 +1,118 @@
+import bz2
+import gzip
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from ust_download_cache import BZ2ExtractionError
+from ust_download_cache.decompressors import get_decompressor
+from ust_download_cache.parallel_decompression import (
+    ParallelStreamDecompressor,
+    decompress_segment,
+)
+
+PARTS = [(b'{"part": %d, "data": "%s"}' % (i, b"x" * i * 100)) for i in range(8)]
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(2) as executor:
+        yield executor
+
+
+def create_decompressor(archive, executor, **kwargs):
+    kwargs.setdefault("min_segment_size", 1)
+    return ParallelStreamDecompressor(
+        get_decompressor(archive[:2]), executor, max_pending=2, **kwargs
+    )
+
+
+def decompress(decompressor, archive, chunk_size=7):
+    output = [
+        decompressor.decompress(archive[i:][:chunk_size])
+        for i in range(0, len(archive), chunk_size)
+    ]
+    output.append(decompressor.flush())
+    return b"".join(output)
+
+
+@pytest.mark.parametrize("compress", [bz2.compress, gzip.compress])
+def test_multi_stream(executor, compress):
+    archive = b"".join(compress(part) for part in PARTS)
+    decompressor = create_decompressor(archive, executor)
+
+    assert decompress(decompressor, archive) == b"".join(PARTS)
+    assert decompressor.segments == len(PARTS)
+
+
+def test_multi_stream_process_pool():
+    archive = b"".join(bz2.compress(part) for part in PARTS)
+    with ProcessPoolExecutor(2) as executor:
+        decompressor = create_decompressor(archive, executor)
+        assert decompress(decompressor, archive, chunk_size=100) == b"".join(PARTS)
+
+    assert decompressor.segments == len(PARTS)
+
+
+def test_streams_grouped_into_segments(executor):
+    archive = b"".join(bz2.compress(part) for part in PARTS)
+    decompressor = create_decompressor(
+        archive, executor, min_segment_size=len(archive) // 2
+    )
+
+    assert decompress(decompressor, archive, chunk_size=len(archive)) == b"".join(PARTS)
+    assert decompressor.segments == 2
+
+
+@pytest.mark.parametrize("compress", [bz2.compress, gzip.compress])
+def test_single_stream_decompressed_sequentially(executor, compress):
+    data = b"".join(PARTS)
+    archive = compress(data)
+    decompressor = create_decompressor(archive, executor)
+
+    assert decompress(decompressor, archive) == data
+    assert decompressor.segments == 0
+
+
+def test_probe_limit(executor):
+    archive = b"".join(bz2.compress(part) for part in PARTS)
+    decompressor = create_decompressor(
+        archive, executor, min_segment_size=len(archive), probe_limit=100
+    )
+
+    assert decompress(decompressor, archive) == b"".join(PARTS)
+    assert decompressor.segments == 0
+
+
+def test_false_stream_boundary(executor):
+    # Stored (level 0) deflate blocks contain the data verbatim, including
+    # something that looks like the header of a gzip member
+    data = b"abc\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03def" * 10
+    compressor = zlib.compressobj(0, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    first_member = compressor.compress(data) + compressor.flush()
+    archive = first_member + gzip.compress(data)
+    segments = []
+    submit = executor.submit
+    executor.submit = lambda fn, segment: segments.append(segment) or submit(
+        fn, segment
+    )
+    decompressor = create_decompressor(archive, executor)
+
+    assert decompress(decompressor, archive) == data * 2
+    assert len(segments[0]) < len(first_member)
+
+
+def test_corrupt_stream(executor):
+    streams = [bz2.compress(part) for part in PARTS]
+    streams[3] = streams[3][:-10] + b"\x00" * 10
+    archive = b"".join(streams)
+    decompressor = create_decompressor(archive, executor)
+
+    with pytest.raises(BZ2ExtractionError):
+        decompress(decompressor, archive)
+
+
+def test_decompress_segment():
+    archive = b"".join(gzip.compress(part) for part in PARTS[:2])
+    assert decompress_segment(archive) == PARTS[0] + PARTS[1]
@@ -0,0 +1,136 @@
+import os
+
+import pytest
+
+from ust_download_cache.partial_download import (
+    PartialDownload,
+    get_resume_validator,
+    parse_content_range,
+)
+
+
+@pytest.mark.parametrize(
+    "headers,validator",
+    [
+        ({"Accept-Ranges": "bytes", "ETag": '"1"'}, '"1"'),
+        (
+            {
+                "Accept-Ranges": "bytes",
+                "Last-Modified": "Sat, 06 Jun 2020 00:00:00 GMT",
+            },
+            "Sat, 06 Jun 2020 00:00:00 GMT",
+        ),
+        (
+            {
+                "Accept-Ranges": "bytes",
+                "ETag": 'W/"1"',
+                "Last-Modified": "Sat, 06 Jun 2020 00:00:00 GMT",
+            },
+            "Sat, 06 Jun 2020 00:00:00 GMT",
+        ),
+        ({"Accept-Ranges": "bytes", "ETag": 'W/"1"'}, None),
+        ({"Accept-Ranges": "bytes"}, None),
+        ({"Accept-Ranges": "none", "ETag": '"1"'}, None),
+        ({"ETag": '"1"'}, None),
+        ({"Accept-Ranges": "bytes", "ETag": '"1"', "Content-Encoding": "gzip"}, None),
+    ],
+)
+def test_get_resume_validator(headers, validator):
+    assert get_resume_validator(headers) == validator
+
+
+def test_parse_content_range():
+    assert parse_content_range("bytes 100-199/200") == 100
+    assert parse_content_range("bytes 0-99/*") == 0
+
+
+@pytest.mark.parametrize("value", [None, "", "bytes */200", "items 0-1/2"])
+def test_parse_content_range_malformed(value):
+    with pytest.raises(ValueError):
+        parse_content_range(value)
+
+
+RESUMABLE_HEADERS = {"Accept-Ranges": "bytes", "ETag": '"1"'}
+
+
+def save(partial_download, status_code, headers, chunks):
+    assert partial_download.open(status_code, headers)
+    saved = list(partial_download.iter_saved_chunks(2))
+    list(partial_download.save_chunks(chunks))
+    partial_download.close()
+    return saved
+
+
+def test_save_and_resume(tmpdir):
+    partial_download = PartialDownload(str(tmpdir.join("downloads", "a")))
+    assert partial_download.get_request_headers() == {}
+    assert not partial_download.can_resume
+
+    assert save(partial_download, 200, RESUMABLE_HEADERS, [b"abc", b"de"]) == []
+    assert partial_download.size == 5
+    assert partial_download.can_resume
+    assert partial_download.get_request_headers() == {
+        "Range": "bytes=5-",
+        "If-Range": '"1"',
+    }
+
+    saved = save(partial_download, 206, {"Content-Range": "bytes 5-7/8"}, [b"fgh"])
+    assert saved == [b"ab", b"cd", b"e"]
+    with open(partial_download.path, "rb") as f:
+        assert f.read() == b"abcdefgh"
+
+
+def test_not_resumed_from_other_source_url(tmpdir):
+    path = str(tmpdir.join("a"))
+    save(
+        PartialDownload(path, "http://example.com/a.gz"),
+        200,
+        RESUMABLE_HEADERS,
+        [b"abc"],
+    )
+
+    assert PartialDownload(path, "http://example.com/a.gz").can_resume
+    assert not PartialDownload(path, "http://example.com/a.xz").can_resume
+    assert PartialDownload(path, "http://example.com/a.xz").get_request_headers() == {}
+    assert not PartialDownload(path).can_resume
+
+
+def test_full_response_replaces_saved_bytes(tmpdir):
+    partial_download = PartialDownload(str(tmpdir.join("a")))
+    save(partial_download, 200, RESUMABLE_HEADERS, [b"abc"])
+
+    headers = {"Accept-Ranges": "bytes", "ETag": '"2"'}
+    assert save(partial_download, 200, headers, [b"xy"]) == []
+    assert partial_download.validator == '"2"'
+    with open(partial_download.path, "rb") as f:
+        assert f.read() == b"xy"
+
+
+def test_full_response_not_resumable(tmpdir):
+    partial_download = PartialDownload(str(tmpdir.join("a")))
+    save(partial_download, 200, RESUMABLE_HEADERS, [b"abc"])
+
+    assert not partial_download.open(200, {})
+    assert not os.path.exists(partial_download.path)
+    assert not partial_download.can_resume
+
+
+@pytest.mark.parametrize("content_range", ["bytes 0-7/8", "bytes 4-7/8", "bytes"])
+def test_partial_response_mismatch(tmpdir, content_range):
+    partial_download = PartialDownload(str(tmpdir.join("a")))
+    save(partial_download, 200, RESUMABLE_HEADERS, [b"abc"])
+
+    with pytest.raises(ValueError):
+        partial_download.open(206, {"Content-Range": content_range})
+
+
+def test_remove(tmpdir):
+    partial_download = PartialDownload(str(tmpdir.join("a")))
+    save(partial_download, 200, RESUMABLE_HEADERS, [b"abc"])
+    assert partial_download.get_mtime() is not None
+
+    assert sorted(partial_download.remove()) == sorted(
+        [partial_download.path, partial_download.state_path]
+    )
+    assert partial_download.get_mtime() is None
+    assert partial_download.remove() == []
@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+from ust_download_cache import CachedFile
+from ust_download_cache.refresh_scheduler import RefreshAheadScheduler
+
+
+class MockDownloadCache:
+    def __init__(self, null_logger, ttl, fail=False):
+        self.logger = null_logger
+        self.ttl = ttl
+        self.fail = fail
+        self.refreshes = []
+        self.refreshed = threading.Event()
+
+    def cached_file(self, url):
+        return CachedFile(url, "/.ust_cache/1", time.time(), self.ttl)
+
+    def _refresh_file(self, url, expires_within=0):
+        self.refreshes.append((url, expires_within))
+        self.refreshed.set()
+        if self.fail:
+            raise Exception("Test")
+
+        return self.cached_file(url)
+
+
+@pytest.fixture
+def scheduler_factory(null_logger):
+    schedulers = []
+
+    def create(ttl, lead_time, fail=False, **kwargs):
+        cache = MockDownloadCache(null_logger, ttl, fail)
+        scheduler = RefreshAheadScheduler(cache, lead_time, **kwargs)
+        scheduler.start()
+        schedulers.append(scheduler)
+
+        return cache, scheduler
+
+    yield create
+
+    for scheduler in schedulers:
+        scheduler.stop()
+
+
+def test_refreshes_before_expiration(scheduler_factory):
+    cache, scheduler = scheduler_factory(ttl=1.2, lead_time=1)
+    cached_file = cache.cached_file("file:///a")
+    scheduler.touch("file:///a", cached_file)
+
+    assert cache.refreshed.wait(2)
+    assert cache.refreshes == [("file:///a", 1)]
+    assert time.time() < cached_file.expiration_time
+
+
+def test_reschedules_after_refresh(scheduler_factory):
+    cache, scheduler = scheduler_factory(ttl=100, lead_time=10)
+    scheduler.touch("file:///a", cache.cached_file("file:///a"))
+    scheduler._refresh("file:///a")
+
+    deadline = scheduler.scheduled["file:///a"]
+    assert 89 < deadline - time.time() <= 91
+
+
+def test_not_refreshed_unless_requested(scheduler_factory):
+    cache, scheduler = scheduler_factory(ttl=0, lead_time=0, min_refresh_interval=0)
+    scheduler.touch("file:///a", cache.cached_file("file:///a"))
+
+    assert cache.refreshed.wait(2)
+    cache.refreshed.clear()
+
+    # Not requested since the first refresh, so it is dropped from the schedule
+    assert not cache.refreshed.wait(1.5)
+    assert len(cache.refreshes) == 1
+    assert "file:///a" not in scheduler.scheduled
+
+
+def test_touch_does_not_duplicate_schedule(scheduler_factory):
+    cache, scheduler = scheduler_factory(ttl=100, lead_time=10)
+    cached_file = cache.cached_file("file:///a")
+    scheduler.touch("file:///a", cached_file)
+    scheduler.touch("file:///a", cached_file)
+
+    assert len(scheduler._heap) == 1
+
+
+def test_min_refresh_interval(scheduler_factory):
+    # The refreshed file has already expired, e.g. upstream published an old file
+    cache, scheduler = scheduler_factory(ttl=-10, lead_time=1, min_refresh_interval=30)
+    scheduler.touch("file:///a", cache.cached_file("file:///a"))
+
+    assert cache.refreshed.wait(2)
+    time.sleep(0.1)
+    assert len(cache.refreshes) == 1
+    assert scheduler.scheduled["file:///a"] - time.time() > 29
+
+
+def test_refresh_failure(scheduler_factory):
+    cache, scheduler = scheduler_factory(ttl=0, lead_time=0, fail=True)
+    scheduler.touch("file:///a", cache.cached_file("file:///a"))
+
+    assert cache.refreshed.wait(2)
+    time.sleep(0.1)
+    assert "file:///a" in scheduler.scheduled
+
+
+def test_stop(null_logger):
+    scheduler = RefreshAheadScheduler(MockDownloadCache(null_logger, 100), 10)
+    scheduler.start()
+    scheduler.stop()
+
+    assert scheduler._thread is None
@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+
+from ust_download_cache.single_flight import SingleFlight
+
+
+class WatchedEvent(threading.Event):
+    """An Event that records when a thread starts waiting for it."""
+
+    def __init__(self):
+        super().__init__()
+        self.waiting = threading.Event()
+
+    def wait(self, timeout=None):
+        self.waiting.set()
+        return super().wait(timeout)
+
+
+def run_in_thread(single_flight, function, results):
+    def run():
+        try:
+            results.append(single_flight.run("key", function))
+        except ValueError as ex:
+            results.append(ex)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def run_shared(leader_function):
+    """Run leader_function, and another call for the same key while it runs."""
+    single_flight = SingleFlight()
+    started = threading.Event()
+    finish = threading.Event()
+
+    def leader():
+        started.set()
+        finish.wait(5)
+        return leader_function()
+
+    results = []
+    threads = [run_in_thread(single_flight, leader, results)]
+    started.wait(5)
+    done = single_flight._calls["key"].done = WatchedEvent()
+    threads.append(run_in_thread(single_flight, lambda: "other", results))
+    done.waiting.wait(5)
+
+    finish.set()
+    for thread in threads:
+        thread.join(5)
+
+    return results
+
+
+def test_run():
+    assert SingleFlight().run("key", lambda x: x * 2, 21) == (42, False)
+
+
+def test_concurrent_calls_shared():
+    results = run_shared(lambda: "result")
+
+    assert results == [("result", False), ("result", True)]
+
+
+def test_error_shared():
+    error = ValueError("failed")
+
+    def fail():
+        raise error
+
+    assert run_shared(fail) == [error, error]
+
+
+def test_different_keys_not_shared():
+    single_flight = SingleFlight()
+    finish = threading.Event()
+    results = []
+    thread = run_in_thread(single_flight, lambda: finish.wait(5), results)
+
+    assert single_flight.run("other", lambda: "other") == ("other", False)
+
+    finish.set()
+    thread.join(5)
+    assert results == [(True, False)]
+
+
+def test_call_after_failure_runs_again():
+    single_flight = SingleFlight()
+
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        single_flight.run("key", fail)
+
+    assert single_flight.run("key", lambda: "result") == ("result", False)
@@ -0,0 +1,91 @@
+import marshal
+import os
+
+from ust_download_cache import snapshot
+from ust_download_cache.snapshot import (
+    get_snapshot_path,
+    read_snapshot,
+    remove_snapshot,
+    write_snapshot,
+)
+
+DOCUMENT = {
+    "metadata": {"timestamp": 1591401600, "ttl": 60},
+    "data": {"a": [1, 2.5, "three", None, True, {"b": []}]},
+}
+IDENTITY = (64769, 1234, 5678, 1591401600123456789)
+
+
+def test_get_snapshot_path():
+    assert get_snapshot_path("/.ust_cache/1") == "/.ust_cache/1.snapshot"
+
+
+def test_write_read_snapshot(tmpdir):
+    path = str(tmpdir.join("1.snapshot"))
+    write_snapshot(path, IDENTITY, DOCUMENT)
+
+    assert read_snapshot(path, IDENTITY) == DOCUMENT
+    assert os.listdir(tmpdir) == ["1.snapshot"]
+
+
+def test_read_snapshot_missing(tmpdir):
+    assert read_snapshot(str(tmpdir.join("1.snapshot")), IDENTITY) is None
+
+
+def test_read_snapshot_identity_changed(tmpdir):
+    path = str(tmpdir.join("1.snapshot"))
+    write_snapshot(path, IDENTITY, DOCUMENT)
+
+    assert read_snapshot(path, IDENTITY[:3] + (0,)) is None
+
+
+def test_read_snapshot_format_version_changed(tmpdir, monkeypatch):
+    path = str(tmpdir.join("1.snapshot"))
+    write_snapshot(path, IDENTITY, DOCUMENT)
+
+    monkeypatch.setattr(snapshot, "SNAPSHOT_FORMAT_VERSION", 2)
+    assert read_snapshot(path, IDENTITY) is None
+
+
+def test_read_snapshot_marshal_version_changed(tmpdir, monkeypatch):
+    path = str(tmpdir.join("1.snapshot"))
+    write_snapshot(path, IDENTITY, DOCUMENT)
+
+    monkeypatch.setattr(marshal, "version", marshal.version + 1)
+    assert read_snapshot(path, IDENTITY) is None
+
+
+def test_read_snapshot_truncated(tmpdir):
+    path = str(tmpdir.join("1.snapshot"))
+    write_snapshot(path, IDENTITY, DOCUMENT)
+    with open(path, "rb") as f:
+        contents = f.read()
+
+    for length in (10, 30, len(contents) - 1):
+        with open(path, "wb") as f:
+            f.write(contents[:length])
+
+        assert read_snapshot(path, IDENTITY) is None
+
+
+def test_write_snapshot_error_removes_tmp_file(tmpdir):
+    path = str(tmpdir.join("1.snapshot"))
+    write_snapshot(path, IDENTITY, DOCUMENT)
+
+    try:
+        write_snapshot(path, IDENTITY, {"a": object()})
+    except ValueError:
+        pass
+
+    assert os.listdir(tmpdir) == ["1.snapshot"]
+    assert read_snapshot(path, IDENTITY) == DOCUMENT
+
+
+def test_remove_snapshot(tmpdir):
+    path = str(tmpdir.join("1.snapshot"))
+    write_snapshot(path, IDENTITY, DOCUMENT)
+
+    remove_snapshot(path)
+    remove_snapshot(path)
+
+    assert os.listdir(tmpdir) == []
@@ -0,0 +1,144 @@
+import logging
+import threading
+
+import pytest
+
+from ust_download_cache.stats import CacheStats, Histogram, format_prometheus
+
+URL = "https://example.com/a.json"
+
+
+def test_histogram_cumulative_buckets():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+
+    histogram_dict = histogram.to_dict()
+    assert histogram_dict["count"] == 4
+    assert histogram_dict["sum"] == pytest.approx(2.65)
+    assert histogram_dict["buckets"] == [(0.1, 2), (1, 3), ("+Inf", 4)]
+
+
+def test_counters_totals(null_logger):
+    stats = CacheStats(null_logger)
+    stats.increment(URL, "hits")
+    stats.increment(URL, "hits")
+    stats.increment("https://example.com/b.json", "hits")
+    stats.increment(URL, "bytes_downloaded", 100)
+
+    snapshot = stats.snapshot()
+    assert snapshot["totals"]["hits"] == 3
+    assert snapshot["totals"]["misses"] == 0
+    assert snapshot["urls"][URL]["hits"] == 2
+    assert snapshot["urls"][URL]["bytes_downloaded"] == 100
+
+
+def test_time_records_duration_and_span(null_logger):
+    spans = []
+    stats = CacheStats(null_logger, lambda *args: spans.append(args))
+    with stats.time(URL, "parse"):
+        pass
+
+    assert stats.snapshot()["urls"][URL]["timings"]["parse"]["count"] == 1
+    assert len(spans) == 1
+    name, url, start, duration, error = spans[0]
+    assert (name, url, error) == ("parse", URL, None)
+    assert duration >= 0
+
+
+def test_time_reports_errors(null_logger):
+    spans = []
+    stats = CacheStats(null_logger, lambda *args: spans.append(args))
+    error = ValueError("malformed")
+    try:
+        with stats.time(URL, "parse"):
+            raise error
+    except ValueError:
+        pass
+
+    assert spans[0][4] is error
+    assert stats.snapshot()["urls"][URL]["timings"]["parse"]["count"] == 1
+
+
+def test_span_callback_failure_ignored(caplog):
+    def span_callback(*args):
+        raise RuntimeError("tracer is down")
+
+    stats = CacheStats(logging.getLogger("test_stats"), span_callback)
+    stats.observe(URL, "download", 0, 1.5)
+
+    assert stats.snapshot()["urls"][URL]["timings"]["download"]["sum"] == 1.5
+    assert "tracer is down" in caplog.text
+
+
+def test_reset(null_logger):
+    stats = CacheStats(null_logger)
+    stats.increment(URL, "hits")
+    stats.reset()
+
+    assert stats.snapshot()["urls"] == {}
+    assert stats.snapshot()["totals"]["hits"] == 0
+
+
+def record_in_thread(stats, url):
+    thread = threading.Thread(target=stats.increment, args=(url, "hits"))
+    thread.start()
+    thread.join(5)
+
+
+def test_threads_summed(null_logger):
+    stats = CacheStats(null_logger)
+    stats.increment(URL, "hits")
+    record_in_thread(stats, URL)
+    # Folds the shard of the thread that has exited
+    record_in_thread(stats, URL)
+
+    assert stats.snapshot()["urls"][URL]["hits"] == 3
+    assert len(stats._shards) == 2
+
+
+def test_reset_clears_threads(null_logger):
+    stats = CacheStats(null_logger)
+    record_in_thread(stats, URL)
+    record_in_thread(stats, URL)
+    stats.increment(URL, "hits")
+    stats.reset()
+    stats.increment(URL, "misses")
+
+    assert stats.snapshot()["totals"]["hits"] == 0
+    assert stats.snapshot()["totals"]["misses"] == 1
+
+
+def test_format_prometheus(null_logger):
+    stats = CacheStats(null_logger, buckets=(0.1, 1))
+    stats.increment(URL, "hits", 2)
+    stats.observe(URL, "download", 0, 0.5)
+
+    text = format_prometheus(stats.snapshot())
+    lines = text.splitlines()
+    assert "# TYPE ust_download_cache_hits_total counter" in lines
+    assert 'ust_download_cache_hits_total{url="%s"} 2' % URL in lines
+    assert "# TYPE ust_download_cache_download_seconds histogram" in lines
+    assert (
+        'ust_download_cache_download_seconds_bucket{url="%s",le="0.1"} 0' % URL in lines
+    )
+    assert (
+        'ust_download_cache_download_seconds_bucket{url="%s",le="1.0"} 1' % URL in lines
+    )
+    assert (
+        'ust_download_cache_download_seconds_bucket{url="%s",le="+Inf"} 1' % URL
+        in lines
+    )
+    assert 'ust_download_cache_download_seconds_sum{url="%s"} 0.5' % URL in lines
+    assert 'ust_download_cache_download_seconds_count{url="%s"} 1' % URL in lines
+    assert text.endswith("\n")
+
+
+def test_format_prometheus_escapes_labels(null_logger):
+    stats = CacheStats(null_logger)
+    stats.increment('https://example.com/"a"\\b\n', "misses")
+
+    assert (
+        'ust_download_cache_misses_total{url="https://example.com/\\"a\\"\\\\b\\n"} 1'
+        in format_prometheus(stats.snapshot()).splitlines()
+    )
@@ -1,28 +1,45 @@
 import bz2
 import gzip
+import hashlib
 import json
 import logging
+import lzma
+import multiprocessing
 import os
 import shutil
+import subprocess
+import sys
+import threading
+import time
 import uuid
+import zlib
+from urllib.parse import urlsplit
 
 import pytest
 import requests
 
 from ust_download_cache import (
+    BatchDownloadError,
     BZ2ExtractionError,
     CachedFile,
+    CircuitBreaker,
     DownloadError,
     FileCacheLoadError,
+    FreshnessPolicy,
     GZExtractionError,
     USTDownloadCache,
+    parallel_decompression,
+    ust_download_cache,
 )
+from ust_download_cache.document_cache import get_file_identity
+from ust_download_cache.freshness import FETCH_BASIS
 
 
 class MockResponse:
-    def __init__(self, content, status_code, url=None):
+    def __init__(self, content, status_code, url=None, headers=None):
         self.content = str.encode(content)
         self.status_code = status_code
+        self.headers = headers if headers is not None else {}
 
         if url is not None and url.startswith("file:///"):
             with open(url[7:], "rb") as f:
@@ -32,6 +49,15 @@ class MockResponse:
         if self.status_code != requests.codes.ok:
             raise requests.exceptions.HTTPError(self.status_code)
 
+    def iter_content(self, chunk_size=1):
+        content = self.content
+        while content:
+            yield content[:chunk_size]
+            content = content[chunk_size:]
+
+    def close(self):
+        pass
+
 
 def load_file_cache(tmp_dir):
     with open(tmp_dir.join("file_cache.json")) as fc:
@@ -40,6 +66,13 @@ def load_file_cache(tmp_dir):
     return file_cache
 
 
+def list_cached_files(tmp_dir):
+    # Lock files are left in place for reuse by other processes
+    return sorted(
+        f for f in os.listdir(tmp_dir) if f != "locks" and not f.endswith(".lock")
+    )
+
+
 def gen_uuid4():
     for x in range(99, 200):
         yield x
@@ -59,15 +92,6 @@ def uuid4():
     return MockUUID4()
 
 
-@pytest.fixture
-def null_logger():
-    logger = logging.getLogger("cvescan.null")
-    if not logger.hasHandlers():
-        logger.addHandler(logging.NullHandler())
-
-    return logger
-
-
 def test_set_cache_dir_constructor(null_logger, tmpdir):
     udc = USTDownloadCache(null_logger, cache_dir=tmpdir.join("my_ust_cache"))
     assert udc.cache_dir == tmpdir.join("my_ust_cache")
@@ -101,7 +125,7 @@ def test_download_creates_file_cache(null_logger, tmpdir, monkeypatch, uuid4):
     url = "file://%s" % os.path.abspath("./tests/assets/1.json")
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
 
     udc = USTDownloadCache(null_logger, tmpdir)
     udc.get_data_from_url(url)
@@ -113,7 +137,7 @@ def test_download_creates_file_cache_contents(null_logger, tmpdir, monkeypatch,
     url = "file://%s" % os.path.abspath("./tests/assets/1.json")
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
 
     udc = USTDownloadCache(null_logger, tmpdir)
     udc.get_data_from_url(url)
@@ -141,11 +165,11 @@ def test_download_creates_file_cache_contents_2(
     udc = USTDownloadCache(null_logger, tmpdir)
 
     mr = MockResponse("", 200, url=url1)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
     udc.get_data_from_url(url1)
 
     mr = MockResponse("", 200, url=url2)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
     udc.get_data_from_url(url2)
     with open(tmpdir.join("file_cache.json")) as f:
         cache_contents = json.load(f)
@@ -175,7 +199,7 @@ def test_download_cache_expired(null_logger, tmpdir, monkeypatch, uuid4):
     udc = USTDownloadCache(null_logger, tmpdir)
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
     udc.get_data_from_url(url)
     # Downloading a second time will cause the mock uuid to increment
     udc.get_data_from_url(url)
@@ -201,10 +225,10 @@ def test_download_cache_not_expired(null_logger, tmpdir, monkeypatch, uuid4):
     udc = USTDownloadCache(null_logger, tmpdir)
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
     udc.get_data_from_url(url)
     # Downloading a second time will NOT cause the mock uuid to increment
     udc.get_data_from_url(url)
@@ -250,7 +274,7 @@ def test_download_cache_load_not_expired(null_logger, tmpdir, monkeypatch, uuid4
     udc = USTDownloadCache(null_logger, tmpdir)
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
     udc.get_data_from_url(url)
     with open(tmpdir.join("file_cache.json")) as f:
         cache_contents = json.load(f)
@@ -277,7 +301,7 @@ def test_download_cache_load_expired(null_logger, tmpdir, monkeypatch, uuid4):
     udc = USTDownloadCache(null_logger, tmpdir)
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
     udc.get_data_from_url(url)
     with open(tmpdir.join("file_cache.json")) as f:
         cache_contents = json.load(f)
@@ -301,7 +325,7 @@ def test_download_missing_metadata(null_logger, tmpdir, monkeypatch, uuid4):
         udc = USTDownloadCache(null_logger, tmpdir)
 
         mr = MockResponse("", 200, url=url)
-        monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+        monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
         udc.get_data_from_url(url)
 
     assert not os.path.exists(tmpdir.join("99"))
@@ -313,14 +337,14 @@ def raise_test_exception():
 
 def test_download_error(null_logger, tmpdir, monkeypatch, uuid4):
     monkeypatch.setattr(uuid, "uuid4", uuid4.get)
-    monkeypatch.setattr(requests, "get", raise_test_exception)
+    monkeypatch.setattr(requests.Session, "get", raise_test_exception)
     url = "file://%s" % os.path.abspath("./tests/assets/1.json")
 
     with pytest.raises(DownloadError):
         udc = USTDownloadCache(null_logger, tmpdir)
 
         monkeypatch.setattr(
-            requests, "get", lambda *args, **kwargs: raise_test_exception
+            requests.Session, "get", lambda *args, **kwargs: raise_test_exception
         )
         udc.get_data_from_url(url)
 
@@ -329,7 +353,7 @@ def test_download_404(null_logger, tmpdir, monkeypatch, uuid4):
     monkeypatch.setattr(uuid, "uuid4", uuid4.get)
 
     mr = MockResponse("", 404)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
 
     url = "file://%s" % os.path.abspath("./tests/assets/1.json")
 
@@ -342,27 +366,27 @@ def test_download_404(null_logger, tmpdir, monkeypatch, uuid4):
 
 def test_bz2_error(null_logger, tmpdir, monkeypatch, uuid4):
     monkeypatch.setattr(uuid, "uuid4", uuid4.get)
-    monkeypatch.setattr(bz2, "open", raise_test_exception)
+    monkeypatch.setattr(bz2, "BZ2Decompressor", raise_test_exception)
     url = "file://%s" % os.path.abspath("./tests/assets/2.json.bz2")
 
     with pytest.raises(BZ2ExtractionError):
         udc = USTDownloadCache(null_logger, tmpdir)
 
         mr = MockResponse("", 200, url=url)
-        monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+        monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
         udc.get_data_from_url(url)
 
 
 def test_gzip_error(null_logger, tmpdir, monkeypatch, uuid4):
     monkeypatch.setattr(uuid, "uuid4", uuid4.get)
-    monkeypatch.setattr(gzip, "open", raise_test_exception)
+    monkeypatch.setattr(zlib, "decompressobj", raise_test_exception)
     url = "file://%s" % os.path.abspath("./tests/assets/4.json.gz")
 
     with pytest.raises(GZExtractionError):
         udc = USTDownloadCache(null_logger, tmpdir)
 
         mr = MockResponse("", 200, url=url)
-        monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+        monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
         udc.get_data_from_url(url)
 
 
@@ -372,7 +396,7 @@ def test_download_gzip(null_logger, tmpdir, monkeypatch, uuid4):
     udc = USTDownloadCache(null_logger, tmpdir)
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
     data = udc.get_data_from_url(url)
 
     assert data["a"] == "I"
@@ -386,8 +410,9 @@ def test_download_cache_load_failed_key_error(null_logger, tmpdir, monkeypatch,
         "./tests/assets/malformed_file_cache.json", tmpdir.join("file_cache.json")
     )
 
+    udc = USTDownloadCache(null_logger, tmpdir)
     with pytest.raises(FileCacheLoadError) as fcle:
-        USTDownloadCache(null_logger, tmpdir)
+        udc.get_data_from_url("file:///test")
 
     assert "missing key 'url'" in str(fcle.value)
 
@@ -398,8 +423,9 @@ def test_download_cache_load_failed_json_error(null_logger, tmpdir, monkeypatch,
         "./tests/assets/malformed_json_file_cache.json", tmpdir.join("file_cache.json")
     )
 
+    udc = USTDownloadCache(null_logger, tmpdir)
     with pytest.raises(FileCacheLoadError) as fcle:
-        USTDownloadCache(null_logger, tmpdir)
+        udc.get_data_from_url("file:///test")
 
     assert "File contains malformed JSON" in str(fcle.value)
 
@@ -412,8 +438,9 @@ def test_download_cache_load_permission_denied_error(
     shutil.copy("./tests/assets/malformed_json_file_cache.json", cache_file)
     os.chmod(cache_file, 0o000)
 
+    udc = USTDownloadCache(null_logger, tmpdir)
     with pytest.raises(FileCacheLoadError) as fcle:
-        USTDownloadCache(null_logger, tmpdir)
+        udc.get_data_from_url("file:///test")
 
     assert "Permission denied" in str(fcle.value)
 
@@ -423,7 +450,7 @@ def test_download_get_data(null_logger, tmpdir, monkeypatch, uuid4):
     url = "file://%s" % os.path.abspath("./tests/assets/1.json")
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
 
     udc = USTDownloadCache(null_logger, tmpdir)
     data = udc.get_data_from_url(url)
@@ -437,10 +464,2319 @@ def test_download_get_cache_metadata(null_logger, tmpdir, monkeypatch, uuid4):
     url = "file://%s" % os.path.abspath("./tests/assets/1.json")
 
     mr = MockResponse("", 200, url=url)
-    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mr)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
 
     udc = USTDownloadCache(null_logger, tmpdir)
     metadata = udc.get_cache_metadata_from_url(url)
     assert metadata["version"] == "1.0"
     assert metadata["timestamp"] == 1591401600
     assert metadata["ttl"] == 60
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024 * 1024])
+def test_download_bz2_chunk_sizes(null_logger, tmpdir, monkeypatch, chunk_size):
+    url = "file://%s" % os.path.abspath("./tests/assets/2.json.bz2")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(
+        mr, "iter_content", lambda _: MockResponse.iter_content(mr, chunk_size)
+    )
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    metadata = udc.get_cache_metadata_from_url(url)
+    assert metadata["timestamp"] == 1591402600
+
+
+def test_download_interrupted_removes_partial_file(
+    null_logger, tmpdir, monkeypatch, uuid4
+):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    def interrupted_iter_content(chunk_size):
+        yield b'{"metadata": '
+        raise requests.exceptions.ConnectionError("Connection reset by peer")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(mr, "iter_content", interrupted_iter_content)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(DownloadError) as de:
+        udc.get_data_from_url(url)
+
+    assert "Connection reset by peer" in str(de.value)
+    assert list_cached_files(tmpdir) == []
+
+
+def test_download_truncated_gzip(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/4.json.gz")
+
+    mr = MockResponse("", 200, url=url)
+    mr.content = mr.content[:-8]
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(GZExtractionError):
+        udc.get_data_from_url(url)
+
+    assert list_cached_files(tmpdir) == []
+
+
+class MockConditionalGet:
+    def __init__(self, url, etag=None, last_modified=None):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.modified = False
+        self.requests = []
+
+    def __call__(self, url, *args, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append(headers)
+
+        response_headers = {}
+        if self.etag is not None:
+            response_headers["ETag"] = self.etag
+        if self.last_modified is not None:
+            response_headers["Last-Modified"] = self.last_modified
+
+        validators = (headers.get("If-None-Match"), headers.get("If-Modified-Since"))
+        if not self.modified and any(
+            v is not None and v in (self.etag, self.last_modified) for v in validators
+        ):
+            return MockResponse("", 304, headers=response_headers)
+
+        return MockResponse("", 200, url=self.url, headers=response_headers)
+
+
+def test_download_stores_validators(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+    last_modified = "Sat, 06 Jun 2020 00:00:00 GMT"
+    monkeypatch.setattr(
+        requests.Session, "get", MockConditionalGet(url, '"abc123"', last_modified)
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+
+    cache_contents = load_file_cache(tmpdir)
+    assert cache_contents[url]["etag"] == '"abc123"'
+    assert cache_contents[url]["last_modified"] == last_modified
+
+
+def test_download_cache_expired_not_modified(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(time, "time", lambda: 1591401600.0 + 120)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+    mock_get = MockConditionalGet(url, etag='"abc123"')
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    data = udc.get_data_from_url(url)
+
+    assert data["a"] == 1
+    assert mock_get.requests[-1] == {"If-None-Match": '"abc123"'}
+    assert list_cached_files(tmpdir) == ["99", "file_cache.json"]
+
+    cache_contents = load_file_cache(tmpdir)
+    assert cache_contents[url]["path"] == str(tmpdir.join("99"))
+    assert cache_contents[url]["revalidated"] == 1591401720
+    assert not udc.file_cache[url].is_expired
+
+
+def test_download_cache_expired_if_modified_since(
+    null_logger, tmpdir, monkeypatch, uuid4
+):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(time, "time", lambda: 1591401600.0 + 120)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+    last_modified = "Sat, 06 Jun 2020 00:00:00 GMT"
+    mock_get = MockConditionalGet(url, last_modified=last_modified)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    udc.get_data_from_url(url)
+
+    assert mock_get.requests[-1] == {"If-Modified-Since": last_modified}
+    assert load_file_cache(tmpdir)[url]["path"] == str(tmpdir.join("99"))
+
+
+def test_download_cache_expired_modified(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(time, "time", lambda: 1591401600.0 + 120)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+    mock_get = MockConditionalGet(url, etag='"abc123"')
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    mock_get.modified = True
+    udc.get_data_from_url(url)
+
+    assert list_cached_files(tmpdir) == ["100", "file_cache.json"]
+    cache_contents = load_file_cache(tmpdir)
+    assert cache_contents[url]["path"] == str(tmpdir.join("100"))
+    assert "revalidated" not in cache_contents[url]
+
+
+def test_download_cache_expired_missing_file_not_revalidated(
+    null_logger, tmpdir, monkeypatch, uuid4
+):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(time, "time", lambda: 1591401600.0 + 120)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+    mock_get = MockConditionalGet(url, etag='"abc123"')
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    os.remove(tmpdir.join("99"))
+    data = udc.get_data_from_url(url)
+
+    assert data["a"] == 1
+    assert "If-None-Match" not in mock_get.requests[-1]
+    assert list_cached_files(tmpdir) == ["100", "file_cache.json"]
+    assert load_file_cache(tmpdir)[url]["path"] == str(tmpdir.join("100"))
+
+
+class CountingJSONLoads:
+    def __init__(self):
+        self.count = 0
+        self.loads = json.loads
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+        return self.loads(*args, **kwargs)
+
+
+def test_memory_cache_avoids_reparsing(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, memory_cache_size=1024 * 1024)
+    udc.get_data_from_url(url)
+
+    loads = CountingJSONLoads()
+    monkeypatch.setattr(json, "loads", loads)
+    metadata = udc.get_cache_metadata_from_url(url)
+    data = udc.get_data_from_url(url)
+
+    assert loads.count == 0
+    assert metadata["timestamp"] == 1591401600
+    assert data["a"] == 1
+
+
+def test_memory_cache_disabled(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+
+    loads = CountingJSONLoads()
+    monkeypatch.setattr(json, "loads", loads)
+    udc.get_data_from_url(url)
+
+    assert loads.count == 1
+    assert len(udc.document_cache) == 0
+
+
+def test_memory_cache_invalidated_on_refresh(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url1 = "file://%s" % os.path.abspath("./tests/assets/1.json")
+    url2 = "file://%s" % os.path.abspath("./tests/assets/4.json.gz")
+
+    udc = USTDownloadCache(null_logger, tmpdir, memory_cache_size=1024 * 1024)
+
+    mr = MockResponse("", 200, url=url1)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+    assert udc.get_data_from_url(url1)["a"] == 1
+    assert str(tmpdir.join("99")) in udc.document_cache
+
+    monkeypatch.setattr(CachedFile, "is_expired", True)
+    mr = MockResponse("", 200, url=url2)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+    assert udc.get_data_from_url(url1)["a"] == "I"
+    assert str(tmpdir.join("99")) not in udc.document_cache
+    assert str(tmpdir.join("100")) in udc.document_cache
+
+
+def test_download_metadata_does_not_parse_data(null_logger, tmpdir, monkeypatch):
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    parsed = []
+    loads = json.loads
+    monkeypatch.setattr(json, "loads", lambda s, **kw: parsed.append(s) or loads(s))
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc._get_cached_file_path(url)
+
+    assert b"metadata" in mr.content
+    assert mr.content not in parsed
+    assert not any(b'"data"' in s for s in parsed)
+
+
+def test_download_metadata_after_large_data(null_logger, tmpdir, monkeypatch):
+    url = "file:///data_first.json"
+    document = {
+        "data": {"a": ["x" * 100] * 100},
+        "metadata": {"timestamp": 5, "ttl": 6},
+    }
+
+    mr = MockResponse(json.dumps(document), 200)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    monkeypatch.setattr(ust_download_cache, "METADATA_SCAN_LIMIT", 1024)
+    udc._get_cached_file_path(url)
+
+    assert udc.file_cache[url].timestamp == 5
+    assert udc.file_cache[url].ttl == 6
+
+
+@pytest.mark.parametrize("document", ["[1, 2]", '"string"'])
+def test_download_metadata_not_object(null_logger, tmpdir, monkeypatch, document):
+    url = "file:///not_object.json"
+
+    mr = MockResponse(document, 200)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(Exception) as ex:
+        udc.get_data_from_url(url)
+
+    assert str(ex.value) == "Error parsing metadata from file."
+
+
+def test_download_empty_file(null_logger, tmpdir, monkeypatch):
+    url = "file:///empty.json"
+
+    mr = MockResponse("", 200)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(json.JSONDecodeError):
+        udc.get_data_from_url(url)
+
+    assert list_cached_files(tmpdir) == []
+
+
+def test_http_download(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/2.json.bz2", "./tests/assets/2.json.bz2")
+
+    with USTDownloadCache(null_logger, tmpdir) as udc:
+        data = udc.get_data_from_url(url)
+
+    assert data == {"a": 1, "b": 2, "c": 3}
+
+
+def test_http_connections_reused(null_logger, tmpdir, feed_server):
+    url1 = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    url2 = feed_server.add_feed_file("/4.json.gz", "./tests/assets/4.json.gz")
+
+    with USTDownloadCache(null_logger, tmpdir) as udc:
+        udc.get_data_from_url(url1)
+        udc.get_data_from_url(url2)
+
+    client_addresses = {r["client_address"] for r in feed_server.requests}
+    assert len(feed_server.requests) == 2
+    assert len(client_addresses) == 1
+
+
+def test_http_retry_transient_errors(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file(
+        "/1.json", "./tests/assets/1.json", failures=[503, 502]
+    )
+
+    with USTDownloadCache(null_logger, tmpdir, backoff_factor=0) as udc:
+        data = udc.get_data_from_url(url)
+
+    assert data["a"] == 1
+    assert len(feed_server.requests_for("/1.json")) == 3
+
+
+def test_http_retries_exhausted(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file(
+        "/1.json", "./tests/assets/1.json", failures=[503, 503, 503]
+    )
+
+    with USTDownloadCache(null_logger, tmpdir, retries=2, backoff_factor=0) as udc:
+        with pytest.raises(DownloadError) as de:
+            udc.get_data_from_url(url)
+
+    assert "503" in str(de.value)
+    assert len(feed_server.requests_for("/1.json")) == 3
+
+
+def test_http_no_retry_not_found(null_logger, tmpdir, feed_server):
+    url = feed_server.url("/missing.json")
+
+    with USTDownloadCache(null_logger, tmpdir, backoff_factor=0) as udc:
+        with pytest.raises(DownloadError) as de:
+            udc.get_data_from_url(url)
+
+    assert "404" in str(de.value)
+    assert len(feed_server.requests) == 1
+
+
+def test_http_read_timeout(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json", delay=2)
+
+    udc = USTDownloadCache(null_logger, tmpdir, timeout=(1, 0.2), retries=0)
+    with pytest.raises(DownloadError) as de:
+        udc.get_data_from_url(url)
+
+    assert "timed out" in str(de.value)
+
+
+def test_http_custom_session(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+
+    session = requests.Session()
+    session.headers["User-Agent"] = "ust-download-cache-test"
+    udc = USTDownloadCache(null_logger, tmpdir, session=session)
+    udc.get_data_from_url(url)
+
+    assert udc.session is session
+    assert feed_server.requests[0]["headers"]["User-Agent"] == "ust-download-cache-test"
+
+
+class CountingSaveCache:
+    def __init__(self, udc):
+        self.count = 0
+        self.save_cache = udc.save_cache
+
+    def __call__(self):
+        self.count += 1
+        self.save_cache()
+
+
+def test_prefetch(null_logger, tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    urls = [
+        feed_server.add_feed_file("/1.json", "./tests/assets/1.json"),
+        feed_server.add_feed_file("/2.json.bz2", "./tests/assets/2.json.bz2"),
+        feed_server.add_feed_file("/4.json.gz", "./tests/assets/4.json.gz"),
+    ]
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    save_cache = CountingSaveCache(udc)
+    udc.save_cache = save_cache
+    errors = udc.prefetch(urls, max_workers=3)
+
+    assert errors == {}
+    assert save_cache.count == 1
+    assert sorted(load_file_cache(tmpdir).keys()) == sorted(urls)
+    assert udc.get_data_from_url(urls[2])["a"] == "I"
+    assert len(feed_server.requests) == 3
+
+
+def test_prefetch_concurrent(null_logger, tmpdir, feed_server):
+    urls = [
+        feed_server.add_feed_file("/%d.json" % i, "./tests/assets/1.json", delay=0.5)
+        for i in range(4)
+    ]
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    start = time.monotonic()
+    errors = udc.prefetch(urls, max_workers=4)
+
+    assert errors == {}
+    assert time.monotonic() - start < 1.5
+
+
+def test_prefetch_reports_failures(null_logger, tmpdir, feed_server):
+    url1 = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    url2 = feed_server.url("/missing.json")
+    url3 = feed_server.add_feed_file("/3.json", "./tests/assets/3.json")
+
+    udc = USTDownloadCache(null_logger, tmpdir, backoff_factor=0)
+    errors = udc.prefetch([url1, url2, url3])
+
+    assert sorted(errors.keys()) == sorted([url2, url3])
+    assert isinstance(errors[url2], DownloadError)
+    assert list(load_file_cache(tmpdir).keys()) == [url1]
+
+
+def test_prefetch_skips_fresh_files(null_logger, tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    save_cache = CountingSaveCache(udc)
+    udc.save_cache = save_cache
+    udc.prefetch([url, url])
+
+    assert len(feed_server.requests) == 1
+    assert save_cache.count == 0
+
+
+def test_prefetch_revalidates_expired_files(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    monkeypatch.setattr(CachedFile, "is_expired", True)
+    url = feed_server.add_feed_file(
+        "/1.json", "./tests/assets/1.json", headers={"ETag": '"v1"'}
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    path = udc.file_cache[url].path
+    errors = udc.prefetch([url])
+
+    assert errors == {}
+    assert feed_server.requests[-1]["headers"]["If-None-Match"] == '"v1"'
+    assert udc.file_cache[url].path == path
+    assert udc.file_cache[url].revalidated is not None
+
+
+def test_get_many(null_logger, tmpdir, feed_server):
+    url1 = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    url2 = feed_server.add_feed_file("/4.json.gz", "./tests/assets/4.json.gz")
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    results = udc.get_many([url1, url2])
+
+    assert results == {
+        url1: {"a": 1, "b": 2, "c": 3},
+        url2: udc.get_data_from_url(url2),
+    }
+
+
+def test_malformed_data_downloaded_again(null_logger, tmpdir, feed_server):
+    metadata = '{"metadata": {"timestamp": %d, "ttl": 3600}, ' % int(time.time())
+    url = feed_server.add_feed("/a.json", metadata + '"data": {"a": 1,')
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(ValueError):
+        udc.get_data_from_url(url)
+    assert url not in load_file_cache(tmpdir)
+    assert list_cached_files(tmpdir) == ["file_cache.json"]
+
+    feed_server.add_feed("/a.json", metadata + '"data": {"a": 1}}')
+    assert udc.get_data_from_url(url) == {"a": 1}
+    assert len(feed_server.requests) == 2
+
+
+def test_get_many_malformed_data(null_logger, tmpdir, feed_server):
+    url1 = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    url2 = feed_server.add_feed(
+        "/2.json", '{"metadata": {"timestamp": 1, "ttl": 2}, "data": '
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(BatchDownloadError) as bde:
+        udc.get_many([url1, url2])
+
+    assert list(bde.value.errors.keys()) == [url2]
+    assert isinstance(bde.value.errors[url2], ValueError)
+    assert bde.value.results == {url1: {"a": 1, "b": 2, "c": 3}}
+
+
+def test_get_many_failure(null_logger, tmpdir, feed_server):
+    url1 = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    url2 = feed_server.url("/missing.json")
+
+    udc = USTDownloadCache(null_logger, tmpdir, backoff_factor=0)
+    with pytest.raises(BatchDownloadError) as bde:
+        udc.get_many([url1, url2])
+
+    assert list(bde.value.errors.keys()) == [url2]
+    assert bde.value.results == {url1: {"a": 1, "b": 2, "c": 3}}
+    assert url2 in str(bde.value)
+
+
+def get_data_in_child(cache_dir, url, barrier, queue):
+    logger = logging.getLogger("cvescan.null")
+    barrier.wait()
+    try:
+        queue.put(USTDownloadCache(logger, cache_dir).get_data_from_url(url))
+    except Exception as ex:
+        queue.put(ex)
+
+
+def run_in_processes(target, args_list):
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    barrier = context.Barrier(len(args_list))
+    processes = [
+        context.Process(target=target, args=args[:-1] + (args[-1], barrier, queue))
+        for args in args_list
+    ]
+    for p in processes:
+        p.start()
+
+    results = [queue.get(timeout=30) for _ in processes]
+    for p in processes:
+        p.join()
+
+    return results
+
+
+def test_multiprocess_download_deduplicated(tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json", delay=0.5)
+
+    results = run_in_processes(get_data_in_child, [(str(tmpdir), url)] * 4)
+
+    assert results == [{"a": 1, "b": 2, "c": 3}] * 4
+    assert len(feed_server.requests) == 1
+    assert list_cached_files(tmpdir) == [
+        os.path.basename(load_file_cache(tmpdir)[url]["path"]),
+        "file_cache.json",
+    ]
+
+
+def test_multiprocess_index_merged(tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    urls = [
+        feed_server.add_feed_file("/%d.json" % i, "./tests/assets/1.json")
+        for i in range(6)
+    ]
+
+    run_in_processes(get_data_in_child, [(str(tmpdir), url) for url in urls])
+
+    file_cache = load_file_cache(tmpdir)
+    assert sorted(file_cache.keys()) == sorted(urls)
+    assert len(list_cached_files(tmpdir)) == len(urls) + 1
+
+
+def run_in_threads(target, count):
+    """Call target(i) from count threads at once, returning the results or errors."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = target(i)
+        except Exception as ex:
+            results[i] = ex
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    return results
+
+
+def test_threads_share_download(null_logger, tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json", delay=0.3)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    results = run_in_threads(lambda i: udc.get_data_from_url(url), 16)
+
+    assert results == [{"a": 1, "b": 2, "c": 3}] * 16
+    assert len(feed_server.requests) == 1
+    url_stats = udc.stats()["urls"][url]
+    assert url_stats["downloads"] == 1
+    assert url_stats["coalesced_requests"] > 0
+    assert url_stats["misses"] == url_stats["coalesced_requests"] + 1
+    assert len(list_cached_files(tmpdir)) == 2
+
+
+def test_threads_share_download_error(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed("/1.json", "", delay=0.3, failures=[503] * 16)
+
+    udc = USTDownloadCache(null_logger, tmpdir, retries=0)
+    results = run_in_threads(lambda i: udc.get_data_from_url(url), 16)
+
+    assert all(isinstance(result, DownloadError) for result in results)
+    assert len(feed_server.requests) == 1
+
+
+@pytest.mark.parametrize("index_backend", ["json", "sqlite"])
+def test_threads_stress(null_logger, tmpdir, feed_server, monkeypatch, index_backend):
+    now = [1591401600]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    urls = [
+        feed_server.add_feed("/%d.json" % i, feed_json(now[0], 60, {"v": i}))
+        for i in range(4)
+    ]
+
+    udc = USTDownloadCache(
+        null_logger,
+        tmpdir,
+        index_backend=index_backend,
+        freshness_policy=FreshnessPolicy(FETCH_BASIS),
+        max_entries=3,
+    )
+
+    def hammer(thread):
+        for i in range(50):
+            url_number = (thread + i) % len(urls)
+            if thread == 0 and i % 10 == 0:
+                # Expire every cached file
+                now[0] += 61
+            if i % 3 == 0:
+                with udc.get_raw_buffer(urls[url_number]) as view:
+                    assert json.loads(bytes(view))["data"] == {"v": url_number}
+            else:
+                assert udc.get_data_from_url(urls[url_number]) == {"v": url_number}
+
+    with udc:
+        results = run_in_threads(hammer, 8)
+        paths = [os.path.basename(cf.path) for cf in udc.file_cache.values()]
+
+    assert results == [None] * 8
+    # Every replaced or evicted file was removed
+    assert len(paths) == 3
+    assert [f for f in list_cached_files(tmpdir) if "file_cache" not in f] == sorted(
+        paths
+    )
+
+
+def test_save_cache_merges_other_instances(null_logger, tmpdir, feed_server):
+    url1 = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    url2 = feed_server.add_feed_file("/2.json.bz2", "./tests/assets/2.json.bz2")
+
+    udc1 = USTDownloadCache(null_logger, tmpdir)
+    udc2 = USTDownloadCache(null_logger, tmpdir)
+    udc1.get_data_from_url(url1)
+    udc2.get_data_from_url(url2)
+
+    assert sorted(load_file_cache(tmpdir).keys()) == sorted([url1, url2])
+    assert sorted(udc2.file_cache.keys()) == sorted([url1, url2])
+
+
+def test_refreshed_by_other_instance(null_logger, tmpdir, feed_server, monkeypatch):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+
+    udc1 = USTDownloadCache(null_logger, tmpdir)
+    udc2 = USTDownloadCache(null_logger, tmpdir)
+
+    monkeypatch.setattr(CachedFile, "is_expired", True)
+    udc1.get_data_from_url(url)
+    udc2.get_data_from_url(url)
+    assert len(feed_server.requests) == 2
+
+    # udc1's copy of the index still refers to the file udc2 has replaced
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    assert udc1.get_data_from_url(url)["a"] == 1
+    assert udc1.file_cache[url].path == udc2.file_cache[url].path
+    assert len(feed_server.requests) == 2
+
+
+def test_save_cache_is_atomic(null_logger, tmpdir, feed_server, monkeypatch):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+
+    def fail(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(json, "dump", fail)
+    udc.file_cache._dirty_urls.add(url)
+    with pytest.raises(OSError):
+        udc.save_cache()
+
+    assert list(load_file_cache(tmpdir).keys()) == [url]
+
+
+def test_sqlite_index_backend(null_logger, tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+
+    with USTDownloadCache(null_logger, tmpdir, index_backend="sqlite") as udc:
+        udc.get_data_from_url(url)
+
+    with USTDownloadCache(null_logger, tmpdir, index_backend="sqlite") as udc:
+        assert udc.get_data_from_url(url)["a"] == 1
+
+    assert len(feed_server.requests) == 1
+    assert not os.path.exists(tmpdir.join("file_cache.json"))
+
+
+def test_sqlite_index_backend_revalidation(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    monkeypatch.setattr(CachedFile, "is_expired", True)
+    url = feed_server.add_feed_file(
+        "/1.json", "./tests/assets/1.json", headers={"ETag": '"v1"'}
+    )
+
+    with USTDownloadCache(null_logger, tmpdir, index_backend="sqlite") as udc:
+        udc.get_data_from_url(url)
+        path = udc.file_cache[url].path
+        udc.get_data_from_url(url)
+
+        assert udc.file_cache[url].path == path
+        assert udc.file_cache[url].revalidated is not None
+
+
+def test_sqlite_index_backend_migration(null_logger, tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+
+    with USTDownloadCache(null_logger, tmpdir) as udc:
+        udc.get_data_from_url(url)
+
+    with USTDownloadCache(null_logger, tmpdir, index_backend="sqlite") as udc:
+        assert udc.get_data_from_url(url)["a"] == 1
+
+    assert len(feed_server.requests) == 1
+
+
+def get_data_in_child_sqlite(cache_dir, url, barrier, queue):
+    logger = logging.getLogger("cvescan.null")
+    barrier.wait()
+    try:
+        udc = USTDownloadCache(logger, cache_dir, index_backend="sqlite")
+        queue.put(udc.get_data_from_url(url))
+    except Exception as ex:
+        queue.put(ex)
+
+
+def test_sqlite_multiprocess_download_deduplicated(tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json", delay=0.5)
+
+    results = run_in_processes(get_data_in_child_sqlite, [(str(tmpdir), url)] * 4)
+
+    assert results == [{"a": 1, "b": 2, "c": 3}] * 4
+    assert len(feed_server.requests) == 1
+
+
+def feed_json(timestamp, ttl, data):
+    return json.dumps({"metadata": {"timestamp": timestamp, "ttl": ttl}, "data": data})
+
+
+def test_stale_while_revalidate(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 1}))
+
+    udc = USTDownloadCache(null_logger, tmpdir, stale_while_revalidate=60)
+    udc.get_data_from_url(url)
+
+    now += 70
+    feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 2}))
+    assert udc.get_data_from_url(url) == {"v": 1}
+
+    for thread in list(udc._background_refreshes.values()):
+        thread.join()
+
+    assert udc.get_data_from_url(url) == {"v": 2}
+    assert len(feed_server.requests) == 2
+
+
+def test_stale_while_revalidate_too_stale(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 1}))
+
+    udc = USTDownloadCache(null_logger, tmpdir, stale_while_revalidate=60)
+    udc.get_data_from_url(url)
+
+    now += 121
+    feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 2}))
+    assert udc.get_data_from_url(url) == {"v": 2}
+    assert udc._background_refreshes == {}
+
+
+def test_stale_while_revalidate_refresh_fails(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 1}))
+
+    udc = USTDownloadCache(
+        null_logger, tmpdir, stale_while_revalidate=60, backoff_factor=0
+    )
+    udc.get_data_from_url(url)
+
+    now += 70
+    del feed_server.feeds["/a.json"]
+    assert udc.get_data_from_url(url) == {"v": 1}
+
+    for thread in list(udc._background_refreshes.values()):
+        thread.join()
+
+    assert udc.get_data_from_url(url) == {"v": 1}
+
+
+def test_refresh_ahead(null_logger, tmpdir, feed_server):
+    now = int(time.time())
+    # now may be up to a second behind, so allow more than a second before the
+    # refresh is due
+    url = feed_server.add_feed("/a.json", feed_json(now, 3, {"v": 1}))
+
+    with USTDownloadCache(null_logger, tmpdir, refresh_ahead=1.5) as udc:
+        assert udc.get_data_from_url(url) == {"v": 1}
+        feed_server.add_feed("/a.json", feed_json(now + 5, 2, {"v": 2}))
+
+        deadline = time.monotonic() + 5
+        while (
+            udc.get_cache_metadata_from_url(url)["timestamp"] == now
+            and time.monotonic() < deadline
+        ):
+            time.sleep(0.05)
+
+        assert udc.get_data_from_url(url) == {"v": 2}
+        assert len(feed_server.requests) == 2
+
+
+def test_snapshot_built_on_download(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, snapshots=True)
+    udc._get_cached_file_path(url)
+
+    assert list_cached_files(tmpdir) == ["99", "99.snapshot", "file_cache.json"]
+
+
+def test_snapshot_avoids_parsing(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, snapshots=True)
+    udc.get_data_from_url(url)
+
+    udc = USTDownloadCache(null_logger, tmpdir, snapshots=True)
+    udc.file_cache.keys()  # The index is loaded (and parsed) on first use
+    loads = CountingJSONLoads()
+    monkeypatch.setattr(json, "loads", loads)
+
+    assert udc.get_data_from_url(url)["a"] == 1
+    assert udc.get_cache_metadata_from_url(url)["timestamp"] == 1591401600
+    assert loads.count == 0
+
+
+def test_snapshot_rebuilt_if_missing(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    assert list_cached_files(tmpdir) == ["99", "file_cache.json"]
+
+    udc = USTDownloadCache(null_logger, tmpdir, snapshots=True)
+    udc.file_cache.keys()  # The index is loaded (and parsed) on first use
+    loads = CountingJSONLoads()
+    monkeypatch.setattr(json, "loads", loads)
+
+    assert udc.get_data_from_url(url)["a"] == 1
+    assert udc.get_data_from_url(url)["a"] == 1
+    assert loads.count == 1
+    assert list_cached_files(tmpdir) == ["99", "99.snapshot", "file_cache.json"]
+
+
+def test_snapshot_rebuilt_if_stale(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, snapshots=True)
+    udc.get_data_from_url(url)
+
+    # Replace the cached file's contents, as another version of the cache might
+    with open(tmpdir.join("99"), "w") as f:
+        f.write(json.dumps({"metadata": {}, "data": {"a": 2}}))
+
+    assert udc.get_data_from_url(url)["a"] == 2
+
+
+def test_snapshot_removed_with_expired_file(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, snapshots=True)
+    udc.get_data_from_url(url)
+
+    monkeypatch.setattr(CachedFile, "is_expired", True)
+    udc.get_data_from_url(url)
+
+    assert list_cached_files(tmpdir) == ["100", "100.snapshot", "file_cache.json"]
+
+
+def test_snapshot_malformed_file(null_logger, tmpdir, monkeypatch):
+    url = "file:///malformed.json"
+    content = '{"metadata": {"timestamp": 5, "ttl": 6}, "data": {"a": '
+
+    mr = MockResponse(content, 200)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, snapshots=True)
+    with pytest.raises(json.JSONDecodeError):
+        udc.get_data_from_url(url)
+
+    assert list_cached_files(tmpdir) == []
+
+
+def test_get_raw_buffer(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/2.json.bz2")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with udc.get_raw_buffer(url) as buf:
+        assert buf.readonly
+        with open("./tests/assets/2.json.bz2", "rb") as f:
+            assert buf == bz2.decompress(f.read())
+
+        with pytest.raises(TypeError):
+            buf[0] = 0
+
+    with pytest.raises(ValueError):
+        buf.tobytes()
+
+    assert udc._pinned_files == {}
+
+
+def test_get_raw_buffer_defers_removal(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    with udc.get_raw_buffer(url) as buf:
+        with udc.get_raw_buffer(url):
+            monkeypatch.setattr(CachedFile, "is_expired", True)
+            udc.get_data_from_url(url)
+            monkeypatch.setattr(CachedFile, "is_expired", False)
+
+        assert list_cached_files(tmpdir) == ["100", "99", "file_cache.json"]
+        assert json.loads(bytes(buf))["data"]["a"] == 1
+
+    assert list_cached_files(tmpdir) == ["100", "file_cache.json"]
+    assert udc.file_cache[url].path == str(tmpdir.join("100"))
+
+
+def test_get_raw_buffer_slice_kept(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with udc.get_raw_buffer(url) as buf:
+        head = buf[:1]
+
+    assert bytes(head) == b"{"
+    assert udc._pinned_files == {}
+
+
+def test_get_raw_buffer_file_removed(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+
+    # Another process replaces the file
+    other_udc = USTDownloadCache(null_logger, tmpdir)
+    other_udc._refresh_file(url, expires_within=float("inf"))
+    assert list_cached_files(tmpdir) == ["100", "file_cache.json"]
+
+    with udc.get_raw_buffer(url) as buf:
+        assert json.loads(bytes(buf))["data"]["a"] == 1
+
+    assert udc._pinned_files == {}
+
+
+def test_get_data_item(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    assert udc.get_data_item(url, "b") == 2
+    assert list(udc.iter_data_keys(url)) == ["a", "b", "c"]
+    with pytest.raises(KeyError):
+        udc.get_data_item(url, "d")
+
+    assert list_cached_files(tmpdir) == ["99", "99.index", "file_cache.json"]
+
+
+def test_get_data_item_does_not_parse_data(null_logger, tmpdir, monkeypatch):
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file:///large.json"
+    data = {"CVE-%d" % i: {"packages": ["pkg%d" % i] * 10} for i in range(100)}
+
+    mr = MockResponse(feed_json(1591401600, 60, data), 200)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, data_index=True)
+    udc._get_cached_file_path(url)
+
+    parsed = []
+    loads = json.loads
+    monkeypatch.setattr(json, "loads", lambda s, **kw: parsed.append(s) or loads(s))
+
+    assert udc.get_data_item(url, "CVE-42") == {"packages": ["pkg42"] * 10}
+    assert parsed == [json.dumps(data["CVE-42"]).encode()]
+
+
+def test_data_index_built_on_download(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, data_index=True)
+    udc._get_cached_file_path(url)
+
+    assert list_cached_files(tmpdir) == ["99", "99.index", "file_cache.json"]
+
+
+def test_data_index_not_built_without_data(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file:///list.json"
+
+    mr = MockResponse('{"metadata": {"timestamp": 5, "ttl": 6}, "data": []}', 200)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, data_index=True)
+    assert udc.get_data_from_url(url) == []
+    assert list_cached_files(tmpdir) == ["99", "file_cache.json"]
+
+
+def test_data_index_rebuilt_if_stale(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, data_index=True)
+    assert udc.get_data_item(url, "a") == 1
+
+    with open(tmpdir.join("99"), "w") as f:
+        f.write(json.dumps({"metadata": {}, "data": {"a": "changed", "d": 4}}))
+
+    assert udc.get_data_item(url, "a") == "changed"
+    assert list(udc.iter_data_keys(url)) == ["a", "d"]
+
+    udc = USTDownloadCache(null_logger, tmpdir, data_index=True)
+    assert udc.get_data_item(url, "d") == 4
+
+
+def test_data_index_removed_with_expired_file(null_logger, tmpdir, monkeypatch, uuid4):
+    monkeypatch.setattr(uuid, "uuid4", uuid4.get)
+    url = "file://%s" % os.path.abspath("./tests/assets/1.json")
+
+    mr = MockResponse("", 200, url=url)
+    monkeypatch.setattr(requests.Session, "get", lambda *args, **kwargs: mr)
+
+    udc = USTDownloadCache(null_logger, tmpdir, data_index=True)
+    monkeypatch.setattr(CachedFile, "is_expired", False)
+    udc.get_data_item(url, "a")
+
+    monkeypatch.setattr(CachedFile, "is_expired", True)
+    udc.get_data_item(url, "a")
+
+    assert list_cached_files(tmpdir) == ["100", "100.index", "file_cache.json"]
+    assert list(udc._data_indexes) == [str(tmpdir.join("100"))]
+
+
+class MockTime:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def add_feeds(feed_server, now, count, size=0):
+    return [
+        feed_server.add_feed(
+            "/%d.json" % i, feed_json(now, 3600, {"x": "x" * size, "i": i})
+        )
+        for i in range(count)
+    ]
+
+
+def test_max_entries_evicts_least_recently_used(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    mock_time = MockTime(1591401600)
+    monkeypatch.setattr(time, "time", mock_time)
+    urls = add_feeds(feed_server, mock_time.now, 3)
+
+    udc = USTDownloadCache(null_logger, tmpdir, max_entries=2)
+    udc.get_data_from_url(urls[0])
+    mock_time.now += 60
+    udc.get_data_from_url(urls[1])
+    mock_time.now += 60
+    udc.get_data_from_url(urls[0])
+    mock_time.now += 60
+    udc.get_data_from_url(urls[2])
+
+    assert sorted(udc.file_cache.keys()) == [urls[0], urls[2]]
+    assert len(list_cached_files(tmpdir)) == 3
+    assert sorted(load_file_cache(tmpdir)) == [urls[0], urls[2]]
+
+
+def test_eviction_scans_index_only_over_budget(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    mock_time = MockTime(1591401600)
+    monkeypatch.setattr(time, "time", mock_time)
+    urls = add_feeds(feed_server, mock_time.now, 4)
+
+    udc = USTDownloadCache(null_logger, tmpdir, index_backend="sqlite", max_entries=3)
+    scans = []
+    values = udc.file_cache.values
+    monkeypatch.setattr(udc.file_cache, "values", lambda: scans.append(1) or values())
+    for url in urls[:3]:
+        mock_time.now += 60
+        udc.get_data_from_url(url)
+    # Only the first write reads the whole index, to count its entries
+    assert len(scans) == 1
+
+    mock_time.now += 60
+    udc.get_data_from_url(urls[3])
+
+    assert len(scans) == 2
+    assert sorted(udc.file_cache.keys()) == sorted(urls[1:])
+    assert (udc._total_entries, udc._total_size) == (
+        3,
+        sum(cf.size for cf in udc.file_cache.values()),
+    )
+
+
+def test_max_size_evicts_least_recently_used(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    mock_time = MockTime(1591401600)
+    monkeypatch.setattr(time, "time", mock_time)
+    urls = add_feeds(feed_server, mock_time.now, 3, size=1000)
+
+    udc = USTDownloadCache(null_logger, tmpdir, max_size=2500)
+    for url in urls:
+        udc.get_data_from_url(url)
+        mock_time.now += 60
+
+    assert sorted(udc.file_cache.keys()) == [urls[1], urls[2]]
+    assert all(cf.size > 1000 for cf in udc.file_cache.values())
+
+
+def test_access_time_resolution(null_logger, tmpdir, feed_server, monkeypatch):
+    mock_time = MockTime(1591401600)
+    monkeypatch.setattr(time, "time", mock_time)
+    (url,) = add_feeds(feed_server, mock_time.now, 1)
+
+    udc = USTDownloadCache(null_logger, tmpdir, max_entries=10)
+    udc.get_data_from_url(url)
+    mock_time.now += 59
+    udc.get_data_from_url(url)
+    assert udc.file_cache[url].last_access == 1591401600
+
+    mock_time.now += 1
+    udc.get_data_from_url(url)
+    assert udc.file_cache[url].last_access == 1591401660
+
+
+def test_access_time_not_recorded_without_budget(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed("/a.json", feed_json(int(time.time()), 3600, {}))
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    udc.get_data_from_url(url)
+
+    assert udc.file_cache[url].last_access is None
+    assert udc.file_cache[url].size is None
+
+
+def test_eviction_skips_files_being_downloaded(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    mock_time = MockTime(1591401600)
+    monkeypatch.setattr(time, "time", mock_time)
+    urls = add_feeds(feed_server, mock_time.now, 3)
+
+    udc = USTDownloadCache(null_logger, tmpdir, max_entries=1)
+    udc.get_data_from_url(urls[0])
+    with udc._get_download_lock(urls[0]):
+        udc.get_data_from_url(urls[1])
+
+    assert sorted(udc.file_cache.keys()) == [urls[0], urls[1]]
+
+    udc.get_data_from_url(urls[2])
+    assert list(udc.file_cache.keys()) == [urls[2]]
+
+
+def test_gc_removes_expired_files(null_logger, tmpdir, feed_server, monkeypatch):
+    mock_time = MockTime(1591401600)
+    monkeypatch.setattr(time, "time", mock_time)
+    old_url = feed_server.add_feed("/old.json", feed_json(mock_time.now, 60, {}))
+    stale_url = feed_server.add_feed("/stale.json", feed_json(mock_time.now, 100, {}))
+    new_url = feed_server.add_feed("/new.json", feed_json(mock_time.now, 3600, {}))
+
+    udc = USTDownloadCache(null_logger, tmpdir, stale_while_revalidate=30)
+    for url in (old_url, stale_url, new_url):
+        udc.get_data_from_url(url)
+
+    old_path = udc.file_cache[old_url].path
+    mock_time.now += 120
+
+    assert udc.gc() == [old_path]
+    assert sorted(udc.file_cache.keys()) == sorted([stale_url, new_url])
+    assert sorted(load_file_cache(tmpdir)) == sorted([stale_url, new_url])
+    assert not os.path.exists(old_path)
+
+
+def test_gc_enforces_budget(null_logger, tmpdir, feed_server, monkeypatch):
+    mock_time = MockTime(1591401600)
+    monkeypatch.setattr(time, "time", mock_time)
+    urls = add_feeds(feed_server, mock_time.now, 3)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    for url in urls:
+        udc.get_data_from_url(url)
+        mock_time.now += 60
+
+    udc = USTDownloadCache(null_logger, tmpdir, max_entries=1)
+    assert len(udc.gc()) == 2
+    assert len(udc.file_cache) == 1
+
+
+def test_gc_removes_orphaned_files(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed("/a.json", feed_json(int(time.time()), 3600, {}))
+
+    udc = USTDownloadCache(null_logger, tmpdir, snapshots=True)
+    udc.get_data_from_url(url)
+
+    orphans = [str(tmpdir.join(str(uuid.uuid4()) + suffix)) for suffix in ("", ".part")]
+    young_orphan = str(tmpdir.join(str(uuid.uuid4()) + ".part"))
+    unrelated = str(tmpdir.join("notes.txt"))
+    for path in orphans + [young_orphan, unrelated]:
+        with open(path, "w") as f:
+            f.write("orphan")
+
+    for path in orphans:
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+    assert sorted(udc.gc()) == sorted(orphans)
+    assert sorted(list_cached_files(tmpdir)) == sorted(
+        [
+            os.path.basename(udc.file_cache[url].path),
+            os.path.basename(udc.file_cache[url].path) + ".snapshot",
+            os.path.basename(young_orphan),
+            "file_cache.json",
+            "notes.txt",
+        ]
+    )
+    assert udc.gc(orphan_age=0) == [young_orphan]
+
+
+def test_cache_hit_does_not_import_network_modules(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed("/a.json", feed_json(int(time.time()), 3600, {}))
+    with USTDownloadCache(null_logger, tmpdir) as udc:
+        udc.get_data_from_url(url)
+
+    script = """
+import logging, sys
+import ust_download_cache
+udc = ust_download_cache.USTDownloadCache(logging.getLogger(), sys.argv[1])
+udc.get_data_from_url(sys.argv[2])
+print(sorted({"asyncio", "requests", "urllib3"} & set(sys.modules)))
+"""
+    output = subprocess.check_output([sys.executable, "-c", script, str(tmpdir), url])
+    assert output.strip() == b"[]"
+
+
+def test_index_loaded_on_first_use(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed("/a.json", feed_json(int(time.time()), 3600, {}))
+    with USTDownloadCache(null_logger, tmpdir) as udc:
+        udc.get_data_from_url(url)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    assert udc._file_cache is None
+    assert udc._session is None
+
+    udc.get_data_from_url(url)
+    assert udc._file_cache is not None
+    assert udc._session is None
+
+
+def test_stats_hits_misses_expirations(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 1}))
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    udc.get_data_from_url(url)
+    now += 70
+    udc.get_data_from_url(url)
+
+    stats = udc.stats()
+    content_size = len(feed_server.feeds["/a.json"]["content"])
+    assert stats["totals"]["hits"] == 1
+    assert stats["totals"]["misses"] == 2
+    assert stats["totals"]["expirations"] == 1
+    assert stats["totals"]["downloads"] == 2
+    assert stats["totals"]["bytes_downloaded"] == 2 * content_size
+    assert stats["totals"]["bytes_decompressed"] == 2 * content_size
+    timings = stats["urls"][url]["timings"]
+    assert timings["download"]["count"] == 2
+    assert timings["decompress"]["count"] == 2
+    assert timings["parse"]["count"] == 3
+
+
+def test_stats_compressed_file(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/2.json.bz2", "./tests/assets/2.json.bz2")
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+
+    with open("./tests/assets/2.json.bz2", "rb") as f:
+        content = f.read()
+    stats = udc.stats()["urls"][url]
+    assert stats["bytes_downloaded"] == len(content)
+    assert stats["bytes_decompressed"] == len(bz2.decompress(content))
+
+
+def test_stats_stale_hits_and_not_modified(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed(
+        "/a.json", feed_json(now, 60, {"v": 1}), headers={"ETag": '"1"'}
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir, stale_while_revalidate=60)
+    udc.get_data_from_url(url)
+    now += 70
+    udc.get_data_from_url(url)
+    for thread in list(udc._background_refreshes.values()):
+        thread.join()
+
+    stats = udc.stats()["totals"]
+    assert stats["hits"] == 1
+    assert stats["stale_hits"] == 1
+    assert stats["not_modified"] == 1
+    assert stats["downloads"] == 1
+
+
+def test_stats_download_errors(null_logger, tmpdir, feed_server):
+    url = feed_server.url("/missing.json")
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+
+    stats = udc.stats()["urls"][url]
+    assert stats["misses"] == 1
+    assert stats["download_errors"] == 1
+    assert stats["downloads"] == 0
+
+
+def test_stats_evictions(null_logger, tmpdir, feed_server, monkeypatch):
+    mock_time = MockTime(1591401600)
+    monkeypatch.setattr(time, "time", mock_time)
+    urls = add_feeds(feed_server, mock_time.now, 3)
+
+    udc = USTDownloadCache(null_logger, tmpdir, max_entries=2)
+    for url in urls:
+        mock_time.now += ust_download_cache.ACCESS_TIME_RESOLUTION
+        udc.get_data_from_url(url)
+
+    assert udc.stats()["totals"]["evictions"] == 1
+    assert udc.stats()["urls"][urls[0]]["evictions"] == 1
+
+
+def test_stats_span_callback(null_logger, tmpdir, feed_server):
+    spans = []
+    url = feed_server.add_feed("/a.json", feed_json(int(time.time()), 60, {"v": 1}))
+
+    udc = USTDownloadCache(
+        null_logger, tmpdir, span_callback=lambda *args: spans.append(args)
+    )
+    udc.get_data_from_url(url)
+
+    assert [(name, span_url) for name, span_url, *_ in spans] == [
+        ("decompress", url),
+        ("download", url),
+        ("parse", url),
+    ]
+    assert all(error is None for *_, error in spans)
+
+
+def test_export_prometheus(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed("/a.json", feed_json(int(time.time()), 60, {"v": 1}))
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    udc.get_data_from_url(url)
+
+    lines = udc.export_prometheus().splitlines()
+    assert 'ust_download_cache_hits_total{url="%s"} 1' % url in lines
+    assert 'ust_download_cache_misses_total{url="%s"} 1' % url in lines
+    assert 'ust_download_cache_parse_seconds_count{url="%s"} 2' % url in lines
+
+    udc.reset_stats()
+    assert udc.stats()["urls"] == {}
+
+
+def resumable_feed_json(size=10000):
+    return feed_json(int(time.time()), 3600, {"x": "x" * size})
+
+
+def list_partial_downloads(tmpdir):
+    downloads_dir = tmpdir.join(ust_download_cache.PARTIAL_DOWNLOAD_DIR_NAME)
+    return sorted(os.listdir(downloads_dir)) if downloads_dir.exists() else []
+
+
+def test_download_resumed_after_dropped_connection(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    # The bytes of a chunk that is cut short by a dropped connection are lost
+    monkeypatch.setattr(ust_download_cache, "DOWNLOAD_CHUNK_SIZE", 100)
+    content = resumable_feed_json()
+    url = feed_server.add_feed(
+        "/a.json", content, headers={"ETag": '"1"'}, ranges=True, drops=[1000, 500]
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    assert udc.get_data_from_url(url) == json.loads(content)["data"]
+
+    requests = feed_server.requests_for("/a.json")
+    assert len(requests) == 3
+    assert "Range" not in requests[0]["headers"]
+    assert requests[1]["headers"]["Range"] == "bytes=1000-"
+    assert requests[1]["headers"]["If-Range"] == '"1"'
+    assert requests[2]["headers"]["Range"] == "bytes=1500-"
+    assert udc.stats()["totals"]["bytes_downloaded"] == len(content)
+    assert list_partial_downloads(tmpdir) == []
+
+
+def test_compressed_download_resumed(null_logger, tmpdir, feed_server, monkeypatch):
+    # The bytes of a chunk that is cut short by a dropped connection are lost
+    monkeypatch.setattr(ust_download_cache, "DOWNLOAD_CHUNK_SIZE", 100)
+    url = feed_server.add_feed_file(
+        "/2.json.bz2",
+        "./tests/assets/2.json.bz2",
+        headers={"Last-Modified": "Sat, 06 Jun 2020 00:00:00 GMT"},
+        ranges=True,
+        drops=[100],
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with open("./tests/assets/2.json.bz2", "rb") as f:
+        expected = json.loads(bz2.decompress(f.read()))
+
+    assert udc.get_data_from_url(url) == expected["data"]
+    requests = feed_server.requests_for("/2.json.bz2")
+    assert len(requests) == 2
+    assert requests[1]["headers"]["Range"] == "bytes=100-"
+
+
+def test_download_resumed_by_next_call(null_logger, tmpdir, feed_server, monkeypatch):
+    # The bytes of a chunk that is cut short by a dropped connection are lost
+    monkeypatch.setattr(ust_download_cache, "DOWNLOAD_CHUNK_SIZE", 100)
+    content = resumable_feed_json()
+    attempts = ust_download_cache.DOWNLOAD_RESUME_ATTEMPTS + 1
+    url = feed_server.add_feed(
+        "/a.json",
+        content,
+        headers={"ETag": '"1"'},
+        ranges=True,
+        drops=[100] * attempts,
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+
+    assert len(list_partial_downloads(tmpdir)) == 2
+    assert udc.get_data_from_url(url) == json.loads(content)["data"]
+
+    requests = feed_server.requests_for("/a.json")
+    assert len(requests) == attempts + 1
+    assert requests[-1]["headers"]["Range"] == "bytes=%d-" % (100 * attempts)
+    assert list_partial_downloads(tmpdir) == []
+
+
+def test_variant_download_resumed_by_next_call(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    # The bytes of a chunk that is cut short by a dropped connection are lost
+    monkeypatch.setattr(ust_download_cache, "DOWNLOAD_CHUNK_SIZE", 100)
+    # Random data, so that the compressed file is longer than a few chunks
+    content = feed_json(int(time.time()), 3600, {"x": os.urandom(5000).hex()})
+    attempts = ust_download_cache.DOWNLOAD_RESUME_ATTEMPTS + 1
+    url = feed_server.add_feed(
+        "/a.json.gz",
+        gzip.compress(content.encode()),
+        headers={"ETag": '"1"'},
+        ranges=True,
+        drops=[100] * attempts,
+    )[: -len(".gz")]
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.set_variants(url, [".gz"])
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+
+    # Kept under the url of the file, whose download lock is held
+    url_hash = hashlib.sha256(url.encode()).hexdigest()
+    assert list_partial_downloads(tmpdir) == [url_hash, url_hash + ".json"]
+    assert udc.get_data_from_url(url) == json.loads(content)["data"]
+
+    request = feed_server.requests_for("/a.json.gz")[-1]
+    assert request["headers"]["Range"] == "bytes=%d-" % (100 * attempts)
+    assert list_partial_downloads(tmpdir) == []
+
+
+def test_download_restarted_if_file_changed(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    # The bytes of a chunk that is cut short by a dropped connection are lost
+    monkeypatch.setattr(ust_download_cache, "DOWNLOAD_CHUNK_SIZE", 100)
+    attempts = ust_download_cache.DOWNLOAD_RESUME_ATTEMPTS + 1
+    url = feed_server.add_feed(
+        "/a.json",
+        resumable_feed_json(),
+        headers={"ETag": '"1"'},
+        ranges=True,
+        drops=[100] * attempts,
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+
+    content = resumable_feed_json(size=20000)
+    feed_server.add_feed("/a.json", content, headers={"ETag": '"2"'}, ranges=True)
+    assert udc.get_data_from_url(url) == json.loads(content)["data"]
+
+    request = feed_server.requests_for("/a.json")[-1]
+    assert request["headers"]["If-Range"] == '"1"'
+    assert udc.stats()["urls"][url]["bytes_downloaded"] == 100 * attempts + len(content)
+
+
+def test_download_not_resumed_without_range_support(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed(
+        "/a.json", resumable_feed_json(), headers={"ETag": '"1"'}, drops=[100]
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+
+    assert len(feed_server.requests_for("/a.json")) == 1
+    assert list_partial_downloads(tmpdir) == []
+
+
+def test_download_restarted_if_range_not_satisfiable(null_logger, tmpdir, feed_server):
+    content = resumable_feed_json()
+    url = feed_server.add_feed("/a.json", content, headers={"ETag": '"1"'}, ranges=True)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    partial_download = udc._get_partial_download(url)
+    assert partial_download.open(200, {"Accept-Ranges": "bytes", "ETag": '"1"'})
+    list(partial_download.save_chunks([b"x" * (len(content) + 1)]))
+    partial_download.close()
+
+    assert udc.get_data_from_url(url) == json.loads(content)["data"]
+    requests = feed_server.requests_for("/a.json")
+    assert len(requests) == 2
+    assert "Range" not in requests[1]["headers"]
+
+
+def test_gc_removes_abandoned_downloads(null_logger, tmpdir, feed_server, monkeypatch):
+    # The bytes of a chunk that is cut short by a dropped connection are lost
+    monkeypatch.setattr(ust_download_cache, "DOWNLOAD_CHUNK_SIZE", 100)
+    attempts = ust_download_cache.DOWNLOAD_RESUME_ATTEMPTS + 1
+    url = feed_server.add_feed(
+        "/a.json",
+        resumable_feed_json(),
+        headers={"ETag": '"1"'},
+        ranges=True,
+        drops=[100] * attempts,
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+
+    partial_download = udc._get_partial_download(url)
+    assert udc.gc() == []
+
+    with udc._get_download_lock(url):
+        assert udc.gc(orphan_age=0) == []
+
+    assert sorted(udc.gc(orphan_age=0)) == sorted(
+        [partial_download.path, partial_download.state_path]
+    )
+    assert list_partial_downloads(tmpdir) == []
+
+
+def test_deduplicate_links_identical_files(null_logger, tmpdir, feed_server):
+    content = feed_json(int(time.time()), 3600, {"v": 1})
+    url_a = feed_server.add_feed("/a.json", content)
+    url_b = feed_server.add_feed("/mirror/a.json", content)
+
+    udc = USTDownloadCache(null_logger, tmpdir, deduplicate=True)
+    assert udc.get_data_from_url(url_a) == udc.get_data_from_url(url_b) == {"v": 1}
+
+    cached_a, cached_b = udc.file_cache[url_a], udc.file_cache[url_b]
+    content_hash = hashlib.sha256(content.encode()).hexdigest()
+    assert cached_a.content_hash == cached_b.content_hash == content_hash
+    assert cached_a.path != cached_b.path
+    assert os.path.samefile(cached_a.path, cached_b.path)
+    assert os.stat(udc.blob_store.get_blob_path(content_hash)).st_nlink == 3
+    assert udc.stats()["urls"][url_b]["deduplicated"] == 1
+
+
+def test_deduplicate_links_snapshots(null_logger, tmpdir, feed_server, monkeypatch):
+    content = feed_json(int(time.time()), 3600, {"v": 1})
+    url_a = feed_server.add_feed("/a.json", content)
+    url_b = feed_server.add_feed("/mirror/a.json", content)
+
+    udc = USTDownloadCache(null_logger, tmpdir, deduplicate=True, snapshots=True)
+    udc.get_data_from_url(url_a)
+
+    parses = []
+    monkeypatch.setattr(udc, "_parse_document", lambda path: parses.append(path) or {})
+    assert udc.get_data_from_url(url_b) == {"v": 1}
+    assert parses == []
+    assert os.path.samefile(
+        udc.file_cache[url_a].path + ".snapshot",
+        udc.file_cache[url_b].path + ".snapshot",
+    )
+
+
+def test_deduplicate_unchanged_file_not_rewritten(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 1}))
+
+    udc = USTDownloadCache(null_logger, tmpdir, deduplicate=True, snapshots=True)
+    udc.get_data_from_url(url)
+    cached_file = udc.file_cache[url]
+    identity = get_file_identity(cached_file.path)
+    snapshot_identity = get_file_identity(cached_file.path + ".snapshot")
+
+    now += 70
+    assert udc.get_data_from_url(url) == {"v": 1}
+
+    refreshed_file = udc.file_cache[url]
+    assert len(feed_server.requests) == 2
+    assert refreshed_file.path == cached_file.path
+    assert refreshed_file.revalidated == now
+    assert not refreshed_file.is_expired
+    assert get_file_identity(cached_file.path) == identity
+    assert get_file_identity(cached_file.path + ".snapshot") == snapshot_identity
+    assert list_cached_files(tmpdir) == sorted(
+        [
+            ust_download_cache.BLOB_DIR_NAME,
+            os.path.basename(cached_file.path),
+            os.path.basename(cached_file.path) + ".snapshot",
+            "file_cache.json",
+        ]
+    )
+
+
+def test_deduplicate_blob_released_with_last_link(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    content = feed_json(now, 60, {"v": 1})
+    url_a = feed_server.add_feed("/a.json", content)
+    url_b = feed_server.add_feed("/mirror/a.json", content)
+
+    udc = USTDownloadCache(null_logger, tmpdir, deduplicate=True)
+    udc.get_data_from_url(url_a)
+    udc.get_data_from_url(url_b)
+    blob_path = udc.blob_store.get_blob_path(udc.file_cache[url_a].content_hash)
+
+    now += 70
+    feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 2}))
+    feed_server.add_feed("/mirror/a.json", feed_json(now, 60, {"v": 2}))
+    assert udc.get_data_from_url(url_a) == {"v": 2}
+    assert os.path.exists(blob_path)
+
+    assert udc.get_data_from_url(url_b) == {"v": 2}
+    assert not os.path.exists(blob_path)
+    assert os.path.samefile(udc.file_cache[url_a].path, udc.file_cache[url_b].path)
+
+
+def test_deduplicate_blob_released_after_raw_buffer(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 1}))
+
+    udc = USTDownloadCache(null_logger, tmpdir, deduplicate=True)
+    with udc.get_raw_buffer(url):
+        blob_path = udc.blob_store.get_blob_path(udc.file_cache[url].content_hash)
+        now += 70
+        feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 2}))
+        assert udc.get_data_from_url(url) == {"v": 2}
+        assert os.path.exists(blob_path)
+
+    assert not os.path.exists(blob_path)
+
+
+def test_gc_removes_unreferenced_blobs(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed("/a.json", feed_json(int(time.time()), 3600, {}))
+
+    udc = USTDownloadCache(null_logger, tmpdir, deduplicate=True)
+    udc.get_data_from_url(url)
+    blob_path = udc.blob_store.get_blob_path(udc.file_cache[url].content_hash)
+    assert udc.gc() == []
+
+    os.remove(udc.file_cache[url].path)
+    assert udc.gc() == [blob_path]
+
+
+def test_deduplicate_disabled_by_default(null_logger, tmpdir, feed_server):
+    content = feed_json(int(time.time()), 3600, {"v": 1})
+    url_a = feed_server.add_feed("/a.json", content)
+    url_b = feed_server.add_feed("/mirror/a.json", content)
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url_a)
+    udc.get_data_from_url(url_b)
+
+    assert udc.file_cache[url_a].content_hash is None
+    assert not os.path.samefile(udc.file_cache[url_a].path, udc.file_cache[url_b].path)
+    assert not tmpdir.join(ust_download_cache.BLOB_DIR_NAME).exists()
+
+
+def test_parallel_decompression(null_logger, tmpdir, feed_server, monkeypatch):
+    monkeypatch.setattr(parallel_decompression, "MIN_SEGMENT_SIZE", 1)
+    now = int(time.time())
+    document = feed_json(now, 3600, {str(i): "x" * i for i in range(1000)})
+    # A multi-stream archive, like those written by pbzip2
+    archive = b"".join(
+        bz2.compress(document[i:][:10000].encode())
+        for i in range(0, len(document), 10000)
+    )
+    url = feed_server.add_feed("/a.json.bz2", archive)
+
+    with USTDownloadCache(null_logger, tmpdir, decompression_workers=2) as udc:
+        assert udc.get_data_from_url(url) == json.loads(document)["data"]
+        # Forked workers would inherit locks held by other threads
+        executor = udc._decompression_executor
+        assert executor._mp_context.get_start_method() != "fork"
+
+
+def test_parallel_decompression_single_stream(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/2.json.bz2", "./tests/assets/2.json.bz2")
+
+    with USTDownloadCache(null_logger, tmpdir, decompression_workers=2) as udc:
+        with open("./tests/assets/2.json.bz2", "rb") as f:
+            expected = json.loads(bz2.decompress(f.read()))
+
+        assert udc.get_data_from_url(url) == expected["data"]
+
+
+def test_parallel_decompression_disabled_by_default(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/2.json.bz2", "./tests/assets/2.json.bz2")
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+
+    assert udc._decompression_executor is None
+
+
+def test_old_feed_downloaded_on_every_request(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now - 7200, 3600, {"v": 1}))
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.get_data_from_url(url)
+    udc.get_data_from_url(url)
+
+    assert len(feed_server.requests) == 2
+    assert udc.stats()["totals"]["expired_on_arrival"] == 2
+    assert "expires" not in load_file_cache(tmpdir)[url]
+
+
+def test_thrash_guard(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now - 7200, 3600, {"v": 1}))
+
+    policy = FreshnessPolicy(thrash_guard_interval=60)
+    udc = USTDownloadCache(null_logger, tmpdir, freshness_policy=policy)
+    udc.get_data_from_url(url)
+    udc.get_data_from_url(url)
+    assert len(feed_server.requests) == 1
+    assert load_file_cache(tmpdir)[url]["expires"] == now + 60
+
+    now += 60
+    udc.get_data_from_url(url)
+    assert len(feed_server.requests) == 1
+
+    now += 1
+    udc.get_data_from_url(url)
+    assert len(feed_server.requests) == 2
+    assert udc.stats()["totals"]["expired_on_arrival"] == 2
+
+
+def test_freshness_fetch_basis(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now - 7200, 3600, {"v": 1}))
+
+    policy = FreshnessPolicy(FETCH_BASIS)
+    udc = USTDownloadCache(null_logger, tmpdir, freshness_policy=policy)
+    udc.get_data_from_url(url)
+    now += 3600
+    udc.get_data_from_url(url)
+    assert len(feed_server.requests) == 1
+
+    now += 1
+    udc.get_data_from_url(url)
+    assert len(feed_server.requests) == 2
+    assert udc.stats()["totals"]["expired_on_arrival"] == 0
+
+
+def test_freshness_max_age(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed(
+        "/a.json",
+        feed_json(now, 3600, {"v": 1}),
+        headers={"Cache-Control": "max-age=60", "Age": "10"},
+    )
+
+    policy = FreshnessPolicy(use_max_age=True)
+    udc = USTDownloadCache(null_logger, tmpdir, freshness_policy=policy)
+    udc.get_data_from_url(url)
+    assert udc.file_cache[url].expiration_time == now + 50
+
+    now += 51
+    udc.get_data_from_url(url)
+    assert len(feed_server.requests) == 2
+
+
+def test_freshness_applied_when_not_modified(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed(
+        "/a.json",
+        feed_json(now, 60, {"v": 1}),
+        headers={"ETag": '"1"', "Cache-Control": "max-age=600"},
+    )
+
+    policy = FreshnessPolicy(use_max_age=True)
+    udc = USTDownloadCache(null_logger, tmpdir, freshness_policy=policy)
+    udc.get_data_from_url(url)
+    now += 700
+    udc.get_data_from_url(url)
+
+    assert feed_server.requests[-1]["headers"]["If-None-Match"] == '"1"'
+    cache_contents = load_file_cache(tmpdir)[url]
+    assert cache_contents["revalidated"] == now
+    assert cache_contents["expires"] == now + 600
+
+
+def test_freshness_min_refresh_interval(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 10, {"v": 1}))
+
+    policy = FreshnessPolicy(min_refresh_interval=300)
+    udc = USTDownloadCache(null_logger, tmpdir, freshness_policy=policy)
+    udc.get_data_from_url(url)
+    now += 300
+    udc.get_data_from_url(url)
+    assert len(feed_server.requests) == 1
+
+    now += 1
+    udc.get_data_from_url(url)
+    assert len(feed_server.requests) == 2
+
+
+def test_negative_cache(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 1}), failures=[503])
+
+    udc = USTDownloadCache(null_logger, tmpdir, retries=0, negative_ttl=30)
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+    with pytest.raises(DownloadError) as de:
+        udc.get_data_from_url(url)
+
+    assert "failed recently" in str(de.value)
+    assert de.value.status_code == 503
+    assert len(feed_server.requests) == 1
+    assert udc.stats()["totals"]["skipped_downloads"] == 1
+
+    now += 30
+    assert udc.get_data_from_url(url) == {"v": 1}
+    assert len(feed_server.requests) == 2
+
+
+def test_negative_cache_disabled_by_default(null_logger, tmpdir, feed_server):
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json", failures=[503])
+
+    udc = USTDownloadCache(null_logger, tmpdir, retries=0)
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+    udc.get_data_from_url(url)
+
+    assert len(feed_server.requests) == 2
+
+
+def test_expired_file_served_when_refresh_fails(
+    null_logger, tmpdir, feed_server, monkeypatch
+):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    url = feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 1}))
+
+    udc = USTDownloadCache(null_logger, tmpdir, retries=0, negative_ttl=30)
+    udc.get_data_from_url(url)
+    now += 70
+    feed_server.add_feed("/a.json", feed_json(now, 60, {"v": 2}), failures=[503])
+
+    assert udc.get_data_from_url(url) == {"v": 1}
+    assert udc.get_data_from_url(url) == {"v": 1}
+    assert len(feed_server.requests) == 2
+    assert udc.stats()["totals"]["stale_on_error"] == 2
+
+    now += 30
+    assert udc.get_data_from_url(url) == {"v": 2}
+
+
+def test_circuit_breaker(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    # The first two feeds fail once
+    urls = [
+        feed_server.add_feed(
+            "/%d.json" % i, feed_json(now, 60, {"v": i}), failures=[503] * (i < 2)
+        )
+        for i in range(3)
+    ]
+
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    udc = USTDownloadCache(null_logger, tmpdir, retries=0, circuit_breaker=breaker)
+    for url in urls[:2]:
+        with pytest.raises(DownloadError):
+            udc.get_data_from_url(url)
+    with pytest.raises(DownloadError) as de:
+        udc.get_data_from_url(urls[2])
+
+    assert "circuit" in str(de.value)
+    assert len(feed_server.requests) == 2
+
+    now += 60
+    assert udc.get_data_from_url(urls[2]) == {"v": 2}
+    assert udc.get_data_from_url(urls[0]) == {"v": 0}
+    assert breaker.get_state(urlsplit(urls[0]).netloc) == "closed"
+
+
+def test_circuit_breaker_ignores_missing_files(null_logger, tmpdir, feed_server):
+    breaker = CircuitBreaker(failure_threshold=1)
+    udc = USTDownloadCache(null_logger, tmpdir, retries=0, circuit_breaker=breaker)
+    with pytest.raises(DownloadError) as de:
+        udc.get_data_from_url(feed_server.url("/missing.json"))
+
+    assert de.value.status_code == 404
+    url = feed_server.add_feed_file("/1.json", "./tests/assets/1.json")
+    udc.get_data_from_url(url)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_mirrors_failover(null_logger, tmpdir, feed_server):
+    content = feed_json(1591401600, 3600, {"v": 1})
+    mirror_urls = [
+        feed_server.add_feed("/a/feed.json", content, failures=[503]),
+        feed_server.add_feed("/b/feed.json", content),
+    ]
+
+    udc = USTDownloadCache(
+        null_logger, tmpdir, retries=0, mirrors={"feed": mirror_urls}
+    )
+    assert udc.get_data_from_url("feed") == {"v": 1}
+
+    assert [r["path"] for r in feed_server.requests] == ["/a/feed.json", "/b/feed.json"]
+    assert list(load_file_cache(tmpdir)) == ["feed"]
+    # Nothing is left behind by the failed download
+    assert len(list_cached_files(tmpdir)) == 2
+    mirror_stats = udc.mirror_stats()
+    assert mirror_stats[mirror_urls[0]]["failures"] == 1
+    assert mirror_stats[mirror_urls[1]]["downloads"] == 1
+    assert mirror_stats[mirror_urls[1]]["throughput_p50"] > 0
+
+
+def test_mirrors_prefer_healthy_mirror(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    content = feed_json(now, 60, {"v": 1})
+    mirror_urls = [
+        feed_server.add_feed("/a/feed.json", content, failures=[503]),
+        feed_server.add_feed("/b/feed.json", content),
+    ]
+
+    udc = USTDownloadCache(
+        null_logger, tmpdir, retries=0, mirrors={"feed": mirror_urls}
+    )
+    udc.get_data_from_url("feed")
+    now += 70
+    udc.get_data_from_url("feed")
+
+    assert [r["path"] for r in feed_server.requests][2:] == ["/b/feed.json"]
+
+
+def test_mirrors_revalidate(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    content = feed_json(now, 60, {"v": 1})
+    mirror_urls = [
+        feed_server.add_feed(path, content, headers={"ETag": '"x"'})
+        for path in ("/a/feed.json", "/b/feed.json")
+    ]
+
+    udc = USTDownloadCache(null_logger, tmpdir, mirrors={"feed": mirror_urls})
+    assert udc.get_data_from_url("feed") == {"v": 1}
+    path = udc.file_cache["feed"].path
+    now += 70
+    assert udc.get_data_from_url("feed") == {"v": 1}
+
+    assert feed_server.requests[-1]["headers"]["If-None-Match"] == '"x"'
+    assert udc.file_cache["feed"].path == path
+    assert udc.stats()["urls"]["feed"]["not_modified"] == 1
+    assert len(list_cached_files(tmpdir)) == 2
+
+
+def test_mirrors_all_fail(null_logger, tmpdir, feed_server):
+    udc = USTDownloadCache(null_logger, tmpdir, retries=0)
+    udc.set_mirrors(
+        "feed", [feed_server.url("/a/missing.json"), feed_server.url("/b/missing.json")]
+    )
+
+    with pytest.raises(DownloadError) as de:
+        udc.get_data_from_url("feed")
+
+    assert "every mirror" in str(de.value)
+    assert de.value.status_code == 404
+    assert list_cached_files(tmpdir) == []
+
+
+def test_set_mirrors_empty(null_logger, tmpdir):
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(ValueError):
+        udc.set_mirrors("feed", [])
+
+
+def test_mirrors_hedged_request(null_logger, tmpdir, feed_server):
+    content = feed_json(1591401600, 3600, {"v": 1})
+    mirror_urls = [
+        feed_server.add_feed("/a/feed.json", content, delay=2),
+        feed_server.add_feed("/b/feed.json", content),
+    ]
+
+    udc = USTDownloadCache(null_logger, tmpdir, mirrors={"feed": mirror_urls})
+    # Downloads from the first mirror have taken 10ms
+    for _ in range(5):
+        udc.mirror_selector.record_success(mirror_urls[0], 0.005, 0.01, len(content))
+
+    start = time.monotonic()
+    assert udc.get_data_from_url("feed") == {"v": 1}
+
+    assert time.monotonic() - start < 2
+    assert udc.stats()["urls"]["feed"]["hedged_requests"] == 1
+    assert udc.mirror_stats()[mirror_urls[1]]["downloads"] == 1
+    # The slower download is cancelled, and its files are removed
+    wait_for(lambda: len(feed_server.requests) == 2)
+    wait_for(lambda: len(list_cached_files(tmpdir)) == 2)
+    assert udc.mirror_stats()[mirror_urls[0]]["duration_p95"] > 0.01
+
+
+def test_mirrors_hedging_disabled(null_logger, tmpdir, feed_server):
+    content = feed_json(1591401600, 3600, {"v": 1})
+    mirror_urls = [
+        feed_server.add_feed("/a/feed.json", content, delay=0.2),
+        feed_server.add_feed("/b/feed.json", content),
+    ]
+
+    udc = USTDownloadCache(
+        null_logger, tmpdir, mirrors={"feed": mirror_urls}, hedge_requests=False
+    )
+    for _ in range(5):
+        udc.mirror_selector.record_success(mirror_urls[0], 0.005, 0.01, len(content))
+    udc.get_data_from_url("feed")
+
+    assert [r["path"] for r in feed_server.requests] == ["/a/feed.json"]
+    assert udc.stats()["urls"]["feed"]["hedged_requests"] == 0
+
+
+def test_download_xz(null_logger, tmpdir, feed_server):
+    content = feed_json(1591401600, 3600, {"v": "x" * 100000}).encode()
+    url = feed_server.add_feed("/feed.json.xz", lzma.compress(content))
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    assert udc.get_data_from_url(url) == {"v": "x" * 100000}
+    # Extraction speeds are measured to choose between variants
+    assert "xz" in udc.variant_selector.decompression_speeds
+
+
+def add_variant_feeds(feed_server, path, content, suffixes):
+    compressors = {
+        ".xz": lzma.compress,
+        ".bz2": bz2.compress,
+        ".gz": gzip.compress,
+        "": bytes,
+    }
+    for suffix in suffixes:
+        feed_server.add_feed(path + suffix, compressors[suffix](content.encode()))
+
+    return feed_server.url(path)
+
+
+def test_variants_chooses_quickest(null_logger, tmpdir, feed_server):
+    content = feed_json(1591401600, 3600, {"v": "x" * 100000})
+    url = add_variant_feeds(
+        feed_server, "/feed.json", content, [".xz", ".bz2", ".gz", ""]
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir, variants=[url])
+    assert udc.get_data_from_url(url) == {"v": "x" * 100000}
+
+    assert [(r["method"], r["path"]) for r in feed_server.requests] == [
+        ("HEAD", "/feed.json.xz"),
+        ("HEAD", "/feed.json.bz2"),
+        ("HEAD", "/feed.json.gz"),
+        ("HEAD", "/feed.json"),
+        ("GET", "/feed.json.gz"),
+    ]
+    assert list(load_file_cache(tmpdir)) == [url]
+
+
+def test_variants_fast_network(null_logger, tmpdir, feed_server):
+    content = feed_json(1591401600, 3600, {"v": "x" * 100000})
+    url = add_variant_feeds(feed_server, "/feed.json", content, [".bz2", ""])
+
+    udc = USTDownloadCache(null_logger, tmpdir)
+    udc.set_variants(url, [".bz2", ""])
+    udc.variant_selector.bandwidth = 1024**4
+    udc.get_data_from_url(url)
+
+    assert feed_server.requests[-1]["method"] == "GET"
+    assert feed_server.requests[-1]["path"] == "/feed.json"
+
+
+def test_variants_missing(null_logger, tmpdir, feed_server, monkeypatch):
+    now = 1591401600
+    monkeypatch.setattr(time, "time", lambda: now)
+    content = feed_json(now, 60, {"v": 1})
+    url = add_variant_feeds(feed_server, "/feed.json", content, [".bz2"])
+
+    udc = USTDownloadCache(null_logger, tmpdir, variants=[url])
+    assert udc.get_data_from_url(url) == {"v": 1}
+    now += 70
+    assert udc.get_data_from_url(url) == {"v": 1}
+
+    # The variants are only probed once
+    assert [(r["method"], r["path"]) for r in feed_server.requests][4:] == [
+        ("GET", "/feed.json.bz2"),
+        ("GET", "/feed.json.bz2"),
+    ]
+
+
+def test_variants_probed_again_after_failure(null_logger, tmpdir, feed_server):
+    content = feed_json(1591401600, 3600, {"v": 1})
+    url = add_variant_feeds(feed_server, "/feed.json", content, [".gz"])
+    feed_server.add_feed(
+        "/feed.json.gz", gzip.compress(content.encode()), failures=[503]
+    )
+
+    udc = USTDownloadCache(null_logger, tmpdir, retries=0)
+    udc.set_variants(url, [".gz"])
+    with pytest.raises(DownloadError):
+        udc.get_data_from_url(url)
+    assert udc.get_data_from_url(url) == {"v": 1}
+
+    assert [r["method"] for r in feed_server.requests] == ["HEAD", "GET"] * 2
+    assert list_cached_files(tmpdir) != []
+
+
+def test_variants_none_available(null_logger, tmpdir, feed_server):
+    url = feed_server.url("/missing.json")
+
+    udc = USTDownloadCache(null_logger, tmpdir, variants=[url])
+    with pytest.raises(DownloadError) as de:
+        udc.get_data_from_url(url)
+
+    assert "No variant" in str(de.value)
+    assert de.value.status_code == 404
+    assert list_cached_files(tmpdir) == []
+
+
+def test_set_variants_unsupported_suffix(null_logger, tmpdir):
+    udc = USTDownloadCache(null_logger, tmpdir)
+    with pytest.raises(ValueError):
+        udc.set_variants("http://example.com/feed.json", [".zip"])
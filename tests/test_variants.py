@@ -0,0 +1,80 @@
+import pytest
+
+from ust_download_cache.variants import (
+    DEFAULT_BANDWIDTH,
+    MIN_SAMPLE_SIZE,
+    Variant,
+    VariantSelector,
+    estimate_extracted_size,
+)
+
+URL = "http://example.com/feed.json"
+MB = 1024 * 1024
+
+VARIANTS = [
+    Variant(URL + ".xz", "xz", 0.55 * MB),
+    Variant(URL + ".bz2", "bz2", 0.5 * MB),
+    Variant(URL + ".gz", "gz", 1 * MB),
+    Variant(URL, None, 10 * MB),
+]
+
+
+def test_estimate_extracted_size_uncompressed():
+    assert estimate_extracted_size(VARIANTS) == 10 * MB
+
+
+def test_estimate_extracted_size_compressed():
+    variants = [Variant(URL + ".gz", "gz", 1000), Variant(URL + ".bz2", "bz2", 600)]
+
+    assert estimate_extracted_size(variants) == 12000
+
+
+def test_estimate_extracted_size_unknown():
+    assert estimate_extracted_size([Variant(URL, None)]) is None
+
+
+def test_choose_unknown_sizes():
+    variants = [Variant(URL + ".xz", "xz"), Variant(URL, None)]
+
+    assert VariantSelector().choose(variants) is variants[0]
+
+
+def test_choose_default_bandwidth():
+    assert VariantSelector().choose(VARIANTS).compression == "gz"
+
+
+@pytest.mark.parametrize(
+    "bandwidth,compression",
+    [(100 * 1024, "bz2"), (DEFAULT_BANDWIDTH, "gz"), (1024 * MB, None)],
+)
+def test_choose_measured_bandwidth(bandwidth, compression):
+    selector = VariantSelector()
+    selector.record_download(bandwidth, 1.0)
+
+    assert selector.bandwidth == bandwidth
+    assert selector.choose(VARIANTS).compression == compression
+
+
+def test_choose_measured_decompression_speed():
+    selector = VariantSelector()
+    selector.record_decompression("gz", 10 * MB, 1.0)
+
+    assert selector.choose(VARIANTS).compression == "xz"
+
+
+def test_small_samples_ignored():
+    selector = VariantSelector()
+    selector.record_download(MIN_SAMPLE_SIZE - 1, 0.001)
+    selector.record_decompression("gz", MIN_SAMPLE_SIZE - 1, 0.001)
+    selector.record_decompression(None, 10 * MB, 1.0)
+
+    assert selector.bandwidth is None
+    assert selector.decompression_speeds == {}
+
+
+def test_moving_average():
+    selector = VariantSelector()
+    selector.record_download(MB, 1.0)
+    selector.record_download(2 * MB, 1.0)
+
+    assert selector.bandwidth == pytest.approx(1.3 * MB)
@@ -1,7 +1,12 @@
+from .errors import BatchDownloadError  # noqa: F401
 from .errors import BZ2ExtractionError  # noqa: F401
 from .errors import DownloadError  # noqa: F401
 from .errors import FileCacheLoadError  # noqa: F401
 from .errors import GZExtractionError  # noqa: F401
+from .errors import XZExtractionError  # noqa: F401
 
 from .cached_file import CachedFile  # noqa: F401
+from .circuit_breaker import CircuitBreaker  # noqa: F401
+from .freshness import FreshnessPolicy  # noqa: F401
 from .ust_download_cache import USTDownloadCache  # noqa: F401
+from .async_download_cache import AsyncUSTDownloadCache  # noqa: F401
@@ -0,0 +1,42 @@
+class AsyncUSTDownloadCache:
+    """An asyncio front-end for a USTDownloadCache.
+
+    Downloading, extracting and parsing files blocks, so this work is done in an
+    executor (the event loop's default executor unless one is supplied) instead
+    of on the event loop. Concurrent requests for the same url are coalesced:
+    the file is downloaded and parsed once, and every waiting coroutine receives
+    the same objects, which must therefore not be modified.
+    """
+
+    def __init__(self, download_cache, executor=None):
+        self.download_cache = download_cache
+        self.executor = executor
+        self._pending = {}
+
+    async def get_data(self, url):
+        return (await self._get(url))["data"]
+
+    async def get_metadata(self, url):
+        return (await self._get(url))["metadata"]
+
+    async def _get(self, url):
+        # asyncio is imported here, rather than when this module is imported with
+        # the rest of the package, as most users of the package do not need it.
+        import asyncio
+
+        future = self._pending.get(url)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(
+                self.executor, self.download_cache._get_from_url, url
+            )
+            self._pending[url] = future
+            future.add_done_callback(lambda f: self._remove_pending(url, f))
+
+        # Shield the shared future so that cancelling one caller does not cancel
+        # the request for every other caller waiting on the same url.
+        return await asyncio.shield(future)
+
+    def _remove_pending(self, url, future):
+        if self._pending.get(url) is future:
+            del self._pending[url]
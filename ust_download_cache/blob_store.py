@@ -0,0 +1,103 @@
+import functools
+import hashlib
+import os
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    """Return the SHA-256 digest of the file at path, as a hex string."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(functools.partial(f.read, HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+class BlobStore:
+    """Files stored under the hash of their contents and shared with hard links.
+
+    Each cached file whose contents are in the store is a hard link to a blob, so
+    the file system counts the references to each blob: a blob with a link count
+    of 1 is only referenced by the store and can be removed. Files derived from a
+    blob (snapshots and indexes), which are named by appending one of
+    sidecar_suffixes to its path, are linked along with it.
+    """
+
+    def __init__(self, path, sidecar_suffixes=()):
+        self.path = path
+        self.sidecar_suffixes = tuple(sidecar_suffixes)
+
+    def get_blob_path(self, content_hash):
+        return os.path.join(self.path, content_hash)
+
+    def link(self, content_hash, path):
+        """Link path to the blob with content_hash, returning False if there is none.
+
+        Sidecars of the blob are linked to the corresponding sidecars of path.
+        """
+        blob_path = self.get_blob_path(content_hash)
+        try:
+            os.link(blob_path, path)
+        except FileNotFoundError:
+            return False
+
+        for suffix in self.sidecar_suffixes:
+            try:
+                os.link(blob_path + suffix, path + suffix)
+            except FileNotFoundError:
+                pass
+
+        return True
+
+    def add(self, content_hash, path):
+        """Add the file at path, and its sidecars, as the blob with content_hash."""
+        os.makedirs(self.path, exist_ok=True)
+        blob_path = self.get_blob_path(content_hash)
+        try:
+            os.link(path, blob_path)
+        except FileExistsError:
+            # Another process added the same contents first
+            return
+
+        for suffix in self.sidecar_suffixes:
+            try:
+                os.link(path + suffix, blob_path + suffix)
+            except (FileExistsError, FileNotFoundError):
+                pass
+
+    def release(self, content_hash):
+        """Remove the blob with content_hash if no file links to it.
+
+        Returns the paths that were removed.
+        """
+        blob_path = self.get_blob_path(content_hash)
+        try:
+            if os.stat(blob_path).st_nlink > 1:
+                return []
+        except FileNotFoundError:
+            pass
+
+        removed = []
+        for path in (blob_path,) + tuple(blob_path + s for s in self.sidecar_suffixes):
+            try:
+                os.remove(path)
+                removed.append(path)
+            except FileNotFoundError:
+                pass
+
+        return removed
+
+    def remove_unreferenced(self):
+        """Remove every blob that no file links to, returning the removed paths."""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        removed = []
+        for content_hash in sorted(set(name.split(".", 1)[0] for name in names)):
+            removed.extend(self.release(content_hash))
+
+        return removed
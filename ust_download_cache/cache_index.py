@@ -0,0 +1,381 @@
+import json
+import os
+import sqlite3
+import threading
+import weakref
+
+from ust_download_cache import CachedFile, FileCacheLoadError
+from ust_download_cache.file_lock import FileLock
+
+JSON_INDEX_FILE_NAME = "file_cache.json"
+LOCK_FILE_SUFFIX = ".lock"
+MIGRATED_FILE_SUFFIX = ".migrated"
+SQLITE_BUSY_TIMEOUT = 30
+SQLITE_INDEX_FILE_NAME = "file_cache.sqlite3"
+TMP_FILE_SUFFIX = ".tmp"
+
+
+class CacheJSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, CachedFile):
+            return o.to_dict()
+
+        return o
+
+
+class CacheIndex:
+    """Maps urls to the CachedFiles that have been downloaded from them.
+
+    Subclasses store the index somewhere that can be shared by every process that
+    uses the same cache dir. CachedFiles returned by an index may be copies;
+    changes to them must be stored with index[url] = cached_file.
+    """
+
+    def __init__(self, logger, cache_dir):
+        self.logger = logger
+        self.cache_dir = cache_dir
+
+    def get(self, url, default=None):
+        try:
+            return self[url]
+        except KeyError:
+            return default
+
+    def pop(self, url, default=None):
+        cached_file = self.get(url, default)
+        if url in self:
+            del self[url]
+
+        return cached_file
+
+    def reload(self, url):
+        """Return the entry for url as it was last saved by any process."""
+        return self.get(url)
+
+    def touch(self, url, path, last_access):
+        """Set the last access time of the entry for url if it still refers to path.
+
+        Unlike index[url] = cached_file, this never replaces a newer entry for url
+        that another process has stored in the meantime.
+        """
+        cached_file = self.get(url)
+        if cached_file is not None and cached_file.path == path:
+            cached_file.last_access = last_access
+            self[url] = cached_file
+
+    def save(self):
+        """Make changes visible to other processes."""
+
+    def close(self):
+        pass
+
+    def __getitem__(self, url):
+        raise NotImplementedError()
+
+    def __setitem__(self, url, cached_file):
+        raise NotImplementedError()
+
+    def __delitem__(self, url):
+        raise NotImplementedError()
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [url for url, _ in self.items()]
+
+    def values(self):
+        return [cached_file for _, cached_file in self.items()]
+
+    def items(self):
+        raise NotImplementedError()
+
+
+class JSONCacheIndex(CacheIndex):
+    """An index kept in memory and saved to file_cache.json.
+
+    The whole index is loaded when it is created and rewritten by save(). To avoid
+    losing entries saved by other processes, save() reloads the file under a lock
+    and only updates the entries that have changed in this instance.
+    """
+
+    def __init__(self, logger, cache_dir):
+        super().__init__(logger, cache_dir)
+        self.path = os.path.join(cache_dir, JSON_INDEX_FILE_NAME)
+        self._lock = threading.RLock()
+        # URLs whose entries have changed since the index was saved
+        self._dirty_urls = set()
+        # Access times that have not been saved, keyed by url: (path, last_access)
+        self._access_times = {}
+        self._file_cache = self._read()
+
+    def _read(self):
+        file_cache = {}
+
+        if os.path.exists(self.path):
+            self.logger.debug("Loading cache metadata file from %s" % self.path)
+            try:
+                with open(self.path) as cmf:
+                    cache_contents = json.load(cmf)
+                    for url, cached_file in cache_contents.items():
+                        file_cache[url] = CachedFile.from_dict(cached_file)
+            except KeyError as ke:
+                error_msg = "Error loading the file cache from %s" % self.path
+                raise FileCacheLoadError(
+                    "%s: record for %s is missing key %s" % (error_msg, url, ke)
+                )
+            except json.decoder.JSONDecodeError as jde:
+                error_msg = "Error loading the file cache from %s" % self.path
+                raise FileCacheLoadError(
+                    "%s: File contains malformed JSON: %s" % (error_msg, jde)
+                )
+            except Exception as ex:
+                error_msg = "Error loading the file cache from %s" % self.path
+                raise FileCacheLoadError("%s: %s" % (error_msg, ex))
+
+        return file_cache
+
+    def reload(self, url):
+        try:
+            cached_file = self._read().get(url)
+        except FileCacheLoadError as fcle:
+            self.logger.debug("Unable to reload the file cache: %s" % fcle)
+            return self.get(url)
+
+        with self._lock:
+            if url in self._dirty_urls:
+                return self._file_cache.get(url)
+
+            if cached_file is None:
+                self._file_cache.pop(url, None)
+            else:
+                self._file_cache[url] = cached_file
+
+            return cached_file
+
+    def save(self):
+        self.logger.debug("Saving cache metadata to %s" % self.path)
+        with self._lock, FileLock(self.path + LOCK_FILE_SUFFIX):
+            try:
+                file_cache = self._read()
+            except FileCacheLoadError as fcle:
+                self.logger.warning("Overwriting the file cache: %s" % fcle)
+                file_cache = {}
+
+            for url in self._dirty_urls:
+                if url in self._file_cache:
+                    file_cache[url] = self._file_cache[url]
+                else:
+                    file_cache.pop(url, None)
+
+            for url, (path, last_access) in self._access_times.items():
+                cached_file = file_cache.get(url)
+                if cached_file is not None and cached_file.path == path:
+                    cached_file.last_access = max(
+                        cached_file.last_access or 0, last_access
+                    )
+
+            tmp_file = self.path + TMP_FILE_SUFFIX
+            with open(tmp_file, "w") as cmf:
+                json.dump(file_cache, cmf, cls=CacheJSONEncoder, indent=4)
+            os.replace(tmp_file, self.path)
+
+            self._file_cache = file_cache
+            self._dirty_urls.clear()
+            self._access_times.clear()
+
+    def touch(self, url, path, last_access):
+        with self._lock:
+            cached_file = self._file_cache.get(url)
+            if cached_file is not None and cached_file.path == path:
+                cached_file.last_access = last_access
+                self._access_times[url] = (path, last_access)
+
+    def close(self):
+        # Access times are not worth saving the index for on their own, so they are
+        # saved with the next change or when the index is closed
+        with self._lock:
+            if self._access_times:
+                self.save()
+
+    def __getitem__(self, url):
+        return self._file_cache[url]
+
+    def __setitem__(self, url, cached_file):
+        with self._lock:
+            self._file_cache[url] = cached_file
+            self._dirty_urls.add(url)
+
+    def __delitem__(self, url):
+        with self._lock:
+            del self._file_cache[url]
+            self._dirty_urls.add(url)
+
+    def __contains__(self, url):
+        return url in self._file_cache
+
+    def __len__(self):
+        return len(self._file_cache)
+
+    def items(self):
+        with self._lock:
+            return list(self._file_cache.items())
+
+
+class _Connection:
+    """Holds the connection of one thread; sqlite3 connections can't be weakly
+    referenced themselves."""
+
+    __slots__ = ("connection", "__weakref__")
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+class SQLiteCacheIndex(CacheIndex):
+    """An index stored in an SQLite database.
+
+    Entries are read from the database when they are needed and every change is
+    committed immediately, so the cost of an update does not depend on the size
+    of the index and changes are visible to other processes without save(). If
+    a file_cache.json exists, its entries are imported and it is renamed.
+
+    Each thread uses a connection of its own, so that threads reading the index
+    don't wait for each other or for a thread that is writing to it.
+    """
+
+    def __init__(self, logger, cache_dir):
+        super().__init__(logger, cache_dir)
+        self.path = os.path.join(cache_dir, SQLITE_INDEX_FILE_NAME)
+        self._local = threading.local()
+        # Guards the connections, which are closed by close() in any thread
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakSet()
+
+        try:
+            connection = self._get_connection()
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_cache "
+                "(url TEXT PRIMARY KEY, cached_file TEXT NOT NULL)"
+            )
+        except sqlite3.Error as se:
+            raise FileCacheLoadError(
+                "Error loading the file cache from %s: %s" % (self.path, se)
+            )
+
+        self._migrate_json_index()
+
+    def _migrate_json_index(self):
+        json_index_path = os.path.join(self.cache_dir, JSON_INDEX_FILE_NAME)
+        if not os.path.exists(json_index_path):
+            return
+
+        with FileLock(json_index_path + LOCK_FILE_SUFFIX):
+            if not os.path.exists(json_index_path):
+                return
+
+            self.logger.debug(
+                "Migrating the file cache from %s to %s" % (json_index_path, self.path)
+            )
+            json_index = JSONCacheIndex(self.logger, self.cache_dir)
+            connection = self._get_connection()
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.executemany(
+                    "INSERT OR IGNORE INTO file_cache VALUES (?, ?)",
+                    [
+                        (url, json.dumps(cached_file.to_dict()))
+                        for url, cached_file in json_index.items()
+                    ],
+                )
+            os.replace(json_index_path, json_index_path + MIGRATED_FILE_SUFFIX)
+
+    def _get_connection(self):
+        holder = getattr(self._local, "connection", None)
+        if holder is None:
+            # The connection is closed when its thread exits, or by close()
+            holder = _Connection(
+                sqlite3.connect(
+                    self.path,
+                    timeout=SQLITE_BUSY_TIMEOUT,
+                    check_same_thread=False,
+                    isolation_level=None,
+                )
+            )
+            with self._lock:
+                self._connections.add(holder)
+            self._local.connection = holder
+
+        return holder.connection
+
+    def _execute(self, sql, parameters=()):
+        return self._get_connection().execute(sql, parameters).fetchall()
+
+    def touch(self, url, path, last_access):
+        connection = self._get_connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            super().touch(url, path, last_access)
+
+    def close(self):
+        with self._lock:
+            for holder in list(self._connections):
+                holder.connection.close()
+
+    def __getitem__(self, url):
+        rows = self._execute("SELECT cached_file FROM file_cache WHERE url = ?", (url,))
+        if not rows:
+            raise KeyError(url)
+
+        return CachedFile.from_dict(json.loads(rows[0][0]))
+
+    def __setitem__(self, url, cached_file):
+        self._execute(
+            "INSERT OR REPLACE INTO file_cache VALUES (?, ?)",
+            (url, json.dumps(cached_file.to_dict())),
+        )
+
+    def __delitem__(self, url):
+        cursor = self._get_connection().execute(
+            "DELETE FROM file_cache WHERE url = ?", (url,)
+        )
+        if cursor.rowcount == 0:
+            raise KeyError(url)
+
+    def __contains__(self, url):
+        return bool(self._execute("SELECT 1 FROM file_cache WHERE url = ?", (url,)))
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM file_cache")[0][0]
+
+    def items(self):
+        return [
+            (url, CachedFile.from_dict(json.loads(cached_file)))
+            for url, cached_file in self._execute(
+                "SELECT url, cached_file FROM file_cache"
+            )
+        ]
+
+
+INDEX_BACKENDS = {"json": JSONCacheIndex, "sqlite": SQLiteCacheIndex}
+
+
+def create_cache_index(backend, logger, cache_dir):
+    """Create an index; backend is a name from INDEX_BACKENDS or a CacheIndex class"""
+    if isinstance(backend, str):
+        try:
+            backend = INDEX_BACKENDS[backend]
+        except KeyError:
+            raise ValueError(
+                "Unknown index backend %r, expected one of: %s"
+                % (backend, ", ".join(sorted(INDEX_BACKENDS)))
+            )
+
+    return backend(logger, cache_dir)
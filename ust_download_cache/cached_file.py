@@ -1,23 +1,99 @@
 import time
 
+OPTIONAL_FIELDS = (
+    "etag",
+    "last_modified",
+    "revalidated",
+    "size",
+    "last_access",
+    "content_hash",
+    "expires",
+)
+
 
 class CachedFile:
-    def __init__(self, url, path, timestamp, ttl):
+    __slots__ = ("url", "path", "timestamp", "ttl") + OPTIONAL_FIELDS
+
+    def __init__(
+        self,
+        url,
+        path,
+        timestamp,
+        ttl,
+        etag=None,
+        last_modified=None,
+        revalidated=None,
+        size=None,
+        last_access=None,
+        content_hash=None,
+        expires=None,
+    ):
         self.url = url
         self.path = path
         self.timestamp = timestamp
         self.ttl = ttl
+        self.etag = etag
+        self.last_modified = last_modified
+        self.revalidated = revalidated
+        self.size = size
+        self.last_access = last_access
+        self.content_hash = content_hash
+        # Overrides the expiration time computed from timestamp and ttl
+        self.expires = expires
 
     @property
     def is_expired(self):
+        return self.expires_within(0)
+
+    @property
+    def expiration_time(self):
+        if self.expires is not None:
+            return self.expires
+
+        fresh_since = self.timestamp
+        if self.revalidated is not None:
+            fresh_since = max(fresh_since, self.revalidated)
+
+        return fresh_since + self.ttl
+
+    def expires_within(self, seconds):
         now = int(time.time())
-        return (now - self.timestamp) > self.ttl
+        return (now + seconds) > self.expiration_time
+
+    @property
+    def can_revalidate(self):
+        return self.etag is not None or self.last_modified is not None
+
+    def get_validator_headers(self):
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        return headers
+
+    def to_dict(self):
+        cache_dict = {
+            "url": self.url,
+            "path": self.path,
+            "timestamp": self.timestamp,
+            "ttl": self.ttl,
+        }
+        for field in OPTIONAL_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                cache_dict[field] = value
+
+        return cache_dict
 
     @classmethod
     def from_dict(cls, cache_dict):
+        optional_fields = {field: cache_dict.get(field) for field in OPTIONAL_FIELDS}
         return cls(
             cache_dict["url"],
             cache_dict["path"],
             cache_dict["timestamp"],
             cache_dict["ttl"],
+            **optional_fields
         )
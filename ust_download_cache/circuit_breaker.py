@@ -0,0 +1,145 @@
+import threading
+import time
+
+CLOSED = "closed"
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 60
+HALF_OPEN = "half-open"
+# A url that keeps failing is not retried for up to this many times the ttl
+MAX_NEGATIVE_TTL_FACTOR = 8
+OPEN = "open"
+
+
+class _HostState:
+    __slots__ = ("failures", "opened", "trial_started")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self.trial_started = None
+
+
+class CircuitBreaker:
+    """Tracks whether each host that files are downloaded from is healthy.
+
+    A host's circuit opens after failure_threshold consecutive failed downloads,
+    and downloads from the host are refused while it is open. Once it has been
+    open for reset_timeout seconds it is half open: a single trial download is
+    allowed, which closes the circuit if it succeeds and opens it again if it
+    fails. A trial that has not finished within reset_timeout seconds is
+    abandoned and another one is allowed.
+    """
+
+    def __init__(
+        self,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout=DEFAULT_RESET_TIMEOUT,
+    ):
+        if failure_threshold < 1:
+            raise ValueError("failure_threshold must be at least 1")
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get_state(self, host):
+        with self._lock:
+            return self._get_state(self._hosts.get(host), time.time())
+
+    def _get_state(self, host_state, now):
+        if host_state is None or host_state.opened is None:
+            return CLOSED
+
+        if now - host_state.opened < self.reset_timeout:
+            return OPEN
+
+        return HALF_OPEN
+
+    def allow_request(self, host):
+        """Return True if a file may be downloaded from host.
+
+        If the circuit is half open, the caller that is allowed to download a file
+        makes the trial download, and must report its outcome.
+        """
+        now = time.time()
+        with self._lock:
+            host_state = self._hosts.get(host)
+            state = self._get_state(host_state, now)
+            if state == CLOSED:
+                return True
+
+            if state == OPEN:
+                return False
+
+            if (
+                host_state.trial_started is not None
+                and now - host_state.trial_started < self.reset_timeout
+            ):
+                return False
+
+            host_state.trial_started = now
+            return True
+
+    def record_success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def record_failure(self, host):
+        """Record a failed download from host, returning True if the circuit opened.
+
+        A failed trial download opens the circuit again for reset_timeout seconds.
+        """
+        now = time.time()
+        with self._lock:
+            host_state = self._hosts.setdefault(host, _HostState())
+            host_state.failures += 1
+            host_state.trial_started = None
+            if host_state.opened is not None:
+                if self._get_state(host_state, now) == HALF_OPEN:
+                    host_state.opened = now
+
+                return False
+
+            if host_state.failures < self.failure_threshold:
+                return False
+
+            host_state.opened = now
+            return True
+
+
+class NegativeCache:
+    """Remembers the urls that recently failed to download, and why.
+
+    A url that failed is not downloaded again for ttl seconds. The interval
+    doubles with each consecutive failure of the same url, up to max_ttl
+    (MAX_NEGATIVE_TTL_FACTOR times ttl by default).
+    """
+
+    def __init__(self, ttl, max_ttl=None):
+        self.ttl = ttl
+        self.max_ttl = max_ttl if max_ttl is not None else ttl * MAX_NEGATIVE_TTL_FACTOR
+        # url -> (consecutive failures, the time until which it is not retried,
+        # the error it failed with)
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """Return the error that url failed with, if it should not be retried yet."""
+        with self._lock:
+            failure = self._failures.get(url)
+
+        if failure is None or time.time() >= failure[1]:
+            return None
+
+        return failure[2]
+
+    def add(self, url, error):
+        with self._lock:
+            failures = self._failures.get(url, (0,))[0] + 1
+            ttl = min(self.ttl * 2 ** (failures - 1), self.max_ttl)
+            self._failures[url] = (failures, time.time() + ttl, error)
+
+    def remove(self, url):
+        with self._lock:
+            self._failures.pop(url, None)
@@ -0,0 +1,23 @@
+from ust_download_cache.json_scan import find_member, iter_object_members
+
+DATA_INDEX_FILE_SUFFIX = ".index"
+
+
+def get_data_index_path(path):
+    return path + DATA_INDEX_FILE_SUFFIX
+
+
+def build_data_index(buf):
+    """Map each key of the top-level "data" object in buf to its value's offsets.
+
+    Returns a dictionary of key: (value_start, value_end), where
+    buf[value_start:value_end] is the JSON text of the value. Raises KeyError if
+    the document has no "data" member and ValueError if it is malformed or "data"
+    is not an object.
+    """
+    return {
+        key: (value_start, value_end)
+        for key, value_start, value_end in iter_object_members(
+            buf, find_member(buf, "data")
+        )
+    }
@@ -0,0 +1,139 @@
+import bz2
+import zlib
+
+from ust_download_cache import BZ2ExtractionError, GZExtractionError, XZExtractionError
+
+try:
+    import lzma
+except ImportError:
+    # Python can be built without liblzma
+    lzma = None
+
+BZ2_MAGIC_NUMBER = b"BZ"
+GZ_MAGIC_NUMBER = bytes.fromhex("1f8b")
+XZ_MAGIC_NUMBER = bytes.fromhex("fd377a585a00")
+MAX_MAGIC_NUMBER_LENGTH = max(
+    len(BZ2_MAGIC_NUMBER), len(GZ_MAGIC_NUMBER), len(XZ_MAGIC_NUMBER)
+)
+
+
+class StreamDecompressor:
+    """Incrementally decompresses a (possibly multi-stream) archive.
+
+    Subclasses provide _new_decompressor(), which must return an object with the
+    decompress()/eof/unused_data interface of bz2.BZ2Decompressor. When one stream
+    ends and there is more input, a new decompressor is started so that archives
+    created by concatenating several streams are extracted in full.
+    """
+
+    name = None
+    error_class = Exception
+
+    def __init__(self):
+        self._decompressor = None
+
+    def _new_decompressor(self):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        try:
+            return self._decompress(data)
+        except self.error_class:
+            raise
+        except Exception as ex:
+            raise self.error_class(
+                "Error extracting %s archive: %s" % (self.name, ex)
+            ) from ex
+
+    def _decompress(self, data):
+        output = []
+        while data:
+            if self._decompressor is None:
+                data = self._skip_padding(data)
+                if not data:
+                    break
+
+                self._decompressor = self._new_decompressor()
+
+            output.append(self._decompressor.decompress(data))
+
+            data = b""
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                self._decompressor = None
+
+        return b"".join(output)
+
+    def _skip_padding(self, data):
+        """Return data without any padding that precedes the next stream."""
+        return data
+
+    def flush(self):
+        if self._decompressor is not None:
+            raise self.error_class(
+                "Error extracting %s archive: Compressed file ended before the "
+                "end-of-stream marker was reached" % self.name
+            )
+
+        return b""
+
+
+class BZ2StreamDecompressor(StreamDecompressor):
+    name = "bz2"
+    error_class = BZ2ExtractionError
+
+    def _new_decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class GZStreamDecompressor(StreamDecompressor):
+    name = "gz"
+    error_class = GZExtractionError
+
+    def _new_decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _skip_padding(self, data):
+        # gzip(1) tolerates zero padding after the last member; so do we.
+        return data if data.strip(b"\x00") else b""
+
+
+class XZStreamDecompressor(StreamDecompressor):
+    name = "xz"
+    error_class = XZExtractionError
+
+    def _new_decompressor(self):
+        if lzma is None:
+            raise XZExtractionError(
+                "Error extracting xz archive: Python was built without lzma support"
+            )
+
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+    def _skip_padding(self, data):
+        # Streams may be separated and followed by null bytes (stream padding)
+        return data.lstrip(b"\x00")
+
+
+class PassthroughDecompressor:
+    name = None
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+def get_decompressor(header):
+    """Return a decompressor suitable for a file that begins with `header`."""
+    if header.startswith(BZ2_MAGIC_NUMBER):
+        return BZ2StreamDecompressor()
+
+    if header.startswith(GZ_MAGIC_NUMBER):
+        return GZStreamDecompressor()
+
+    if header.startswith(XZ_MAGIC_NUMBER):
+        return XZStreamDecompressor()
+
+    return PassthroughDecompressor()
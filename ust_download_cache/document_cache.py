@@ -0,0 +1,85 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+def get_file_identity(path):
+    """Return a tuple that changes whenever the file at path is replaced."""
+    stat_result = os.stat(path)
+    return (
+        stat_result.st_dev,
+        stat_result.st_ino,
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+    )
+
+
+class DocumentCache:
+    """A least-recently-used cache of parsed JSON documents.
+
+    Documents are keyed by the path of the cached file they were parsed from and
+    are only returned if the identity (device, inode, size and mtime) of that file
+    is unchanged. The size of the source file is used as the cost of holding a
+    document in memory; the least recently used documents are evicted once the
+    total exceeds max_size bytes. A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, path, identity):
+        with self._lock:
+            try:
+                cached_identity, _, document = self._documents[path]
+            except KeyError:
+                return None
+
+            if cached_identity != identity:
+                self._invalidate(path)
+                return None
+
+            self._documents.move_to_end(path)
+            return document
+
+    def put(self, path, identity, document):
+        size = identity[2]
+        with self._lock:
+            self._invalidate(path)
+            if size > self.max_size:
+                return
+
+            self._documents[path] = (identity, size, document)
+            self.size += size
+
+            while self.size > self.max_size:
+                _, (_, evicted_size, _) = self._documents.popitem(last=False)
+                self.size -= evicted_size
+
+    def invalidate(self, path):
+        with self._lock:
+            self._invalidate(path)
+
+    def _invalidate(self, path):
+        try:
+            _, size, _ = self._documents.pop(path)
+            self.size -= size
+        except KeyError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, path):
+        return path in self._documents
@@ -1,9 +1,22 @@
+class BatchDownloadError(Exception):
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+        super().__init__(
+            "Failed to download %d file(s): %s"
+            % (len(errors), ", ".join("%s (%s)" % (u, e) for u, e in errors.items()))
+        )
+
+
 class BZ2ExtractionError(Exception):
     pass
 
 
 class DownloadError(Exception):
-    pass
+    def __init__(self, message, status_code=None):
+        # The HTTP status of the response, if the server responded with an error
+        self.status_code = status_code
+        super().__init__(message)
 
 
 class FileCacheLoadError(Exception):
@@ -12,3 +25,7 @@ class FileCacheLoadError(Exception):
 
 class GZExtractionError(Exception):
     pass
+
+
+class XZExtractionError(Exception):
+    pass
@@ -0,0 +1,97 @@
+import re
+
+FETCH_BASIS = "fetch"
+TIMESTAMP_BASIS = "timestamp"
+
+_MAX_AGE = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)\"?\s*(?:,|$)", re.I)
+
+
+def get_max_age(headers):
+    """Return the freshness lifetime given by a response's headers, or None.
+
+    The lifetime is the Cache-Control max-age, less the response's Age.
+    """
+    if not headers:
+        return None
+
+    match = _MAX_AGE.search(headers.get("Cache-Control", ""))
+    if match is None:
+        return None
+
+    try:
+        age = int(headers.get("Age", 0))
+    except ValueError:
+        age = 0
+
+    return max(0, int(match.group(1)) - max(0, age))
+
+
+class FreshnessPolicy:
+    """Decides when a file that has been downloaded or revalidated expires.
+
+    basis is TIMESTAMP_BASIS to measure a file's ttl from the timestamp in its
+    metadata (or from when it was last revalidated, if that is later), or
+    FETCH_BASIS to measure it from when the file was downloaded or revalidated.
+    If use_max_age is True, a Cache-Control max-age sent with the file replaces
+    its ttl and is measured from when it was fetched. The ttl is then clamped to
+    [min_ttl, max_ttl], and a file never expires less than min_refresh_interval
+    seconds after it was fetched.
+
+    A file that has already expired when it is fetched, e.g. a feed whose
+    timestamp + ttl is already in the past, is downloaded again by every request.
+    If thrash_guard_interval is set, such a file is kept for that many seconds
+    instead. The default policy measures the ttl from the timestamp, like
+    CachedFile.
+    """
+
+    def __init__(
+        self,
+        basis=TIMESTAMP_BASIS,
+        use_max_age=False,
+        min_ttl=None,
+        max_ttl=None,
+        min_refresh_interval=0,
+        thrash_guard_interval=0,
+    ):
+        if basis not in (TIMESTAMP_BASIS, FETCH_BASIS):
+            raise ValueError("Unknown freshness basis: %s" % basis)
+
+        if min_ttl is not None and max_ttl is not None and min_ttl > max_ttl:
+            raise ValueError("min_ttl must not be greater than max_ttl")
+
+        self.basis = basis
+        self.use_max_age = use_max_age
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.thrash_guard_interval = thrash_guard_interval
+
+    def get_expiration_time(self, cached_file, fetched, headers=None):
+        """Return the time at which cached_file, fetched at fetched, expires."""
+        if self.basis == FETCH_BASIS:
+            fresh_since = fetched
+        else:
+            fresh_since = cached_file.timestamp
+            if cached_file.revalidated is not None:
+                fresh_since = max(fresh_since, cached_file.revalidated)
+
+        ttl = cached_file.ttl
+        max_age = get_max_age(headers) if self.use_max_age else None
+        if max_age is not None:
+            fresh_since = fetched
+            ttl = max_age
+
+        if self.min_ttl is not None:
+            ttl = max(ttl, self.min_ttl)
+        if self.max_ttl is not None:
+            ttl = min(ttl, self.max_ttl)
+
+        expiration_time = fresh_since + ttl
+        if self.min_refresh_interval > 0:
+            expiration_time = max(expiration_time, fetched + self.min_refresh_interval)
+
+        return expiration_time
+
+    def is_expired_on_arrival(self, expiration_time, fetched):
+        """Return True if a file that expires at expiration_time was fetched stale."""
+        return expiration_time < fetched
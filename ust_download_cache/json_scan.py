@@ -0,0 +1,147 @@
+"""Locate values inside a JSON document without decoding the whole document.
+
+The functions in this module operate on any bytes-like object that supports the
+buffer protocol (bytes, mmap, memoryview), so large files can be scanned through
+a memory map without being read into memory. Only the values that are asked for
+are decoded with json.loads().
+"""
+import json
+import re
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_SCALAR = re.compile(
+    rb"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?|true|false|null"
+)
+_CONTAINER_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]', re.DOTALL)
+
+_OPENING = frozenset(b"[{")
+_CLOSING = {ord("]"): ord("["), ord("}"): ord("{")}
+
+
+def skip_whitespace(buf, pos):
+    return _WHITESPACE.match(buf, pos).end()
+
+
+def _expect(buf, pos, char):
+    if pos >= len(buf) or buf[pos] != ord(char):
+        raise ValueError("Expected %r at position %d" % (char, pos))
+
+    return pos + 1
+
+
+def skip_string(buf, pos):
+    match = _STRING.match(buf, pos)
+    if match is None:
+        raise ValueError("Expected a string at position %d" % pos)
+
+    return match.end()
+
+
+def skip_container(buf, pos, limit=None):
+    """Return the position immediately after the array/object that starts at pos.
+
+    If limit is given, ValueError is raised if the container is not closed within
+    limit bytes of pos.
+    """
+    endpos = len(buf) if limit is None else min(len(buf), pos + limit)
+    stack = []
+    for match in _CONTAINER_TOKEN.finditer(buf, pos, endpos):
+        token = buf[match.start()]
+        if not stack and match.start() != pos:
+            break
+
+        if token in _OPENING:
+            stack.append(token)
+        elif token in _CLOSING:
+            if not stack or stack.pop() != _CLOSING[token]:
+                break
+
+            if not stack:
+                return match.end()
+
+    raise ValueError("Unterminated or mismatched container at position %d" % pos)
+
+
+def skip_value(buf, pos, limit=None):
+    """Return the position immediately after the JSON value that starts at pos."""
+    if pos >= len(buf):
+        raise ValueError("Expected a value at position %d" % pos)
+
+    if buf[pos] in _OPENING:
+        return skip_container(buf, pos, limit)
+
+    if buf[pos] == ord('"'):
+        return skip_string(buf, pos)
+
+    match = _SCALAR.match(buf, pos)
+    if match is None:
+        raise ValueError("Expected a value at position %d" % pos)
+
+    return match.end()
+
+
+def iter_object_members(buf, pos=0, limit=None):
+    """Yield (key, value_start, value_end) for each member of the object at pos.
+
+    pos may point at leading whitespace. Values are not decoded; buf[value_start:
+    value_end] is the JSON text of each value. Skipping over a value is slower than
+    decoding it with json.loads(), so callers that only need members near the start
+    of the object can pass a limit (see skip_container()) to give up early.
+    """
+    pos = _enter_object(buf, pos)
+    while pos is not None:
+        key, value_start = _read_member_key(buf, pos)
+        value_end = skip_value(buf, value_start, limit)
+
+        yield key, value_start, value_end
+
+        pos = _next_member(buf, value_end)
+
+
+def find_member(buf, name, pos=0):
+    """Return the position of the value of member name of the object at pos.
+
+    Only the values of the members that precede name are skipped. Raises KeyError
+    if the object has no member called name.
+    """
+    pos = _enter_object(buf, pos)
+    while pos is not None:
+        key, value_start = _read_member_key(buf, pos)
+        if key == name:
+            return value_start
+
+        pos = _next_member(buf, skip_value(buf, value_start))
+
+    raise KeyError(name)
+
+
+def _enter_object(buf, pos):
+    # Returns the position of the first member, or None if the object is empty
+    pos = _expect(buf, skip_whitespace(buf, pos), "{")
+    pos = skip_whitespace(buf, pos)
+    if pos < len(buf) and buf[pos] == ord("}"):
+        return None
+
+    return pos
+
+
+def _read_member_key(buf, pos):
+    key_end = skip_string(buf, pos)
+    key = json.loads(bytes(buf[pos:key_end]))
+
+    pos = _expect(buf, skip_whitespace(buf, key_end), ":")
+    return key, skip_whitespace(buf, pos)
+
+
+def _next_member(buf, value_end):
+    # Returns the position of the next member, or None at the end of the object
+    pos = skip_whitespace(buf, value_end)
+    if pos < len(buf) and buf[pos] == ord("}"):
+        return None
+
+    return skip_whitespace(buf, _expect(buf, pos, ","))
+
+
+def decode_value(buf, start, end):
+    return json.loads(bytes(buf[start:end]))
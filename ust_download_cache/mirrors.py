@@ -0,0 +1,144 @@
+import math
+import string
+import threading
+from collections import deque
+
+# The percentile of a mirror's recent download times after which a request to the
+# next mirror is sent
+HEDGE_PERCENTILE = 95
+# Mirrors are not hedged until this many of their downloads have been timed
+MIN_HEDGE_SAMPLES = 5
+# The number of recent downloads from each mirror that are kept
+SAMPLE_WINDOW = 50
+
+
+def get_percentile(values, percentile):
+    """Return the nearest-rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percentile / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def get_attempt_suffix(attempt):
+    """Return the suffix of the file that download attempt number attempt writes to.
+
+    The names of cached files can't contain digits after the uuid, so the digits
+    of attempt are spelled with letters.
+    """
+    return "." + "".join(string.ascii_lowercase[int(digit)] for digit in str(attempt))
+
+
+class _MirrorStats:
+    __slots__ = ("latencies", "durations", "throughputs", "downloads", "failures")
+
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.durations = deque(maxlen=window)
+        self.throughputs = deque(maxlen=window)
+        self.downloads = 0
+        # Consecutive failures
+        self.failures = 0
+
+
+class MirrorSelector:
+    """Tracks how quickly each mirror responds, and chooses which to use first.
+
+    For each mirror url, the latency (the time until the response's headers were
+    received), the duration and the throughput (extracted bytes per second) of the
+    last window downloads are kept. Mirrors are ranked by their median download
+    time. Mirrors that have not been timed yet come after those that have, and
+    mirrors whose last download failed come last.
+    """
+
+    def __init__(self, window=SAMPLE_WINDOW, min_hedge_samples=MIN_HEDGE_SAMPLES):
+        self.window = window
+        self.min_hedge_samples = min_hedge_samples
+        self._mirrors = {}
+        self._lock = threading.Lock()
+
+    def _get_mirror_stats(self, url):
+        mirror_stats = self._mirrors.get(url)
+        if mirror_stats is None:
+            mirror_stats = self._mirrors[url] = _MirrorStats(self.window)
+
+        return mirror_stats
+
+    def rank(self, urls):
+        """Return urls in the order in which they should be tried."""
+        with self._lock:
+            keys = {}
+            for index, url in enumerate(urls):
+                mirror_stats = self._mirrors.get(url)
+                if mirror_stats is None or not mirror_stats.durations:
+                    median = None
+                else:
+                    median = get_percentile(mirror_stats.durations, 50)
+                failed = mirror_stats is not None and mirror_stats.failures > 0
+                keys[url] = (failed, median is None, median or 0, index)
+
+        return sorted(urls, key=keys.get)
+
+    def get_hedge_delay(self, url):
+        """Return how long to wait for url before also trying another mirror.
+
+        Returns None if too few downloads from url have been timed.
+        """
+        with self._lock:
+            mirror_stats = self._mirrors.get(url)
+            if (
+                mirror_stats is None
+                or len(mirror_stats.durations) < self.min_hedge_samples
+            ):
+                return None
+
+            return get_percentile(mirror_stats.durations, HEDGE_PERCENTILE)
+
+    def record_success(self, url, latency, duration=None, size=None):
+        """Record a download from url.
+
+        duration and size are None if the server reported that the file has not
+        been modified, which says nothing about how long downloading it takes.
+        """
+        with self._lock:
+            mirror_stats = self._get_mirror_stats(url)
+            mirror_stats.downloads += 1
+            mirror_stats.failures = 0
+            mirror_stats.latencies.append(latency)
+            if duration is not None:
+                mirror_stats.durations.append(duration)
+                if size is not None and duration > 0:
+                    mirror_stats.throughputs.append(size / duration)
+
+    def record_cancellation(self, url, duration):
+        """Record a download from url that was cancelled after duration seconds.
+
+        Downloads are cancelled when another mirror was faster, so the download
+        would have taken at least this long.
+        """
+        with self._lock:
+            self._get_mirror_stats(url).durations.append(duration)
+
+    def record_failure(self, url):
+        with self._lock:
+            self._get_mirror_stats(url).failures += 1
+
+    def snapshot(self):
+        """Return the recent performance of each mirror as a dictionary."""
+        with self._lock:
+            return {
+                url: {
+                    "downloads": mirror_stats.downloads,
+                    "failures": mirror_stats.failures,
+                    "latency_p50": get_percentile(mirror_stats.latencies, 50),
+                    "latency_p95": get_percentile(mirror_stats.latencies, 95),
+                    "duration_p50": get_percentile(mirror_stats.durations, 50),
+                    "duration_p95": get_percentile(
+                        mirror_stats.durations, HEDGE_PERCENTILE
+                    ),
+                    "throughput_p50": get_percentile(mirror_stats.throughputs, 50),
+                }
+                for url, mirror_stats in self._mirrors.items()
+            }
@@ -0,0 +1,150 @@
+import re
+from collections import deque
+
+from ust_download_cache.decompressors import MAX_MAGIC_NUMBER_LENGTH, get_decompressor
+
+# Streams are only split off once at least this many compressed bytes have been
+# received, so that each task is large enough to be worth sending to a process
+MIN_SEGMENT_SIZE = 1024 * 1024
+# An archive with no stream boundaries in this many bytes is decompressed
+# sequentially, so that single-stream archives are not buffered in memory
+PROBE_LIMIT = 4 * 1024 * 1024
+
+# The byte-aligned start of each stream. These patterns can also occur inside
+# compressed data; a segment split at a false boundary fails to decompress, and
+# the rest of the archive is then decompressed sequentially.
+STREAM_STARTS = {
+    # "BZh", the block size and the magic number of the first block
+    "bz2": re.compile(rb"BZh[1-9]\x31\x41\x59\x26\x53\x59"),
+    # The magic number, deflate, flags without reserved bits, mtime, xfl and os
+    "gz": re.compile(
+        rb"\x1f\x8b\x08[\x00-\x1f].{4}[\x00\x02\x04][\x00-\x0d\xff]", re.S
+    ),
+}
+STREAM_START_LENGTH = 10
+
+
+def decompress_segment(data):
+    """Decompress one or more complete streams. Runs in a worker process."""
+    decompressor = get_decompressor(bytes(data[:MAX_MAGIC_NUMBER_LENGTH]))
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class ParallelStreamDecompressor:
+    """Decompresses the streams of a multi-stream archive in parallel.
+
+    Archives written by parallel compressors (e.g. pbzip2) are a series of
+    independent streams. Compressed data is buffered until the start of a stream
+    is found, and everything before it is decompressed by executor while more data
+    is received. Output is returned in order. Up to max_pending segments are
+    decompressed at once.
+
+    decompressor, a StreamDecompressor for the archive's format, is used instead
+    if no stream boundaries are found, or from the first segment that fails to
+    decompress, which is how corrupt archives report their errors.
+    """
+
+    def __init__(
+        self,
+        decompressor,
+        executor,
+        max_pending,
+        min_segment_size=None,
+        probe_limit=None,
+    ):
+        self.name = decompressor.name
+        self._fallback_decompressor = decompressor
+        self._sequential = None
+        self._stream_start = STREAM_STARTS[decompressor.name]
+        self._executor = executor
+        self._max_pending = max_pending
+        self.min_segment_size = (
+            MIN_SEGMENT_SIZE if min_segment_size is None else min_segment_size
+        )
+        self.probe_limit = PROBE_LIMIT if probe_limit is None else probe_limit
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._pending = deque()
+        self.segments = 0
+
+    def decompress(self, data):
+        if self._sequential is not None:
+            return self._sequential.decompress(data)
+
+        self._buffer += data
+        self._submit_segments()
+
+        if not self.segments and len(self._buffer) > self.probe_limit:
+            return self._fall_back()
+
+        output = []
+        while self._pending and self._sequential is None:
+            if (
+                len(self._pending) <= self._max_pending
+                and not self._pending[0][1].done()
+            ):
+                break
+
+            output.append(self._collect())
+
+        return b"".join(output)
+
+    def flush(self):
+        if self._sequential is None:
+            if not self.segments:
+                # A single stream, or too little data to be worth splitting
+                return self._fall_back() + self._sequential.flush()
+
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+
+        output = []
+        while self._pending and self._sequential is None:
+            output.append(self._collect())
+
+        if self._sequential is not None:
+            output.append(self._sequential.flush())
+
+        return b"".join(output)
+
+    def _submit_segments(self):
+        while True:
+            start = max(self._scanned, self.min_segment_size)
+            match = self._stream_start.search(self._buffer, start)
+            if match is None:
+                self._scanned = max(0, len(self._buffer) - STREAM_START_LENGTH + 1)
+                return
+
+            end = match.start()
+            self._submit(bytes(self._buffer[:end]))
+            del self._buffer[:end]
+            self._scanned = 0
+
+    def _submit(self, segment):
+        self._pending.append(
+            (segment, self._executor.submit(decompress_segment, segment))
+        )
+        self.segments += 1
+
+    def _collect(self):
+        segment, future = self._pending[0]
+        try:
+            output = future.result()
+        except Exception:
+            return self._fall_back()
+
+        self._pending.popleft()
+        return output
+
+    def _fall_back(self):
+        """Decompress the data that has not been decompressed sequentially."""
+        self._sequential = self._fallback_decompressor
+        remaining = [segment for segment, _ in self._pending]
+        remaining.append(bytes(self._buffer))
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._buffer = bytearray()
+
+        return b"".join(self._sequential.decompress(data) for data in remaining)
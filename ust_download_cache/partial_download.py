@@ -0,0 +1,174 @@
+import json
+import os
+import re
+
+STATE_FILE_SUFFIX = ".json"
+STATUS_PARTIAL_CONTENT = 206
+
+_CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+
+
+def get_resume_validator(headers):
+    """Return the validator to send in If-Range when resuming a response.
+
+    Returns None if the response can't be resumed: the server must accept byte
+    ranges and must not have encoded the response (requests decodes it, so the
+    number of bytes received would not be an offset into the response), and an
+    If-Range validator must be a strong ETag or a Last-Modified date.
+    """
+    if headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+
+    if headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None
+
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+
+    return headers.get("Last-Modified")
+
+
+def parse_content_range(value):
+    """Return the first byte position in a Content-Range header."""
+    match = _CONTENT_RANGE.match(value or "")
+    if match is None:
+        raise ValueError("Malformed Content-Range: %r" % value)
+
+    return int(match.group(1))
+
+
+class PartialDownload:
+    """The bytes of an interrupted download, kept so that it can be resumed.
+
+    The bytes received are saved to path exactly as they were sent by the server,
+    and the validator of the version of the file that they belong to is saved
+    alongside them. The download is resumed with a Range request that is
+    conditional on that validator (If-Range), so that if the file has changed the
+    server sends the whole new version rather than the rest of the old one.
+
+    If source_url is given, it is saved with the validator and the bytes are only
+    resumed by a download from the same url, e.g. the same variant of a file.
+
+    A PartialDownload must only be used with the download lock for its url held.
+    """
+
+    def __init__(self, path, source_url=None):
+        self.path = path
+        self.state_path = path + STATE_FILE_SUFFIX
+        self.source_url = source_url
+        self._file = None
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def validator(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state.get("source_url") != self.source_url:
+                return None
+
+            return state["validator"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @property
+    def can_resume(self):
+        return self.validator is not None
+
+    def get_request_headers(self):
+        """Return the headers that request the bytes that have not been saved."""
+        size = self.size
+        validator = self.validator
+        if size == 0 or validator is None:
+            return {}
+
+        return {"Range": "bytes=%d-" % size, "If-Range": validator}
+
+    def open(self, status_code, headers):
+        """Prepare to save the body of a response, returning True if it is saved.
+
+        A partial response must continue the saved bytes, otherwise ValueError is
+        raised. A full response replaces them, and is only saved if it can be
+        resumed.
+        """
+        if status_code == STATUS_PARTIAL_CONTENT:
+            start = parse_content_range(headers.get("Content-Range"))
+            if start != self.size or not self.can_resume:
+                raise ValueError(
+                    "The server sent bytes from %d, but %d bytes are saved"
+                    % (start, self.size)
+                )
+
+            self._file = open(self.path, "ab")
+            return True
+
+        self.remove()
+        validator = get_resume_validator(headers)
+        if validator is None:
+            return False
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.state_path, "w") as f:
+            state = {"validator": validator}
+            if self.source_url is not None:
+                state["source_url"] = self.source_url
+            json.dump(state, f)
+        self._file = open(self.path, "wb")
+        return True
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def iter_saved_chunks(self, chunk_size):
+        """Return an iterator of the bytes saved before the current response."""
+        return self._iter_file_chunks(self._file.tell(), chunk_size)
+
+    def _iter_file_chunks(self, remaining, chunk_size):
+        with open(self.path, "rb") as f:
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+
+                remaining -= len(chunk)
+                yield chunk
+
+    def save_chunks(self, chunks):
+        """Save each chunk of the current response before yielding it."""
+        for chunk in chunks:
+            self._file.write(chunk)
+            self._file.flush()
+            yield chunk
+
+    def get_mtime(self):
+        """Return when the download was last written to, or None if it is absent."""
+        mtimes = []
+        for path in (self.path, self.state_path):
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except FileNotFoundError:
+                pass
+
+        return max(mtimes, default=None)
+
+    def remove(self):
+        """Remove the saved bytes and validator, returning the removed paths."""
+        self.close()
+        removed = []
+        for path in (self.path, self.state_path):
+            try:
+                os.remove(path)
+                removed.append(path)
+            except FileNotFoundError:
+                pass
+
+        return removed
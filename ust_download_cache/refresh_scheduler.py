@@ -0,0 +1,138 @@
+import heapq
+import math
+import threading
+import time
+
+DEFAULT_MIN_REFRESH_INTERVAL = 60
+
+
+class RefreshAheadScheduler:
+    """Refreshes frequently used files shortly before they expire.
+
+    The scheduler keeps a heap of deadlines, lead_time seconds before each file's
+    expiration time, and refreshes files in a background thread as their deadlines
+    pass. Only files that have been requested since they were last refreshed are
+    refreshed; the rest are dropped from the schedule until they are requested
+    again. A file is never refreshed more often than every min_refresh_interval
+    seconds, even if the refreshed file is due to expire sooner than that.
+    """
+
+    def __init__(
+        self,
+        download_cache,
+        lead_time,
+        min_refresh_interval=DEFAULT_MIN_REFRESH_INTERVAL,
+    ):
+        self.download_cache = download_cache
+        self.logger = download_cache.logger
+        self.lead_time = lead_time
+        self.min_refresh_interval = min_refresh_interval
+
+        self._condition = threading.Condition()
+        self._heap = []
+        self._deadlines = {}
+        self._requested = set()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="ust-refresh-ahead", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._condition.notify()
+
+        if thread is not None:
+            thread.join()
+
+    def touch(self, url, cached_file):
+        """Record a request for url, scheduling it for refresh if necessary."""
+        # Most hits find that url has been requested since it was scheduled, and
+        # return without waiting for the lock. If the worker takes url at the same
+        # time, the refresh that it starts covers this request.
+        if url in self._requested and url in self._deadlines:
+            return
+
+        with self._condition:
+            self._requested.add(url)
+            if url not in self._deadlines:
+                self._schedule(url, self._get_deadline(cached_file))
+
+    def _get_deadline(self, cached_file):
+        # CachedFile checks expiration against whole seconds, so this is the first
+        # moment at which expires_within(lead_time) is true
+        return math.floor(cached_file.expiration_time - self.lead_time) + 1
+
+    def _schedule(self, url, deadline):
+        self._deadlines[url] = deadline
+        heapq.heappush(self._heap, (deadline, url))
+        self._condition.notify()
+
+    @property
+    def scheduled(self):
+        with self._condition:
+            return dict(self._deadlines)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                url = self._wait_for_next_deadline()
+                if url is None:
+                    return
+
+            self._refresh(url)
+
+    def _wait_for_next_deadline(self):
+        while not self._stopping:
+            if not self._heap:
+                self._condition.wait()
+                continue
+
+            deadline, url = self._heap[0]
+            if self._deadlines.get(url) != deadline:
+                # Superseded by a later call to _schedule()
+                heapq.heappop(self._heap)
+                continue
+
+            now = time.time()
+            if deadline > now:
+                self._condition.wait(deadline - now)
+                continue
+
+            heapq.heappop(self._heap)
+            del self._deadlines[url]
+            if url in self._requested:
+                self._requested.discard(url)
+                return url
+
+            self.logger.debug("Not refreshing %s, it has not been requested" % url)
+
+        return None
+
+    def _refresh(self, url):
+        self.logger.debug("Refreshing %s ahead of its expiration" % url)
+        try:
+            cached_file = self.download_cache._refresh_file(
+                url, expires_within=self.lead_time
+            )
+        except Exception as ex:
+            self.logger.warning("Refreshing %s ahead of time failed: %s" % (url, ex))
+            cached_file = None
+
+        next_deadline = time.time() + self.min_refresh_interval
+        if cached_file is not None:
+            next_deadline = max(next_deadline, self._get_deadline(cached_file))
+
+        with self._condition:
+            if url not in self._deadlines:
+                self._schedule(url, next_deadline)
@@ -0,0 +1,82 @@
+import marshal
+import os
+import struct
+import sys
+
+SNAPSHOT_FILE_SUFFIX = ".snapshot"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_MAGIC = b"USTSNAP\0"
+TMP_FILE_SUFFIX = ".tmp"
+
+# magic, format version, marshal version, python major and minor version
+_VERSION_TAG = struct.Struct("<8sHHBB")
+# device, inode, size and mtime_ns of the file the snapshot was built from
+_IDENTITY = struct.Struct("<QQQq")
+
+
+def get_snapshot_path(path):
+    return path + SNAPSHOT_FILE_SUFFIX
+
+
+def _get_version_tag():
+    return _VERSION_TAG.pack(
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_FORMAT_VERSION,
+        marshal.version,
+        sys.version_info[0],
+        sys.version_info[1],
+    )
+
+
+def write_snapshot(path, identity, document):
+    """Save a snapshot of document, which was parsed from the file with identity.
+
+    The marshal format is only readable by the Python version that wrote it, so
+    snapshots are tagged with the format, marshal and Python versions and are
+    ignored by read_snapshot() if any of them differ.
+    """
+    tmp_path = path + TMP_FILE_SUFFIX
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(_get_version_tag())
+            f.write(_IDENTITY.pack(*identity))
+            marshal.dump(document, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_snapshot(path, identity):
+    """Return the document saved at path, or None if the snapshot can't be used.
+
+    A snapshot can't be used if it does not exist, was written by a different
+    version, was built from a file other than the one with identity, or is
+    corrupt.
+    """
+    try:
+        with open(path, "rb") as f:
+            contents = f.read()
+    except FileNotFoundError:
+        return None
+
+    version_tag = _get_version_tag()
+    header_size = len(version_tag) + _IDENTITY.size
+    if contents[: len(version_tag)] != version_tag or len(contents) < header_size:
+        return None
+
+    if _IDENTITY.unpack_from(contents, len(version_tag)) != tuple(identity):
+        return None
+
+    try:
+        return marshal.loads(memoryview(contents)[header_size:])
+    except (EOFError, TypeError, ValueError):
+        return None
+
+
+def remove_snapshot(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
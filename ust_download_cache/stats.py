@@ -0,0 +1,263 @@
+import bisect
+import contextlib
+import threading
+import time
+
+COUNTERS = (
+    "hits",
+    "misses",
+    "coalesced_requests",
+    "expirations",
+    "stale_hits",
+    "stale_on_error",
+    "downloads",
+    "download_errors",
+    "skipped_downloads",
+    "hedged_requests",
+    "not_modified",
+    "deduplicated",
+    "expired_on_arrival",
+    "evictions",
+    "bytes_downloaded",
+    "bytes_decompressed",
+)
+TIMINGS = ("download", "decompress", "parse")
+# Upper bounds, in seconds, of the buckets that durations are counted in
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRIC_PREFIX = "ust_download_cache"
+
+_COUNTER_HELP = {
+    "hits": "Requests answered from the cache without waiting for a download",
+    "misses": "Requests that waited for a file to be downloaded",
+    "coalesced_requests": "Misses that waited for another thread's download",
+    "expirations": "Requests that found an expired file in the cache",
+    "stale_hits": "Requests answered with an expired file while it was refreshed",
+    "stale_on_error": "Requests answered with an expired file that failed to refresh",
+    "downloads": "Files downloaded",
+    "download_errors": "Downloads that failed",
+    "skipped_downloads": "Downloads refused because the url or its host failed",
+    "hedged_requests": "Downloads that were also requested from another mirror",
+    "not_modified": "Expired files revalidated without being downloaded again",
+    "deduplicated": "Downloaded files whose contents were already cached",
+    "expired_on_arrival": "Files that had already expired when they were fetched",
+    "evictions": "Files evicted to keep the cache within its budget",
+    "bytes_downloaded": "Bytes received from the server",
+    "bytes_decompressed": "Bytes written to the cache after decompression",
+}
+_TIMING_HELP = {
+    "download": "Time taken to fetch, extract and store a file",
+    "decompress": "Time spent decompressing a file while it was downloaded",
+    "parse": "Time taken to load a cached file",
+}
+
+
+class Histogram:
+    """Counts observations in cumulative buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        """Add the observations counted by other."""
+        for index, count in enumerate(list(other.counts)):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def to_dict(self):
+        cumulative_counts = []
+        total = 0
+        for upper_bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            cumulative_counts.append((upper_bound, total))
+
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative_counts}
+
+
+class _Shard:
+    """The counters and histograms recorded by one thread, keyed by url."""
+
+    __slots__ = ("thread", "generation", "urls")
+
+    def __init__(self, thread, generation):
+        self.thread = thread
+        self.generation = generation
+        self.urls = {}
+
+
+class CacheStats:
+    """Counters and histograms of durations, kept for each url.
+
+    Each thread records into a shard of its own, so that recording doesn't take a
+    lock. The shards are summed by snapshot(), which may miss updates that are
+    being recorded at the same time. The shards of threads that have exited are
+    folded together when another thread records its first update.
+
+    If span_callback is given, it is called as span_callback(name, url, start,
+    duration, error) for each timed operation, where name is one of TIMINGS, start
+    is the time (as returned by time.time()) that the operation started, duration
+    is in seconds and error is the exception that the operation raised, if any.
+    """
+
+    def __init__(self, logger, span_callback=None, buckets=DEFAULT_BUCKETS):
+        self.logger = logger
+        self.span_callback = span_callback
+        self.buckets = buckets
+        # Guards the list of shards and the stats of threads that have exited
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        # Incremented by reset(), which makes every thread start a new shard
+        self._generation = 0
+
+    def _new_url_stats(self):
+        return {
+            "counters": dict.fromkeys(COUNTERS, 0),
+            "timings": {timing: Histogram(self.buckets) for timing in TIMINGS},
+        }
+
+    def _get_url_stats(self, url):
+        shard = getattr(self._local, "shard", None)
+        if shard is None or shard.generation != self._generation:
+            shard = self._add_shard()
+
+        url_stats = shard.urls.get(url)
+        if url_stats is None:
+            url_stats = shard.urls[url] = self._new_url_stats()
+
+        return url_stats
+
+    def _add_shard(self):
+        with self._lock:
+            shards = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    shards.append(shard)
+                else:
+                    self._merge(self._retired, shard.urls)
+
+            shard = _Shard(threading.current_thread(), self._generation)
+            shards.append(shard)
+            self._shards = shards
+
+        self._local.shard = shard
+        return shard
+
+    def _merge(self, target, urls):
+        # Copying with list() doesn't release the GIL, so shards can be read while
+        # their threads update them
+        for url, url_stats in list(urls.items()):
+            target_stats = target.get(url)
+            if target_stats is None:
+                target_stats = target[url] = self._new_url_stats()
+
+            for counter, value in list(url_stats["counters"].items()):
+                target_stats["counters"][counter] += value
+            for timing, histogram in url_stats["timings"].items():
+                target_stats["timings"][timing].merge(histogram)
+
+    def increment(self, url, counter, value=1):
+        self._get_url_stats(url)["counters"][counter] += value
+
+    def observe(self, url, timing, start, duration, error=None):
+        self._get_url_stats(url)["timings"][timing].observe(duration)
+
+        if self.span_callback is not None:
+            try:
+                self.span_callback(timing, url, start, duration, error)
+            except Exception as ex:
+                self.logger.warning("The span callback failed: %s" % ex)
+
+    @contextlib.contextmanager
+    def time(self, url, timing):
+        start = time.time()
+        start_counter = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as ex:
+            error = ex
+            raise
+        finally:
+            self.observe(url, timing, start, time.perf_counter() - start_counter, error)
+
+    def snapshot(self):
+        """Return the counters and histograms as a dictionary.
+
+        "totals" holds the counters summed over every url and "urls" holds the
+        counters and histograms of each url.
+        """
+        merged = {}
+        with self._lock:
+            self._merge(merged, self._retired)
+            for shard in self._shards:
+                self._merge(merged, shard.urls)
+
+        totals = dict.fromkeys(COUNTERS, 0)
+        urls = {}
+        for url, url_stats in merged.items():
+            for counter, value in url_stats["counters"].items():
+                totals[counter] += value
+
+            urls[url] = dict(url_stats["counters"])
+            urls[url]["timings"] = {
+                timing: histogram.to_dict()
+                for timing, histogram in url_stats["timings"].items()
+            }
+
+        return {"totals": totals, "urls": urls}
+
+    def reset(self):
+        with self._lock:
+            self._generation += 1
+            self._shards = []
+            self._retired = {}
+
+
+def _escape_label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_bound(bound):
+    return bound if isinstance(bound, str) else repr(float(bound))
+
+
+def format_prometheus(stats):
+    """Format a CacheStats.snapshot() in the Prometheus text exposition format."""
+    lines = []
+    urls = sorted(stats["urls"].items())
+
+    for counter in COUNTERS:
+        name = "%s_%s_total" % (METRIC_PREFIX, counter)
+        lines.append("# HELP %s %s" % (name, _COUNTER_HELP[counter]))
+        lines.append("# TYPE %s counter" % name)
+        for url, url_stats in urls:
+            lines.append(
+                '%s{url="%s"} %d' % (name, _escape_label_value(url), url_stats[counter])
+            )
+
+    for timing in TIMINGS:
+        name = "%s_%s_seconds" % (METRIC_PREFIX, timing)
+        lines.append("# HELP %s %s" % (name, _TIMING_HELP[timing]))
+        lines.append("# TYPE %s histogram" % name)
+        for url, url_stats in urls:
+            label = 'url="%s"' % _escape_label_value(url)
+            histogram = url_stats["timings"][timing]
+            for bound, count in histogram["buckets"]:
+                lines.append(
+                    '%s_bucket{%s,le="%s"} %d'
+                    % (name, label, _format_bound(bound), count)
+                )
+            lines.append("%s_sum{%s} %r" % (name, label, histogram["sum"]))
+            lines.append("%s_count{%s} %d" % (name, label, histogram["count"]))
+
+    return "\n".join(lines) + "\n"
@@ -1,44 +1,314 @@
-import bz2
-import gzip
+import contextlib
+import hashlib
+import itertools
 import json
+import mmap
 import os
+import re
+import threading
+import time
 import uuid
-from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
 
-import requests
-
-from ust_download_cache import (
-    BZ2ExtractionError,
-    CachedFile,
-    DownloadError,
-    FileCacheLoadError,
-    GZExtractionError,
+from ust_download_cache import BatchDownloadError, CachedFile, DownloadError
+from ust_download_cache.blob_store import BlobStore, hash_file
+from ust_download_cache.cache_index import create_cache_index
+from ust_download_cache.circuit_breaker import NegativeCache
+from ust_download_cache.data_index import (
+    DATA_INDEX_FILE_SUFFIX,
+    build_data_index,
+    get_data_index_path,
 )
+from ust_download_cache.decompressors import MAX_MAGIC_NUMBER_LENGTH, get_decompressor
+from ust_download_cache.document_cache import DocumentCache, get_file_identity
+from ust_download_cache.file_lock import FileLock
+from ust_download_cache.freshness import FreshnessPolicy
+from ust_download_cache.json_scan import decode_value, iter_object_members
+from ust_download_cache.mirrors import MirrorSelector, get_attempt_suffix
+from ust_download_cache.parallel_decompression import (
+    STREAM_STARTS,
+    ParallelStreamDecompressor,
+)
+from ust_download_cache.partial_download import PartialDownload
+from ust_download_cache.refresh_scheduler import RefreshAheadScheduler
+from ust_download_cache.single_flight import SingleFlight
+from ust_download_cache.snapshot import (
+    SNAPSHOT_FILE_SUFFIX,
+    get_snapshot_path,
+    read_snapshot,
+    remove_snapshot,
+    write_snapshot,
+)
+from ust_download_cache.stats import CacheStats, format_prometheus
+from ust_download_cache.variants import VARIANT_COMPRESSIONS, Variant, VariantSelector
 
-
-class CacheJSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, CachedFile):
-            return o.__dict__
-
-        return o
+# Access times are only updated once they are this many seconds old, so that
+# every cache hit does not write to the index
+ACCESS_TIME_RESOLUTION = 60
+BLOB_DIR_NAME = "blobs"
+# The names of the files that USTDownloadCache creates in the cache dir
+CACHE_FILE_NAME = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(\.[a-z.]+)?$"
+)
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_INDEX_BACKEND = "json"
+DEFAULT_MAX_WORKERS = 4
+# Unreferenced files younger than this may belong to a download in progress
+DEFAULT_ORPHAN_AGE = 60 * 60
+# The number of requests for a file that are sent to different mirrors at once
+MAX_MIRROR_REQUESTS = 2
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+# (connect, read) timeouts in seconds. The read timeout applies to each read
+# from the socket, not to the download as a whole.
+DEFAULT_TIMEOUT = (10, 60)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# The number of times a download whose connection is dropped is resumed before
+# giving up. The bytes received are kept, so the next attempt resumes it too.
+DOWNLOAD_RESUME_ATTEMPTS = 3
+LOCK_DIR_NAME = "locks"
+LOCK_FILE_SUFFIX = ".lock"
+METADATA_SCAN_LIMIT = 64 * 1024
+# Appended to the file that a download from a mirror is written to, for the bytes
+# that are kept so that it can be resumed
+MIRROR_PARTIAL_DOWNLOAD_SUFFIX = ".raw"
+PARTIAL_DOWNLOAD_DIR_NAME = "downloads"
+PARTIAL_FILE_SUFFIX = ".part"
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+STATUS_NOT_MODIFIED = 304
+STATUS_RANGE_NOT_SATISFIABLE = 416
 
 
 class USTDownloadCache:
-    def __init__(self, logger, cache_dir=None):
+    def __init__(
+        self,
+        logger,
+        cache_dir=None,
+        memory_cache_size=0,
+        index_backend=DEFAULT_INDEX_BACKEND,
+        session=None,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        backoff_factor=DEFAULT_BACKOFF_FACTOR,
+        pool_size=DEFAULT_POOL_SIZE,
+        stale_while_revalidate=0,
+        refresh_ahead=None,
+        snapshots=False,
+        data_index=False,
+        max_size=None,
+        max_entries=None,
+        span_callback=None,
+        deduplicate=False,
+        decompression_workers=None,
+        freshness_policy=None,
+        negative_ttl=0,
+        circuit_breaker=None,
+        mirrors=None,
+        hedge_requests=True,
+        variants=None,
+    ):
         self.logger = logger
         self.logger.debug("Initializing USTDownloadCache")
 
         self.cache_dir = cache_dir if cache_dir else self._get_cache_dir()
         self.cache_metadata_file = os.path.join(self.cache_dir, "file_cache.json")
+        self.lock_dir = os.path.join(self.cache_dir, LOCK_DIR_NAME)
+        self.partial_download_dir = os.path.join(
+            self.cache_dir, PARTIAL_DOWNLOAD_DIR_NAME
+        )
         self._try_create_cache_dir()
+        self.document_cache = DocumentCache(memory_cache_size)
+        self.snapshots = snapshots
+        self.data_index = data_index
+        self.max_size = max_size
+        self.max_entries = max_entries
+        # Running totals of the size and number of cached files, kept once the
+        # index has been scanned by _evict() so that writes don't have to scan it
+        self._total_size = None
+        self._total_entries = None
+        self.deduplicate = deduplicate
+        self.blob_store = BlobStore(
+            os.path.join(self.cache_dir, BLOB_DIR_NAME),
+            (SNAPSHOT_FILE_SUFFIX, DATA_INDEX_FILE_SUFFIX),
+        )
+        # Offsets of the members of each cached file's "data" object, keyed by path
+        self._data_indexes = {}
+        # Guards file_cache. Files are downloaded without holding this lock, so
+        # that different files can be downloaded by several threads at once.
+        self._index_lock = threading.RLock()
+        # Threads in this process that need the same file share one refresh of it
+        self._refreshes = SingleFlight()
+        # The number of open raw buffers for each path, and the pinned paths
+        # that will be removed once their last buffer is closed, with the content
+        # hashes of their blobs
+        self._pinned_files = {}
+        self._deferred_removals = {}
+        self._stats = CacheStats(logger, span_callback)
+
+        # The index and the session are created when they are first used, so that
+        # short-lived processes that only read fresh files don't pay for loading
+        # the index of every file, or for importing requests.
+        self.index_backend = index_backend
+        self._file_cache = None
+        self.timeout = timeout
+        self._session = session
+        # Multi-stream archives are decompressed in a pool of this many processes,
+        # which is created when it is first needed
+        self.decompression_workers = decompression_workers
+        self._decompression_executor = None
+        self._session_options = (retries, backoff_factor, pool_size)
+
+        self.freshness_policy = (
+            freshness_policy if freshness_policy is not None else FreshnessPolicy()
+        )
+        # Failed downloads are not retried for negative_ttl seconds, and hosts
+        # whose circuit is open are not contacted. Either enables serving expired
+        # files when they can't be refreshed.
+        self.negative_cache = NegativeCache(negative_ttl) if negative_ttl > 0 else None
+        self.circuit_breaker = circuit_breaker
+        # Maps keys, which are requested like urls, to the urls of their mirrors
+        self.mirrors = {}
+        for key, mirror_urls in (mirrors or {}).items():
+            self.set_mirrors(key, mirror_urls)
+        self.hedge_requests = hedge_requests
+        self.mirror_selector = MirrorSelector()
+        self.variant_selector = VariantSelector()
+        self._probed_variants = {}
+        # Maps base urls to the suffixes of the variants that they are fetched from
+        self.variants = {}
+        for base_url in variants or ():
+            self.set_variants(base_url)
+        self.stale_while_revalidate = stale_while_revalidate
+        self._background_refreshes = {}
+        self.refresh_scheduler = None
+        if refresh_ahead is not None:
+            self.refresh_scheduler = RefreshAheadScheduler(self, refresh_ahead)
+            self.refresh_scheduler.start()
 
-        self._load_file_cache()
+    def close(self):
+        if self.refresh_scheduler is not None:
+            self.refresh_scheduler.stop()
+
+        if self._session is not None:
+            self._session.close()
+        if self._decompression_executor is not None:
+            self._decompression_executor.shutdown()
+        if self._file_cache is not None:
+            self._file_cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def save_cache(self):
-        self.logger.debug("Saving cache metadata to %s" % self.cache_metadata_file)
-        with open(self.cache_metadata_file, "w") as cmf:
-            json.dump(self.file_cache, cmf, cls=CacheJSONEncoder, indent=4)
+        self.file_cache.save()
+
+    def stats(self):
+        """Return the cache's counters and duration histograms.
+
+        See CacheStats.snapshot() for the layout of the returned dictionary.
+        """
+        return self._stats.snapshot()
+
+    def export_prometheus(self):
+        return format_prometheus(self.stats())
+
+    def reset_stats(self):
+        self._stats.reset()
+
+    def set_mirrors(self, key, mirror_urls):
+        """Fetch the file requested as key from any of mirror_urls.
+
+        The file is cached under key, which is passed to get_data_from_url() and
+        the other methods in place of a url.
+        """
+        if not mirror_urls:
+            raise ValueError("No mirrors were given for %s" % key)
+
+        self.mirrors[key] = list(mirror_urls)
+
+    def set_variants(self, base_url, suffixes=None):
+        """Fetch base_url from whichever of its variants is expected to be quickest.
+
+        Each of suffixes (by default, ".xz", ".bz2", ".gz" and "", the uncompressed
+        file) is appended to base_url to give the url of a variant. The file is
+        cached under base_url.
+        """
+        if suffixes is None:
+            suffixes = [suffix for suffix, _ in VARIANT_COMPRESSIONS]
+
+        compressions = dict(VARIANT_COMPRESSIONS)
+        for suffix in suffixes:
+            if suffix not in compressions:
+                raise ValueError("Unsupported variant suffix: %s" % suffix)
+
+        self.variants[base_url] = list(suffixes)
+        with self._index_lock:
+            self._probed_variants.pop(base_url, None)
+
+    def mirror_stats(self):
+        """Return the recent latency and throughput of each mirror.
+
+        See MirrorSelector.snapshot() for the layout of the returned dictionary.
+        """
+        return self.mirror_selector.snapshot()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._index_lock:
+                if self._session is None:
+                    self._session = self._create_session(*self._session_options)
+
+        return self._session
+
+    @property
+    def decompression_executor(self):
+        if self._decompression_executor is None:
+            with self._index_lock:
+                if self._decompression_executor is None:
+                    # Imported here as they import multiprocessing, which most
+                    # processes never need
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+
+                    # The pool is created while other threads may hold locks,
+                    # which would stay locked in processes forked from this one
+                    start_method = "spawn"
+                    if "forkserver" in multiprocessing.get_all_start_methods():
+                        start_method = "forkserver"
+                    self._decompression_executor = ProcessPoolExecutor(
+                        self.decompression_workers,
+                        mp_context=multiprocessing.get_context(start_method),
+                    )
+
+        return self._decompression_executor
+
+    @staticmethod
+    def _create_session(retries, backoff_factor, pool_size):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
 
     def _get_cache_dir(self):
         cache_dir = ".ust_cache"
@@ -66,39 +336,32 @@ class USTDownloadCache:
         self.logger.debug(
             "The cache dir (%s) does not exist, creating now" % self.cache_dir
         )
-        Path(self.cache_dir).mkdir(parents=True)
+        os.makedirs(self.cache_dir)
+
+    @property
+    def file_cache(self):
+        if self._file_cache is None:
+            with self._index_lock:
+                if self._file_cache is None:
+                    self._load_file_cache()
+
+        return self._file_cache
 
     def _load_file_cache(self):
-        self.file_cache = {}
+        self._file_cache = create_cache_index(
+            self.index_backend, self.logger, self.cache_dir
+        )
 
-        if os.path.exists(self.cache_metadata_file):
-            self.logger.debug(
-                "Loading cache metadata file from %s" % self.cache_metadata_file
-            )
-            try:
-                with open(self.cache_metadata_file) as cmf:
-                    cache_contents = json.load(cmf)
-                    for url, cached_file in cache_contents.items():
-                        self.file_cache[url] = CachedFile.from_dict(cached_file)
-            except KeyError as ke:
-                error_msg = (
-                    "Error loading the file cache from %s" % self.cache_metadata_file
-                )
-                raise FileCacheLoadError(
-                    "%s: record for %s is missing key %s" % (error_msg, url, ke)
-                )
-            except json.decoder.JSONDecodeError as jde:
-                error_msg = (
-                    "Error loading the file cache from %s" % self.cache_metadata_file
-                )
-                raise FileCacheLoadError(
-                    "%s: File contains malformed JSON: %s" % (error_msg, jde)
-                )
-            except Exception as ex:
-                error_msg = (
-                    "Error loading the file cache from %s" % self.cache_metadata_file
-                )
-                raise FileCacheLoadError("%s: %s" % (error_msg, ex))
+    def _get_download_lock(self, url):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        url_hash = hashlib.sha256(url.encode()).hexdigest()
+        return FileLock(os.path.join(self.lock_dir, url_hash + LOCK_FILE_SUFFIX))
+
+    def _get_partial_download(self, url, source_url=None):
+        url_hash = hashlib.sha256(url.encode()).hexdigest()
+        return PartialDownload(
+            os.path.join(self.partial_download_dir, url_hash), source_url
+        )
 
     def get_data_from_url(self, url):
         return self._get_from_url(url)["data"]
@@ -106,121 +369,1321 @@ class USTDownloadCache:
     def get_cache_metadata_from_url(self, url):
         return self._get_from_url(url)["metadata"]
 
+    @contextlib.contextmanager
+    def get_raw_buffer(self, url):
+        """Map the (extracted) cached file for url into memory.
+
+        This is a context manager that yields a read-only memoryview of the file,
+        which can be read without copying it. The file is not removed by this
+        USTDownloadCache, even if it expires and is replaced, until the with block
+        exits. The memoryview is released when the with block exits. Slices of it
+        that are kept keep the file mapped until they are released, but the file is
+        no longer protected from removal.
+        """
+        with self._map_cached_file(url) as (_, view):
+            yield view
+
+    @contextlib.contextmanager
+    def _map_cached_file(self, url):
+        path = self._pin_cached_file(url)
+        try:
+            with open(path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            view = memoryview(buf)
+            try:
+                yield path, view
+            finally:
+                try:
+                    view.release()
+                    buf.close()
+                except BufferError:
+                    # The caller kept a slice of the view. The file is unmapped
+                    # when the last slice is garbage collected.
+                    pass
+        finally:
+            self._unpin_file(path)
+
+    def _pin_cached_file(self, url):
+        path = self._get_cached_file_path(url)
+        if self._try_pin_file(path):
+            return path
+
+        self.logger.debug("The cached file for %s was removed, retrying" % url)
+        with self._index_lock:
+            self.file_cache.reload(url)
+
+        path = self._get_cached_file_path(url)
+        if self._try_pin_file(path):
+            return path
+
+        raise FileNotFoundError("The cached file %s was removed" % path)
+
+    def _try_pin_file(self, path):
+        # Files are removed with the index lock held, so a file that exists while
+        # it is held can be pinned before it is removed.
+        with self._index_lock:
+            if not os.path.exists(path):
+                return False
+
+            self._pinned_files[path] = self._pinned_files.get(path, 0) + 1
+            return True
+
+    def _unpin_file(self, path):
+        with self._index_lock:
+            self._pinned_files[path] -= 1
+            if self._pinned_files[path] > 0:
+                return
+
+            del self._pinned_files[path]
+            if path in self._deferred_removals:
+                self._release_file(path, self._deferred_removals.pop(path))
+
+    def get_data_item(self, url, key):
+        """Return the value of key in the data from url.
+
+        Only the requested value is decoded, using an index of the offsets of the
+        values in the data that is built the first time it is needed (or when the
+        file is downloaded, if data_index is set) and saved next to the cached
+        file. Raises KeyError if the data does not contain key.
+        """
+        with self._map_cached_file(url) as (path, buf):
+            value_start, value_end = self._get_data_index(path, buf)[key]
+            return decode_value(buf, value_start, value_end)
+
+    def iter_data_keys(self, url):
+        """Return an iterator over the keys in the data from url."""
+        with self._map_cached_file(url) as (path, buf):
+            return iter(list(self._get_data_index(path, buf)))
+
+    def _get_data_index(self, path, buf):
+        identity = get_file_identity(path)
+        # Looking up a dict is atomic, and an index is only used if the file is
+        # unchanged, so this doesn't need the index lock
+        cached_index = self._data_indexes.get(path)
+        if cached_index is not None and cached_index[0] == identity:
+            return cached_index[1]
+
+        index_path = get_data_index_path(path)
+        offsets = read_snapshot(index_path, identity)
+        if offsets is None:
+            self.logger.debug("Building an index of the data in %s" % path)
+            offsets = build_data_index(buf)
+            self._write_snapshot(index_path, identity, offsets)
+
+        with self._index_lock:
+            self._data_indexes[path] = (identity, offsets)
+
+        return offsets
+
+    def get_many(self, urls, max_workers=DEFAULT_MAX_WORKERS):
+        """Return a dictionary that maps each of urls to its data.
+
+        Files that are not cached or have expired are downloaded concurrently (see
+        prefetch()). If any of them cannot be downloaded, BatchDownloadError is
+        raised once the others have been fetched.
+        """
+        errors = self.prefetch(urls, max_workers)
+
+        results = {}
+        for url in urls:
+            if url in errors:
+                continue
+
+            try:
+                results[url] = self.get_data_from_url(url)
+            except ValueError as ex:
+                errors[url] = ex
+
+        if errors:
+            raise BatchDownloadError(errors, results)
+
+        return results
+
+    def prefetch(self, urls, max_workers=DEFAULT_MAX_WORKERS):
+        """Download any of urls that are not cached or have expired.
+
+        Downloading, extracting and validating the metadata of files happens in a
+        pool of up to max_workers threads and the file cache is saved once all
+        downloads have finished. The rest of a file is validated when it is first
+        read, and a malformed file is then removed. A failed download does not
+        prevent the other urls from being fetched; a dictionary mapping each url
+        that failed to the exception it raised is returned.
+        """
+        errors = {}
+        downloads = OrderedDict()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for url in urls:
+                cached_file = self.file_cache.get(url)
+                if url in downloads or (
+                    cached_file is not None and not cached_file.is_expired
+                ):
+                    continue
+
+                downloads[url] = executor.submit(self._prefetch_file, url)
+
+            stored = False
+            for url, future in downloads.items():
+                try:
+                    download = future.result()
+                    if download is not None:
+                        with self._index_lock:
+                            self._store_downloaded_file(url, *download)
+                        stored = True
+                except Exception as ex:
+                    self.logger.debug("Prefetching %s failed: %s" % (url, ex))
+                    errors[url] = ex
+
+        if stored:
+            self.save_cache()
+
+        return errors
+
+    def _prefetch_file(self, url):
+        # The download lock is released before the file cache is saved, so another
+        # process may download the same file in the meantime. Holding the locks
+        # until then could deadlock against another process's prefetch().
+        with self._get_download_lock(url):
+            return self._download_if_expired(url)
+
     def _get_from_url(self, url):
+        try:
+            return self._load_cached_url(url)
+        except FileNotFoundError:
+            # The file was replaced by another thread or process between looking up
+            # its path and reading it.
+            self.logger.debug("The cached file for %s was removed, retrying" % url)
+            # Files are replaced with the index lock held, so holding it here
+            # ensures that the index is not reloaded halfway through a refresh.
+            with self._index_lock:
+                self.file_cache.reload(url)
+            return self._load_cached_url(url)
+
+    def _load_cached_url(self, url):
         path = self._get_cached_file_path(url)
-        file_contents = self._read_cached_file(path)
-        json_data = json.loads(file_contents)
+        try:
+            return self._load_cached_document(path, url)
+        except ValueError:
+            # Only the metadata is validated when a file is downloaded. A file that
+            # is malformed after it is removed, so that the next request for url
+            # downloads it again.
+            self._remove_malformed_file(url, path)
+            raise
+
+    def _remove_malformed_file(self, url, path):
+        self.logger.warning("The cached file for %s is malformed, removing it" % url)
+        with self._index_lock:
+            cached_file = self.file_cache.get(url)
+            if cached_file is not None and cached_file.path == path:
+                self._remove_cached_file(cached_file)
+                self.save_cache()
+
+    def _load_cached_document(self, path, url):
+        if not self.document_cache.enabled:
+            with self._stats.time(url, "parse"):
+                return self._load_document(path)
+
+        identity = get_file_identity(path)
+        json_data = self.document_cache.get(path, identity)
+        if json_data is None:
+            self.logger.debug("Parsing cached file %s" % path)
+            with self._stats.time(url, "parse"):
+                json_data = self._load_document(path)
+            self.document_cache.put(path, identity, json_data)
+
+        return json_data
+
+    def _load_document(self, path):
+        if not self.snapshots:
+            return self._parse_document(path)
+
+        identity = get_file_identity(path)
+        json_data = read_snapshot(get_snapshot_path(path), identity)
+        if json_data is None:
+            self.logger.debug("The snapshot of %s is missing or stale" % path)
+            json_data = self._parse_document(path)
+            self._write_snapshot(get_snapshot_path(path), identity, json_data)
 
         return json_data
 
+    def _parse_document(self, path):
+        file_contents = self._read_cached_file(path)
+        return json.loads(file_contents)
+
+    def _build_snapshot(self, source_path, path):
+        identity = get_file_identity(source_path)
+        self._write_snapshot(
+            get_snapshot_path(path), identity, self._parse_document(source_path)
+        )
+
+    def _build_data_index(self, source_path, path):
+        identity = get_file_identity(source_path)
+        with open(source_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                try:
+                    offsets = build_data_index(buf)
+                except (KeyError, ValueError) as ex:
+                    self.logger.debug(
+                        "Unable to index the data in %s: %s" % (source_path, ex)
+                    )
+                    return
+
+        self._write_snapshot(get_data_index_path(path), identity, offsets)
+
+    def _write_snapshot(self, snapshot_path, identity, obj):
+        self.logger.debug("Saving %s" % snapshot_path)
+        try:
+            write_snapshot(snapshot_path, identity, obj)
+        except Exception as ex:
+            # Snapshots only speed up loading, the cached file is still usable
+            self.logger.warning("Unable to save %s: %s" % (snapshot_path, ex))
+
     def _get_cached_file_path(self, url):
-        if url in self.file_cache.keys():
+        cached_file = self._get_cached_file(url)
+        if self.refresh_scheduler is not None:
+            self.refresh_scheduler.touch(url, cached_file)
+
+        return cached_file.path
+
+    def _get_cached_file(self, url):
+        cached_file = self.file_cache.get(url)
+        if cached_file is not None:
             self.logger.debug("File for url %s is cached" % url)
-            cached_file = self.file_cache[url]
             if not cached_file.is_expired:
                 self.logger.debug("The cache file for %s has not expired" % url)
+                self._stats.increment(url, "hits")
+                self._record_access(url, cached_file)
+                return cached_file
+
+            self.logger.debug("The cached file for %s has expired" % url)
+            self._stats.increment(url, "expirations")
+            if self._can_serve_stale(cached_file):
+                self.logger.debug(
+                    "Using the expired file for %s while it is refreshed" % url
+                )
+                self._stats.increment(url, "hits")
+                self._stats.increment(url, "stale_hits")
+                self._refresh_in_background(url)
+                self._record_access(url, cached_file)
+                return cached_file
+
+        self._stats.increment(url, "misses")
+        if cached_file is None or not self.tracks_failures:
+            return self._refresh_file(url)
+
+        try:
+            return self._refresh_file(url)
+        except DownloadError as ex:
+            self.logger.warning(
+                "Unable to refresh %s, using the expired file: %s" % (url, ex)
+            )
+            self._stats.increment(url, "stale_on_error")
+            self._record_access(url, cached_file)
+            return cached_file
+
+    @property
+    def tracks_failures(self):
+        return self.negative_cache is not None or self.circuit_breaker is not None
+
+    def _record_access(self, url, cached_file):
+        if not self.is_bounded:
+            return
+
+        now = int(time.time())
+        if (
+            cached_file.last_access is None
+            or now - cached_file.last_access >= ACCESS_TIME_RESOLUTION
+        ):
+            self.file_cache.touch(url, cached_file.path, now)
+
+    def _can_serve_stale(self, cached_file):
+        return self.stale_while_revalidate > 0 and not cached_file.expires_within(
+            -self.stale_while_revalidate
+        )
+
+    def _refresh_in_background(self, url):
+        with self._index_lock:
+            if url in self._background_refreshes:
+                return
+
+            thread = threading.Thread(
+                target=self._background_refresh, args=(url,), daemon=True
+            )
+            self._background_refreshes[url] = thread
+
+        thread.start()
+
+    def _background_refresh(self, url):
+        try:
+            self._refresh_file(url)
+        except Exception as ex:
+            self.logger.warning(
+                "Refreshing %s in the background failed: %s" % (url, ex)
+            )
+        finally:
+            with self._index_lock:
+                del self._background_refreshes[url]
+
+    def _refresh_file(self, url, expires_within=0):
+        # Without this, each waiting thread would take the download lock in turn and
+        # reload the index, and would download the file again if the first failed.
+        cached_file, shared = self._refreshes.run(
+            url, self._refresh_file_locked, url, expires_within
+        )
+        if shared:
+            self._stats.increment(url, "coalesced_requests")
+
+        return cached_file
+
+    def _refresh_file_locked(self, url, expires_within):
+        with self._get_download_lock(url):
+            download = self._download_if_expired(url, expires_within)
+            with self._index_lock:
+                if download is not None:
+                    self._store_downloaded_file(url, *download)
+                    self.save_cache()
+
+                return self.file_cache[url]
+
+    def _download_if_expired(self, url, expires_within=0):
+        """Download url unless another process has already refreshed it.
+
+        Must be called with the download lock for url held. Files that will expire
+        within expires_within seconds are treated as expired. Returns None if no
+        download was needed, otherwise the cached file (if any) and the file that
+        replaces it, which has the same path if the cached file was revalidated.
+        """
+        cached_file = self.file_cache.reload(url)
+        if cached_file is not None:
+            if expires_within:
+                expired = cached_file.expires_within(expires_within)
             else:
-                self.logger.debug("The cached file for %s has expired" % url)
-                self._remove_expired_file(cached_file)
-                self._download_and_cache_file(url)
+                expired = cached_file.is_expired
+
+            if not expired:
+                self.logger.debug(
+                    "The file for %s was refreshed by another process" % url
+                )
+                return None
+
+            if cached_file.can_revalidate:
+                self.logger.debug("Revalidating the cached file for %s" % url)
+
+        if not self.tracks_failures:
+            return cached_file, self._download_file(url, cached_file)
+
+        # The circuits of mirrors are checked when each mirror is tried
+        host = None if url in self.mirrors else urlsplit(url).netloc
+        self._check_can_download(url, host)
+        try:
+            new_cached_file = self._download_file(url, cached_file)
+        except Exception as ex:
+            self._record_download_failure(url, host, ex)
+            raise
+
+        self._record_download_success(url, host)
+        return cached_file, new_cached_file
+
+    def _check_can_download(self, url, host):
+        """Raise DownloadError if url failed recently or its host is unavailable."""
+        if self.negative_cache is not None:
+            error = self.negative_cache.get(url)
+            if error is not None:
+                self._stats.increment(url, "skipped_downloads")
+                raise DownloadError(
+                    "Not downloading %s, which failed recently: %s" % (url, error),
+                    getattr(error, "status_code", None),
+                )
+
+        if host is not None and not self._is_host_available(host):
+            self._stats.increment(url, "skipped_downloads")
+            raise DownloadError(
+                "Not downloading %s, the circuit for %s is open" % (url, host)
+            )
+
+    def _is_host_available(self, host):
+        return self.circuit_breaker is None or self.circuit_breaker.allow_request(host)
+
+    def _record_download_failure(self, url, host, error):
+        if self.negative_cache is not None:
+            self.negative_cache.add(url, error)
+        if host is not None:
+            self._record_host_result(host, error)
+
+    def _record_download_success(self, url, host):
+        if self.negative_cache is not None:
+            self.negative_cache.remove(url)
+        if host is not None:
+            self._record_host_result(host)
+
+    def _record_host_result(self, host, error=None):
+        if self.circuit_breaker is None:
+            return
+
+        # Only errors that suggest that the host is unavailable count against it.
+        # A file that is missing or can't be extracted was served by a healthy host.
+        if not isinstance(error, DownloadError) or (
+            error.status_code is not None
+            and error.status_code < 500
+            and error.status_code not in RETRY_STATUS_CODES
+        ):
+            self.circuit_breaker.record_success(host)
+        elif self.circuit_breaker.record_failure(host):
+            self.logger.warning(
+                "Opening the circuit for %s after %d failed downloads"
+                % (host, self.circuit_breaker.failure_threshold)
+            )
+
+    def _store_downloaded_file(self, url, cached_file, new_cached_file):
+        # Another thread may have replaced cached_file since it was downloaded.
+        current_cached_file = self.file_cache.get(url)
+        if (
+            current_cached_file is not None
+            and current_cached_file.path != new_cached_file.path
+        ):
+            self._remove_cached_file(current_cached_file)
+            current_cached_file = None
+
+        self.file_cache[url] = new_cached_file
+        self._update_totals(current_cached_file, new_cached_file)
+        if self.is_bounded:
+            self._evict(protected_url=url)
+
+    @property
+    def is_bounded(self):
+        return self.max_size is not None or self.max_entries is not None
+
+    def _is_within_budget(self, size, entries):
+        return (self.max_size is None or size <= self.max_size) and (
+            self.max_entries is None or entries <= self.max_entries
+        )
+
+    def _update_totals(self, old_cached_file, new_cached_file):
+        """Update the running totals for an entry replaced by new_cached_file.
+
+        Either may be None, when an entry is added or removed.
+        """
+        if self._total_entries is None:
+            return
+
+        if old_cached_file is not None:
+            self._total_size -= self._get_cached_file_size(old_cached_file)
+            self._total_entries -= 1
+        if new_cached_file is not None:
+            self._total_size += self._get_cached_file_size(new_cached_file)
+            self._total_entries += 1
+
+    def _evict(self, protected_url=None, rescan=False):
+        """Remove least recently used files until the cache is within its budget.
+
+        Must be called with the index lock held. Only the index is read, the cache
+        dir is not scanned. The index is only read if the running totals exceed the
+        budget, or if rescan is set, which also corrects the totals for entries that
+        other processes have changed. Returns the paths of the files that were
+        removed.
+        """
+        if (
+            not rescan
+            and self._total_entries is not None
+            and self._is_within_budget(self._total_size, self._total_entries)
+        ):
+            return []
+
+        cached_files = self.file_cache.values()
+        self._total_size = sum(self._get_cached_file_size(cf) for cf in cached_files)
+        self._total_entries = len(cached_files)
+        if self._is_within_budget(self._total_size, self._total_entries):
+            return []
+
+        candidates = sorted(
+            (cf for cf in cached_files if cf.url != protected_url),
+            key=lambda cf: cf.last_access or 0,
+        )
+        removed = []
+        with contextlib.ExitStack() as download_locks:
+            for cached_file in candidates:
+                if self._is_within_budget(self._total_size, self._total_entries):
+                    break
+
+                cached_file = self._lock_for_removal(cached_file.url, download_locks)
+                if cached_file is None:
+                    continue
+
+                self.logger.debug(
+                    "Evicting %s to keep the cache within its budget" % cached_file.url
+                )
+                self._remove_cached_file(cached_file)
+                self._stats.increment(cached_file.url, "evictions")
+                removed.append(cached_file.path)
+
+            if removed:
                 self.save_cache()
-        else:
-            self._download_and_cache_file(url)
-            self.save_cache()
 
-        return self.file_cache[url].path
+        return removed
+
+    def _lock_for_removal(self, url, download_locks):
+        """Take the download lock for url, if it is free, and reload its entry.
+
+        The lock is added to download_locks and must be held until the index has
+        been saved, so that another process does not revalidate the file that is
+        being removed. Returns None if the lock is held or url is no longer cached.
+        """
+        download_lock = self._get_download_lock(url)
+        if not download_lock.acquire(blocking=False):
+            self.logger.debug("Not removing %s, it is being downloaded" % url)
+            return None
+
+        download_locks.callback(download_lock.release)
+        return self.file_cache.reload(url)
+
+    @staticmethod
+    def _get_cached_file_size(cached_file):
+        if cached_file.size is not None:
+            return cached_file.size
+
+        # Files cached by earlier versions do not record their size
+        try:
+            return os.path.getsize(cached_file.path)
+        except FileNotFoundError:
+            return 0
+
+    def gc(self, orphan_age=DEFAULT_ORPHAN_AGE):
+        """Remove expired files, evict files over budget and remove orphaned files.
+
+        Files that have expired (and can't be served while they are revalidated)
+        are removed in bulk, files are evicted until the cache is within max_size
+        and max_entries, and files in the cache dir that are not referenced by the
+        index and are older than orphan_age seconds, such as partial downloads left
+        behind by a process that crashed, are removed. Files that are being
+        downloaded are skipped. Returns the paths of the files that were removed.
+        """
+        removed = []
+        with self._index_lock:
+            with contextlib.ExitStack() as download_locks:
+                for url, cached_file in self.file_cache.items():
+                    if not cached_file.is_expired or self._can_serve_stale(cached_file):
+                        continue
+
+                    cached_file = self._lock_for_removal(url, download_locks)
+                    if cached_file is not None and cached_file.is_expired:
+                        self._remove_cached_file(cached_file)
+                        removed.append(cached_file.path)
+
+                self.save_cache()
+
+            if self.is_bounded:
+                removed.extend(self._evict(rescan=True))
+
+            referenced = set(self._pinned_files)
+            referenced.update(cf.path for cf in self.file_cache.values())
+            removed.extend(self._remove_orphaned_files(referenced, orphan_age))
+            removed.extend(self._remove_abandoned_downloads(orphan_age))
+            removed.extend(self.blob_store.remove_unreferenced())
+
+        return removed
 
-    def _remove_expired_file(self, cached_file):
+    def _remove_orphaned_files(self, referenced, orphan_age):
+        removed = []
+        cutoff = time.time() - orphan_age
+        for entry in os.scandir(self.cache_dir):
+            if not CACHE_FILE_NAME.match(entry.name) or not entry.is_file():
+                continue
+
+            # Snapshots, indexes and partial files belong to the file they extend
+            path = os.path.join(self.cache_dir, entry.name.split(".", 1)[0])
+            if path in referenced:
+                continue
+
+            try:
+                if entry.stat().st_mtime > cutoff:
+                    continue
+
+                self.logger.debug("Removing orphaned file %s" % entry.path)
+                os.remove(entry.path)
+                removed.append(entry.path)
+            except FileNotFoundError:
+                pass
+
+        return removed
+
+    def _remove_abandoned_downloads(self, orphan_age):
+        """Remove interrupted downloads that have not been resumed recently."""
+        removed = []
+        cutoff = time.time() - orphan_age
+        try:
+            names = os.listdir(self.partial_download_dir)
+        except FileNotFoundError:
+            return removed
+
+        # Partial downloads are named after the hash of their url, like locks
+        for url_hash in sorted(set(name.split(".", 1)[0] for name in names)):
+            partial_download = PartialDownload(
+                os.path.join(self.partial_download_dir, url_hash)
+            )
+            modified = partial_download.get_mtime()
+            if modified is None or modified > cutoff:
+                continue
+
+            os.makedirs(self.lock_dir, exist_ok=True)
+            download_lock = FileLock(
+                os.path.join(self.lock_dir, url_hash + LOCK_FILE_SUFFIX)
+            )
+            if not download_lock.acquire(blocking=False):
+                continue
+
+            try:
+                self.logger.debug(
+                    "Removing abandoned download %s" % partial_download.path
+                )
+                removed.extend(partial_download.remove())
+            finally:
+                download_lock.release()
+
+        return removed
+
+    def _remove_cached_file(self, cached_file):
         self.logger.debug(
-            "Removing expired cached file %s downloaded from %s"
+            "Removing cached file %s downloaded from %s"
             % (cached_file.path, cached_file.url)
         )
-        os.remove(cached_file.path)
-        del self.file_cache[cached_file.url]
-        self.save_cache()
+        with self._index_lock:
+            self._update_totals(cached_file, None)
+            if cached_file.path in self._pinned_files:
+                self.logger.debug(
+                    "%s is mapped into memory, removing it once it is unmapped"
+                    % cached_file.path
+                )
+                self._deferred_removals[cached_file.path] = cached_file.content_hash
+            else:
+                self._release_file(cached_file.path, cached_file.content_hash)
+
+            self.document_cache.invalidate(cached_file.path)
+            self._data_indexes.pop(cached_file.path, None)
+            self.file_cache.pop(cached_file.url)
+
+    def _release_file(self, path, content_hash):
+        self._remove_file(path)
+        if content_hash is not None:
+            self.blob_store.release(content_hash)
 
-    def _download_and_cache_file(self, url):
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Another process sharing the cache dir has already removed it.
+            pass
+        remove_snapshot(get_snapshot_path(path))
+        remove_snapshot(get_data_index_path(path))
+
+    def _download_file(self, url, cached_file=None):
+        """Download url, returning a renewed cached_file if it has not been modified.
+
+        If deduplicate is set, a file whose contents are the same as cached_file's
+        is not stored again, and cached_file is renewed as if it had not been
+        modified. A file whose contents are already cached for another url is
+        linked to them.
+        """
         file_id = str(uuid.uuid4())
         downloaded_file_path = os.path.join(self.cache_dir, file_id)
-        self._download(url, downloaded_file_path)
-
-        if USTDownloadCache._is_bz2(downloaded_file_path):
-            self._extract_bz2_file(downloaded_file_path)
-        elif USTDownloadCache._is_gz(downloaded_file_path):
-            self._extract_gz_file(downloaded_file_path)
+        partial_file_path = downloaded_file_path + PARTIAL_FILE_SUFFIX
+        validator_headers = None
+        # A file that has been removed can't be renewed, so it is downloaded again
+        if cached_file is not None and os.path.exists(cached_file.path):
+            validator_headers = cached_file.get_validator_headers()
 
         try:
-            metadata = self._get_file_metadata(downloaded_file_path)
+            with self._stats.time(url, "download"):
+                if url in self.mirrors:
+                    response = self._download_from_mirrors(
+                        url, partial_file_path, validator_headers
+                    )
+                elif url in self.variants:
+                    response = self._download_variant(
+                        url, partial_file_path, validator_headers
+                    )
+                else:
+                    response = self._download(url, partial_file_path, validator_headers)
+            if response.status_code == STATUS_NOT_MODIFIED:
+                self._stats.increment(url, "not_modified")
+                self.logger.debug(
+                    "The file at %s has not been modified, renewing the cached file"
+                    % url
+                )
+                return self._renew_cached_file(cached_file, response.headers)
+
+            metadata = self._get_file_metadata(partial_file_path)
+            content_hash = hash_file(partial_file_path) if self.deduplicate else None
+            path = self._save_downloaded_file(
+                url, partial_file_path, downloaded_file_path, content_hash, cached_file
+            )
         except Exception as ex:
-            if os.path.exists(downloaded_file_path):
-                os.remove(downloaded_file_path)
+            self._stats.increment(url, "download_errors")
+            if os.path.exists(partial_file_path):
+                os.remove(partial_file_path)
+            self._remove_file(downloaded_file_path)
 
             raise ex
 
-        self.file_cache[url] = CachedFile(
-            url, downloaded_file_path, metadata["timestamp"], metadata["ttl"]
+        new_cached_file = CachedFile(
+            url,
+            path,
+            metadata["timestamp"],
+            metadata["ttl"],
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            content_hash=content_hash,
+        )
+        fetched = int(time.time())
+        if cached_file is not None and path == cached_file.path:
+            new_cached_file.revalidated = fetched
+        self._apply_freshness_policy(new_cached_file, fetched, response.headers)
+        if self.is_bounded:
+            new_cached_file.size = os.path.getsize(path)
+            new_cached_file.last_access = fetched
+
+        self._stats.increment(url, "downloads")
+        return new_cached_file
+
+    def _renew_cached_file(self, cached_file, response_headers):
+        renewed_file = CachedFile.from_dict(cached_file.to_dict())
+        renewed_file.revalidated = int(time.time())
+        self._apply_freshness_policy(
+            renewed_file, renewed_file.revalidated, response_headers
+        )
+
+        return renewed_file
+
+    def _apply_freshness_policy(self, cached_file, fetched, response_headers):
+        """Set when cached_file, fetched at fetched, expires.
+
+        The expiration time is only stored in the index if it differs from the one
+        computed from the file's timestamp and ttl.
+        """
+        cached_file.expires = None
+        expiration_time = self.freshness_policy.get_expiration_time(
+            cached_file, fetched, response_headers
         )
+        if self.freshness_policy.is_expired_on_arrival(expiration_time, fetched):
+            self._stats.increment(cached_file.url, "expired_on_arrival")
+            guard_interval = self.freshness_policy.thrash_guard_interval
+            if guard_interval > 0:
+                self.logger.warning(
+                    "The file at %s had expired when it was fetched, keeping it for "
+                    "%d seconds" % (cached_file.url, guard_interval)
+                )
+                expiration_time = fetched + guard_interval
+            else:
+                self.logger.warning(
+                    "The file at %s had expired when it was fetched, and will be "
+                    "downloaded again by the next request" % cached_file.url
+                )
+
+        if expiration_time != cached_file.expiration_time:
+            cached_file.expires = expiration_time
+
+    def _save_downloaded_file(
+        self, url, partial_file_path, downloaded_file_path, content_hash, cached_file
+    ):
+        """Move a downloaded file into the cache, returning its path."""
+        if content_hash is not None:
+            if (
+                cached_file is not None
+                and cached_file.content_hash == content_hash
+                and os.path.exists(cached_file.path)
+            ):
+                self.logger.debug(
+                    "The contents of %s have not changed, keeping %s"
+                    % (url, cached_file.path)
+                )
+                self._stats.increment(url, "deduplicated")
+                os.remove(partial_file_path)
+                return cached_file.path
+
+            if self._link_blob(content_hash, downloaded_file_path):
+                self.logger.debug(
+                    "The contents of %s are already cached, linked them to %s"
+                    % (url, downloaded_file_path)
+                )
+                self._stats.increment(url, "deduplicated")
+                os.remove(partial_file_path)
+                return downloaded_file_path
+
+        # Renaming the file does not change its identity, so snapshots and
+        # indexes built from the partial file remain valid
+        if self.snapshots:
+            self._build_snapshot(partial_file_path, downloaded_file_path)
+        if self.data_index:
+            self._build_data_index(partial_file_path, downloaded_file_path)
+        os.replace(partial_file_path, downloaded_file_path)
 
-    def _download(self, download_url, filename):
+        if content_hash is not None:
+            self._add_blob(content_hash, downloaded_file_path)
+
+        return downloaded_file_path
+
+    def _link_blob(self, content_hash, path):
         try:
-            self.logger.debug("Downloading %s to %s" % (download_url, filename))
-            with open(filename, "wb") as target_file:
-                r = requests.get(download_url)
-                r.raise_for_status()
-                target_file.write(r.content)
+            return self.blob_store.link(content_hash, path)
+        except OSError as ex:
+            # e.g. the file system does not support hard links
+            self.logger.debug("Unable to link %s to its blob: %s" % (path, ex))
+            return False
+
+    def _add_blob(self, content_hash, path):
+        try:
+            self.blob_store.add(content_hash, path)
+        except OSError as ex:
+            self.logger.warning("Unable to add %s to the blob store: %s" % (path, ex))
+
+    def _download_from_mirrors(self, key, filename, validator_headers=None):
+        """Download and extract the file requested as key from one of its mirrors.
+
+        Mirrors are tried in the order chosen by the mirror selector, moving on to
+        the next mirror when a download fails. If hedge_requests is set and a
+        download takes longer than most recent downloads from the same mirror, the
+        next mirror is tried at the same time, and the first download to finish is
+        kept. Returns the response, like _download().
+        """
+        pending = self.mirror_selector.rank(self.mirrors[key])
+        attempt_numbers = itertools.count()
+        attempts = {}
+        errors = []
+        while True:
+            while pending and not attempts:
+                self._start_mirror_attempt(
+                    pending.pop(0),
+                    filename + get_attempt_suffix(next(attempt_numbers)),
+                    validator_headers,
+                    attempts,
+                    errors,
+                )
+            if not attempts:
+                break
+
+            done, _ = wait(
+                attempts, self._get_hedge_timeout(attempts, pending), FIRST_COMPLETED
+            )
+            if not done:
+                mirror_url = pending.pop(0)
+                self.logger.debug(
+                    "Downloading %s is slow, also trying %s" % (key, mirror_url)
+                )
+                self._stats.increment(key, "hedged_requests")
+                self._start_mirror_attempt(
+                    mirror_url,
+                    filename + get_attempt_suffix(next(attempt_numbers)),
+                    validator_headers,
+                    attempts,
+                    errors,
+                )
+                continue
+
+            for future in done:
+                mirror_url, path, _, _ = attempts.pop(future)
+                try:
+                    response = future.result()
+                except Exception as ex:
+                    self.logger.debug(
+                        "Downloading from %s failed: %s" % (mirror_url, ex)
+                    )
+                    errors.append(ex)
+                    continue
+
+                self._cancel_mirror_attempts(attempts)
+                # Nothing is written if the cached file has not been modified
+                if response.status_code != STATUS_NOT_MODIFIED:
+                    os.replace(path, filename)
+                return response
+
+        raise DownloadError(
+            "Downloading %s failed from every mirror: %s"
+            % (key, "; ".join(str(error) for error in errors)),
+            getattr(errors[-1], "status_code", None) if errors else None,
+        )
+
+    def _start_mirror_attempt(
+        self, mirror_url, path, validator_headers, attempts, errors
+    ):
+        host = urlsplit(mirror_url).netloc
+        if not self._is_host_available(host):
+            errors.append(DownloadError("The circuit for %s is open" % host))
+            return
+
+        cancelled = threading.Event()
+        # A thread of its own, which is not waited for if the download is cancelled
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(
+            self._download_from_mirror, mirror_url, path, validator_headers, cancelled
+        )
+        executor.shutdown(wait=False)
+        attempts[future] = (mirror_url, path, cancelled, time.monotonic())
+
+    def _get_hedge_timeout(self, attempts, pending):
+        """Return how long to wait for attempts before trying the next mirror."""
+        if not self.hedge_requests or not pending:
+            return None
+        if len(attempts) >= MAX_MIRROR_REQUESTS:
+            return None
+
+        ((mirror_url, _, _, started),) = attempts.values()
+        hedge_delay = self.mirror_selector.get_hedge_delay(mirror_url)
+        if hedge_delay is None:
+            return None
+
+        return max(0, started + hedge_delay - time.monotonic())
+
+    def _cancel_mirror_attempts(self, attempts):
+        for future, (mirror_url, path, cancelled, started) in attempts.items():
+            cancelled.set()
+            self.mirror_selector.record_cancellation(
+                mirror_url, time.monotonic() - started
+            )
+            # Removes the file once the download has stopped
+            future.add_done_callback(lambda _, path=path: self._remove_file(path))
+
+    def _download_from_mirror(self, mirror_url, path, validator_headers, cancelled):
+        partial_download = PartialDownload(path + MIRROR_PARTIAL_DOWNLOAD_SUFFIX)
+        host = urlsplit(mirror_url).netloc
+        start = time.monotonic()
+        try:
+            response = self._download(
+                mirror_url, path, validator_headers, partial_download, cancelled
+            )
         except Exception as ex:
-            raise DownloadError("Downloading %s failed: %s" % (download_url, ex))
+            partial_download.remove()
+            self._remove_file(path)
+            if not cancelled.is_set():
+                self.mirror_selector.record_failure(mirror_url)
+                self._record_host_result(host, ex)
+            raise
+
+        latency = response.elapsed.total_seconds()
+        if response.status_code == STATUS_NOT_MODIFIED:
+            self.mirror_selector.record_success(mirror_url, latency)
+        else:
+            self.mirror_selector.record_success(
+                mirror_url, latency, time.monotonic() - start, os.path.getsize(path)
+            )
+        self._record_host_result(host)
 
-    def _extract_bz2_file(self, path):
+        return response
+
+    def _download_variant(self, base_url, filename, validator_headers=None):
+        """Download and extract the quickest variant of base_url to filename."""
+        variant = self.variant_selector.choose(self._get_variants(base_url))
+        self.logger.debug(
+            "Downloading the %s variant of %s"
+            % (variant.compression or "uncompressed", base_url)
+        )
+        # Kept under base_url, whose download lock is held, but only resumed by
+        # a download of the same variant
+        partial_download = self._get_partial_download(base_url, variant.url)
         try:
-            self.logger.debug("Reading bz2 file %s" % path)
-            with bz2.open(path, "rb") as f:
-                file_contents = f.read()
+            return self._download(
+                variant.url, filename, validator_headers, partial_download
+            )
+        except DownloadError:
+            # The variant may have been removed, so they are probed again next time
+            with self._index_lock:
+                self._probed_variants.pop(base_url, None)
+            raise
+
+    def _get_variants(self, base_url):
+        variants = self._probed_variants.get(base_url)
+        if variants is None:
+            variants = self._probe_variants(base_url)
+            with self._index_lock:
+                self._probed_variants[base_url] = variants
+
+        return variants
+
+    def _probe_variants(self, base_url):
+        """Return the variants of base_url that exist, and their sizes if known."""
+        compressions = dict(VARIANT_COMPRESSIONS)
+        variants = []
+        error = None
+        for suffix in self.variants[base_url]:
+            variant_url = base_url + suffix
+            try:
+                r = self.session.head(
+                    variant_url, timeout=self.timeout, allow_redirects=True
+                )
+                r.close()
+                r.raise_for_status()
+            except Exception as ex:
+                self.logger.debug("Unable to probe %s: %s" % (variant_url, ex))
+                error = ex
+                continue
+
+            variants.append(
+                Variant(
+                    variant_url,
+                    compressions[suffix],
+                    self._get_content_length(r.headers),
+                )
+            )
+
+        if not variants:
+            response = getattr(error, "response", None)
+            raise DownloadError(
+                "No variant of %s is available: %s" % (base_url, error),
+                getattr(response, "status_code", None),
+            )
+
+        return variants
+
+    def _download(
+        self,
+        download_url,
+        filename,
+        validator_headers=None,
+        partial_download=None,
+        cancelled=None,
+    ):
+        """Download and extract download_url to filename.
+
+        Returns the response, which has been closed. Its status is 304 if
+        validator_headers were supplied and the server reports that the file has not
+        been modified.
+
+        If the server supports range requests, the bytes received are kept until
+        the download completes. A download whose connection is dropped is resumed
+        up to DOWNLOAD_RESUME_ATTEMPTS times, and then by the next call with the
+        same partial_download, which by default is the one kept for download_url.
+        The download stops, raising DownloadError, once the cancelled event is set.
+        """
+        self.logger.debug("Downloading %s to %s" % (download_url, filename))
+        if partial_download is None:
+            partial_download = self._get_partial_download(download_url)
+        for attempt in itertools.count(1):
+            r = self._request(download_url, partial_download, validator_headers)
+            if r.status_code == STATUS_NOT_MODIFIED:
+                r.close()
+                partial_download.remove()
+                return r
+
+            try:
+                self._write_response(
+                    download_url, r, partial_download, filename, cancelled
+                )
+            except DownloadError as ex:
+                if (
+                    attempt > DOWNLOAD_RESUME_ATTEMPTS
+                    or not partial_download.can_resume
+                    or (cancelled is not None and cancelled.is_set())
+                ):
+                    raise
+
+                self.logger.debug(
+                    "%s, resuming from byte %d" % (ex, partial_download.size)
+                )
+                continue
+            except BaseException:
+                partial_download.remove()
+                raise
+            finally:
+                partial_download.close()
+                r.close()
+
+            partial_download.remove()
+            return r
+
+    def _request(self, download_url, partial_download, validator_headers=None):
+        """Request download_url, or the part of it that has not been saved.
+
+        The response's status is 304 if validator_headers were supplied and the
+        server reports that the file has not been modified.
+        """
+        headers = dict(validator_headers or {})
+        range_headers = partial_download.get_request_headers()
+        headers.update(range_headers)
+        try:
+            r = self.session.get(
+                download_url, stream=True, headers=headers, timeout=self.timeout
+            )
+            if range_headers and r.status_code == STATUS_RANGE_NOT_SATISFIABLE:
+                self.logger.debug(
+                    "Unable to resume downloading %s, starting again" % download_url
+                )
+                r.close()
+                partial_download.remove()
+                return self._request(download_url, partial_download, validator_headers)
+
+            if validator_headers and r.status_code == STATUS_NOT_MODIFIED:
+                return r
 
-            self.logger.debug("Writing extracted bz2 file contents to %s" % path)
-            with open(path, "wb") as f:
-                f.write(file_contents)
+            r.raise_for_status()
+        except DownloadError:
+            raise
         except Exception as ex:
-            raise BZ2ExtractionError("Error extracting bz2 archive: %s" % ex)
+            response = getattr(ex, "response", None)
+            raise DownloadError(
+                "Downloading %s failed: %s" % (download_url, ex),
+                getattr(response, "status_code", None),
+            )
+
+        return r
 
-    def _extract_gz_file(self, path):
+    def _write_response(
+        self, download_url, response, partial_download, filename, cancelled=None
+    ):
         try:
-            self.logger.debug("Reading gz file %s" % path)
-            with gzip.open(path, "rb") as f:
-                file_contents = f.read()
+            saved = partial_download.open(response.status_code, response.headers)
+        except ValueError as ex:
+            partial_download.remove()
+            raise DownloadError(
+                "Unable to resume downloading %s: %s" % (download_url, ex)
+            )
+
+        chunks = self._iter_download_chunks(
+            download_url,
+            response.iter_content(DOWNLOAD_CHUNK_SIZE),
+            self._get_content_length(response.headers),
+            cancelled,
+        )
+        if saved:
+            # The bytes saved by earlier attempts are extracted again, as the state
+            # of the decompressor can't be saved.
+            chunks = itertools.chain(
+                partial_download.iter_saved_chunks(DOWNLOAD_CHUNK_SIZE),
+                partial_download.save_chunks(chunks),
+            )
+
+        with open(filename, "wb") as target_file:
+            self._write_decompressed(download_url, chunks, target_file)
+
+    def _write_decompressed(self, download_url, chunks, target_file):
+        decompressor = None
+        header = b""
+        start = time.time()
+        start_counter = time.perf_counter()
+        downloaded_size = 0
+        decompressed_size = 0
+        decompress_time = 0.0
+
+        def write(decompress, *args):
+            nonlocal decompressed_size, decompress_time
+            decompress_start = time.perf_counter()
+            data = decompress(*args)
+            decompress_time += time.perf_counter() - decompress_start
+            decompressed_size += len(data)
+            target_file.write(data)
+
+        for chunk in chunks:
+            downloaded_size += len(chunk)
+            if decompressor is None:
+                header += chunk
+                if len(header) < MAX_MAGIC_NUMBER_LENGTH:
+                    continue
+
+                decompressor = self._get_decompressor(header)
+                chunk = header
 
-            self.logger.debug("Writing extracted gz file contents to %s" % path)
-            with open(path, "wb") as f:
-                f.write(file_contents)
+            write(decompressor.decompress, chunk)
+
+        if decompressor is None:
+            decompressor = self._get_decompressor(header)
+            write(decompressor.decompress, header)
+
+        write(decompressor.flush)
+
+        self._stats.increment(download_url, "bytes_decompressed", decompressed_size)
+        self._stats.observe(download_url, "decompress", start, decompress_time)
+        # The time spent waiting for the server is what remains
+        self.variant_selector.record_download(
+            downloaded_size, time.perf_counter() - start_counter - decompress_time
+        )
+        self.variant_selector.record_decompression(
+            decompressor.name, decompressed_size, decompress_time
+        )
+
+    def _get_decompressor(self, header):
+        decompressor = get_decompressor(header)
+        if decompressor.name is not None:
+            self.logger.debug("Extracting %s archive" % decompressor.name)
+
+        if (
+            self.decompression_workers is not None
+            and self.decompression_workers > 1
+            and decompressor.name in STREAM_STARTS
+        ):
+            decompressor = ParallelStreamDecompressor(
+                decompressor,
+                self.decompression_executor,
+                max_pending=2 * self.decompression_workers,
+            )
+
+        return decompressor
+
+    @staticmethod
+    def _get_content_length(headers):
+        # The length of an encoded response is not the number of bytes requests
+        # yields once it has decoded it
+        if headers.get("Content-Encoding", "identity").lower() != "identity":
+            return None
+
+        try:
+            return int(headers["Content-Length"])
+        except (KeyError, ValueError):
+            return None
+
+    def _iter_download_chunks(
+        self, download_url, chunks, content_length=None, cancelled=None
+    ):
+        downloaded_size = 0
+        try:
+            for chunk in chunks:
+                if cancelled is not None and cancelled.is_set():
+                    raise DownloadError("Downloading %s was cancelled" % download_url)
+
+                downloaded_size += len(chunk)
+                yield chunk
+        except DownloadError:
+            raise
         except Exception as ex:
-            raise GZExtractionError("Error extracting gz archive: %s" % ex)
+            raise DownloadError("Downloading %s failed: %s" % (download_url, ex))
+        finally:
+            self._stats.increment(download_url, "bytes_downloaded", downloaded_size)
 
-    def _get_file_metadata(self, path):
-        file_contents = self._read_cached_file(path)
+        # Older versions of urllib3 don't report connections that are closed early
+        if content_length is not None and downloaded_size < content_length:
+            raise DownloadError(
+                "Downloading %s failed: the connection was closed after %d of %d "
+                "bytes" % (download_url, downloaded_size, content_length)
+            )
 
-        json_data = json.loads(file_contents)
+    def _get_file_metadata(self, path):
+        try:
+            metadata = self._scan_file_metadata(path)
+        except ValueError as ve:
+            self.logger.debug(
+                "Unable to scan %s for metadata (%s), parsing the whole file"
+                % (path, ve)
+            )
+            document = self._parse_document(path)
+            metadata = document.get("metadata") if isinstance(document, dict) else None
 
-        if "metadata" not in json_data:
+        if metadata is None:
             raise Exception("Error parsing metadata from file.")
 
-        return json_data["metadata"]
+        return metadata
+
+    @staticmethod
+    def _scan_file_metadata(path):
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for key, start, end in iter_object_members(
+                    buf, limit=METADATA_SCAN_LIMIT
+                ):
+                    if key == "metadata":
+                        return decode_value(buf, start, end)
+
+        return None
 
     def _read_cached_file(self, path):
         with open(path, "rb") as f:
             file_contents = f.read()
 
         return file_contents
-
-    @classmethod
-    def _is_bz2(cls, file_path):
-        return cls._magic_number_matches(file_path, b"BZ")
-
-    @classmethod
-    def _is_gz(cls, file_path):
-        return cls._magic_number_matches(file_path, bytearray.fromhex("1f8b"))
-
-    @staticmethod
-    def _magic_number_matches(file_path, expected_magic_number):
-        with open(file_path, "rb") as f:
-            file_magic_number = f.read(2)
-            return file_magic_number == expected_magic_number
@@ -0,0 +1,119 @@
+import threading
+
+# The suffixes of the variants of a file that are probed, and their compression
+VARIANT_COMPRESSIONS = ((".xz", "xz"), (".bz2", "bz2"), (".gz", "gz"), ("", None))
+
+# Used until the bandwidth and the speed of each decompressor have been measured.
+# Decompression speeds are in extracted bytes per second.
+DEFAULT_BANDWIDTH = 10 * 1024 * 1024
+DEFAULT_DECOMPRESSION_SPEEDS = {
+    "bz2": 30 * 1024 * 1024,
+    "gz": 300 * 1024 * 1024,
+    "xz": 100 * 1024 * 1024,
+}
+# Typical compression ratios of JSON feeds, used to estimate the size of an
+# extracted file when the size of its uncompressed variant is not known
+DEFAULT_COMPRESSION_RATIOS = {"bz2": 20, "gz": 10, "xz": 20}
+# Downloads and extractions of fewer bytes are too short to time accurately
+MIN_SAMPLE_SIZE = 64 * 1024
+# The weight of each new measurement in the moving averages
+SMOOTHING_FACTOR = 0.3
+
+
+class Variant:
+    __slots__ = ("url", "compression", "size")
+
+    def __init__(self, url, compression, size=None):
+        self.url = url
+        self.compression = compression
+        # The size of the (compressed) file, if the server reported it
+        self.size = size
+
+    def __repr__(self):
+        return "Variant(%r, %r, %r)" % (self.url, self.compression, self.size)
+
+
+class VariantSelector:
+    """Chooses the variant of a file that can be fetched and extracted quickest.
+
+    The bandwidth and the speed of each decompressor are exponentially weighted
+    moving averages of the downloads and extractions that have been recorded. The
+    time to fetch a variant is estimated from its size and the bandwidth, and the
+    time to extract it from the size of the extracted file and the speed of the
+    variant's decompressor.
+    """
+
+    def __init__(self):
+        self.bandwidth = None
+        self.decompression_speeds = {}
+        self._lock = threading.Lock()
+
+    def record_download(self, size, duration):
+        """Record that size bytes were received in duration seconds."""
+        if size < MIN_SAMPLE_SIZE or duration <= 0:
+            return
+
+        with self._lock:
+            self.bandwidth = _update_average(self.bandwidth, size / duration)
+
+    def record_decompression(self, compression, size, duration):
+        """Record that size bytes were extracted from a compression archive."""
+        if compression is None or size < MIN_SAMPLE_SIZE or duration <= 0:
+            return
+
+        with self._lock:
+            self.decompression_speeds[compression] = _update_average(
+                self.decompression_speeds.get(compression), size / duration
+            )
+
+    def estimate_time(self, variant, extracted_size):
+        """Return how long fetching and extracting variant is expected to take."""
+        with self._lock:
+            bandwidth = self.bandwidth or DEFAULT_BANDWIDTH
+            decompression_speed = self.decompression_speeds.get(
+                variant.compression,
+                DEFAULT_DECOMPRESSION_SPEEDS.get(variant.compression),
+            )
+
+        size = variant.size if variant.size is not None else extracted_size
+        estimate = size / bandwidth
+        if variant.compression is not None:
+            estimate += extracted_size / decompression_speed
+
+        return estimate
+
+    def choose(self, variants):
+        """Return the variant that is expected to be the quickest to fetch.
+
+        If the sizes of the variants are unknown, the first variant is returned.
+        """
+        extracted_size = estimate_extracted_size(variants)
+        if extracted_size is None:
+            return variants[0]
+
+        return min(variants, key=lambda v: self.estimate_time(v, extracted_size))
+
+
+def estimate_extracted_size(variants):
+    """Estimate the size of the extracted file from the sizes of its variants.
+
+    Returns None if the size of no variant is known.
+    """
+    estimates = []
+    for variant in variants:
+        if variant.size is None:
+            continue
+
+        if variant.compression is None:
+            return variant.size
+
+        estimates.append(variant.size * DEFAULT_COMPRESSION_RATIOS[variant.compression])
+
+    return max(estimates) if estimates else None
+
+
+def _update_average(average, value):
+    if average is None:
+        return value
+
+    return average + SMOOTHING_FACTOR * (value - average)